@@ -27,6 +27,8 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import heapq
+
 from miro import app
 from miro import models
 from miro import prefs
@@ -45,6 +47,14 @@ def _key_for_feed(feed):
     return feed.orig_url
 
 class Downloader:
+    """Starts pending downloads, up to a maximum number at once.
+
+    Feeds with pending items are kept in a priority queue, ordered by how
+    many downloads they have running, then by the last time we started a
+    download for them.  Entries in the queue aren't updated in place.  When
+    a feed's priority changes we push a new entry and skip the old one when
+    it gets popped (see _pop_feed()).
+    """
     def __init__(self, is_auto):
         self.dc = None
         self.paused = False
@@ -52,7 +62,16 @@ class Downloader:
         self.pending_count = 0
         self.feed_pending_count = {}
         self.feed_running_count = {}
+        # these are all keyed by feed id
         self.feed_time = {}
+        self.feeds = {}
+        self.pending_count_for_feed = {}
+        # maps keys from _key_for_feed() to sets of feed ids
+        self.feeds_for_key = {}
+        # heap of (running count, last start time, feed id) tuples
+        self.feed_queue = []
+        # feed ids that have a valid entry in feed_queue
+        self.queued_feeds = set()
         self.is_auto = is_auto
         if is_auto:
             pending_items = models.Item.auto_pending_view()
@@ -98,50 +117,104 @@ class Downloader:
     def start_downloads_idle(self):
         if self.paused:
             return
-        last_count = 0
         while (self.running_count < self.MAX
-               and self.pending_count > 0
-               and self.pending_count != last_count):
-            last_count = self.pending_count
-            candidate_feeds = []
-            for feed in models.Feed.make_view():
-                key = _key_for_feed(feed)
-                if self.is_auto:
-                    max_new = feed.get_max_new()
-                    if max_new != "unlimited":
-                        count = (self.feed_new_count.get(feed, 0) +
-                                self.feed_running_count.get(key, 0) +
-                                feed.num_unwatched())
-                        if count >= max_new:
-                            continue
-                if self.feed_pending_count.get(key, 0) <= 0:
-                    continue
-                candidate_feeds.append((feed,
-                                        self.feed_running_count.get(key, 0),
-                                        self.feed_time.get(feed, datetime.min)))
-            candidate_feeds.sort(key=lambda x: (x[1], x[2]))
-
-            for feed, count, dummy in candidate_feeds:
-                if self.is_auto:
-                    feed.start_auto_download()
-                else:
-                    feed.start_manual_download()
-                self.feed_time[feed] = datetime.now()
-                if self.running_count >= self.MAX:
-                    break
+               and self.pending_count > 0):
+            feed_id = self._pop_feed()
+            if feed_id is None:
+                break
+            feed = self.feeds[feed_id]
+            if not feed.id_exists():
+                continue
+            if self.is_auto:
+                max_new = feed.get_max_new()
+                if max_new != "unlimited":
+                    key = _key_for_feed(feed)
+                    count = (self.feed_new_count.get(key, 0) +
+                            self.feed_running_count.get(key, 0) +
+                            feed.num_unwatched())
+                    if count >= max_new:
+                        # This feed gets queued again when one of its
+                        # downloads finishes or gets watched.
+                        continue
+            pending_count = self.pending_count
+            if self.is_auto:
+                feed.start_auto_download()
+            else:
+                feed.start_manual_download()
+            self.feed_time[feed_id] = datetime.now()
+            # If we couldn't start anything, wait until the feed gets a
+            # new pending item.
+            if self.pending_count < pending_count:
+                self._queue_feed(feed_id)
         self.dc = None
 
+    def _feed_priority(self, feed_id):
+        key = _key_for_feed(self.feeds[feed_id])
+        return (self.feed_running_count.get(key, 0),
+                self.feed_time.get(feed_id, datetime.min))
+
+    def _queue_feed(self, feed_id):
+        """Add a feed to the priority queue, or update its priority."""
+        if self.pending_count_for_feed.get(feed_id, 0) <= 0:
+            return
+        running_count, start_time = self._feed_priority(feed_id)
+        heapq.heappush(self.feed_queue, (running_count, start_time, feed_id))
+        self.queued_feeds.add(feed_id)
+        if len(self.feed_queue) > 2 * len(self.queued_feeds) + 100:
+            self._compact_feed_queue()
+
+    def _queue_feeds_for_key(self, key, only_queued=False):
+        """Call _queue_feed() for all feeds with a _key_for_feed() key.
+
+        :param only_queued: only update feeds that are already queued
+        """
+        for feed_id in self.feeds_for_key.get(key, ()):
+            if not only_queued or feed_id in self.queued_feeds:
+                self._queue_feed(feed_id)
+
+    def _pop_feed(self):
+        """Get the id of the next feed to start a download for and remove
+        it from the queue.
+
+        :returns: feed id or None if no feeds are queued
+        """
+        while self.feed_queue:
+            running_count, start_time, feed_id = heapq.heappop(
+                self.feed_queue)
+            if ((feed_id in self.queued_feeds and
+                 (running_count, start_time) ==
+                 self._feed_priority(feed_id))):
+                self.queued_feeds.remove(feed_id)
+                return feed_id
+        return None
+
+    def _compact_feed_queue(self):
+        """Remove outdated entries from the priority queue."""
+        self.feed_queue = [self._feed_priority(feed_id) + (feed_id,)
+                           for feed_id in self.queued_feeds]
+        heapq.heapify(self.feed_queue)
+
     def start_downloads(self):
         if self.dc or self.paused:
             return
         self.dc = eventloop.add_idle(self.start_downloads_idle,
                                      "Start Downloads")
 
+    def retry_feed(self, feed):
+        """Try to start downloads for a feed after its settings changed."""
+        self._queue_feed(feed.id)
+        self.start_downloads()
+
     def pending_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count + 1
         self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) + 1
+        self.feeds[feed.id] = feed
+        self.feeds_for_key.setdefault(key, set()).add(feed.id)
+        self.pending_count_for_feed[feed.id] = (
+            self.pending_count_for_feed.get(feed.id, 0) + 1)
+        self._queue_feed(feed.id)
         self.start_downloads()
 
     def pending_on_remove(self, tracker, obj):
@@ -149,18 +222,24 @@ class Downloader:
         key = _key_for_feed(feed)
         self.pending_count = self.pending_count - 1
         self.feed_pending_count[key] = self.feed_pending_count.get(key, 0) - 1
+        self.pending_count_for_feed[feed.id] = (
+            self.pending_count_for_feed.get(feed.id, 0) - 1)
+        if self.pending_count_for_feed[feed.id] <= 0:
+            self.queued_feeds.discard(feed.id)
 
     def running_on_add(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count + 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) + 1
+        self._queue_feeds_for_key(key, only_queued=True)
 
     def running_on_remove(self, tracker, obj):
         feed = obj.get_feed()
         key = _key_for_feed(feed)
         self.running_count = self.running_count - 1
         self.feed_running_count[key] = self.feed_running_count.get(key, 0) - 1
+        self._queue_feeds_for_key(key)
         self.start_downloads()
 
     def new_on_add(self, tracker, obj):
@@ -174,6 +253,7 @@ class Downloader:
         key = _key_for_feed(feed)
         self.new_count = self.new_count - 1
         self.feed_new_count[key] = self.feed_new_count.get(key, 0) - 1
+        self._queue_feeds_for_key(key)
         self.start_downloads()
 
     def pause(self):
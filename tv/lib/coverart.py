@@ -31,9 +31,10 @@
 MovieDataUpdater.
 """
 
+import glob
+import hashlib
 import logging
 import os
-import shutil
 import string
 from mutagen import id3, mp4, flac
 
@@ -58,6 +59,10 @@ class UnknownImageObjectException(StandardError):
         """The types that Image does know how to handle."""
         return self.known_types
 
+# subdirectory of the cover art directory that stores images by the hash of
+# their contents
+CONTENT_STORE_DIRECTORY = 'by-content'
+
 MIME_CHARS = frozenset(string.ascii_letters + '/-')
 def _text_to_mime_chars(text):
     """Given a unicode or str containing arbitrary data, return an ascii str
@@ -133,7 +138,14 @@ class Image(object):
         :raises EnvironmentError: error writing cover art file
         """
         file_handle = fileutil.open_file(path, 'wb')
-        file_handle.write(self.data) 
+        try:
+            file_handle.write(self.data)
+        finally:
+            file_handle.close()
+
+    def content_hash(self):
+        """Get a hex digest of this image's data."""
+        return hashlib.sha1(self.data).hexdigest()
 
     def _set_extension_by_mime(self, raw_mime):
         """If a subclasss can determine its data's mime type, this function will
@@ -197,3 +209,69 @@ class FLACImage(Image):
         else:
             logging.warn("FLAC image without an identifiable type")
         self.data = image_object.data
+
+def store_image(image, cover_art_directory):
+    """Store an image in the content store for a cover art directory.
+
+    Images are stored using the hash of their data, so identical images only
+    get written once.
+
+    :returns: path to the stored image
+    :raises EnvironmentError: error writing the image
+    """
+    store_directory = os.path.join(cover_art_directory,
+                                   CONTENT_STORE_DIRECTORY)
+    filename = '%s.%s' % (image.content_hash(), image.get_extension())
+    path = os.path.join(store_directory, filename)
+    if not os.path.exists(path):
+        if not os.path.exists(store_directory):
+            fileutil.makedirs(store_directory)
+        image.write_to_file(path)
+    return path
+
+def save_image(image, cover_art_directory, dest_path):
+    """Write the cover art file for an album.
+
+    If we can, dest_path is a hard link to the image in the content store, so
+    that albums with the same cover art share their data.  If we can't make
+    hard links, we write the image straight to dest_path.
+
+    :raises EnvironmentError: error writing dest_path
+    """
+    if not hasattr(os, 'link'):
+        image.write_to_file(dest_path)
+        return
+    store_path = store_image(image, cover_art_directory)
+    try:
+        os.link(store_path, dest_path)
+    except OSError, e:
+        logging.debug("coverart: can't link %s (%s)", dest_path, e)
+        image.write_to_file(dest_path)
+        # don't keep a second copy of the image in the content store
+        if os.stat(store_path).st_nlink == 1:
+            fileutil.delete(store_path)
+
+def remove_image(path):
+    """Remove a cover art file that nothing uses anymore.
+
+    If path is linked to an image in the content store and no other cover
+    art file uses that image, the stored image gets removed as well.
+    """
+    store_path = _find_stored_image(path)
+    fileutil.delete(path)
+    if store_path is not None and os.stat(store_path).st_nlink == 1:
+        fileutil.delete(store_path)
+
+def _find_stored_image(path):
+    try:
+        data = open(path, 'rb').read()
+    except EnvironmentError:
+        return None
+    store_directory = os.path.join(os.path.dirname(path),
+                                   CONTENT_STORE_DIRECTORY)
+    pattern = os.path.join(store_directory,
+                           hashlib.sha1(data).hexdigest() + '.*')
+    for candidate in glob.glob(pattern):
+        if fileutil.samefile(candidate, path):
+            return candidate
+    return None
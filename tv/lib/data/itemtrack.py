@@ -547,6 +547,14 @@ class ItemTracker(signals.SignalEmitter):
         """Get a list of all items in sorted order."""
         return [self.get_row(i) for i in xrange(len(self.id_list))]
 
+    def get_loaded_items(self):
+        """Get the items that we've already fetched from the database.
+
+        Unlike get_items(), this never hits the database.  It includes every
+        item that's been displayed, but can also include others.
+        """
+        return self.row_data.values()
+
     def get_playable_ids(self):
         """Get a list of ids for items that can be played."""
         # If we have loaded all items, then we can just use that data
@@ -4417,3 +4417,46 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+def upgrade202(cursor):
+    """Add entries_digest to rss_feed_impl."""
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN entries_digest TEXT")
+
+def upgrade203(cursor):
+    """Add the metadata_cache table."""
+    cursor.execute("CREATE TABLE metadata_cache (id integer PRIMARY KEY, "
+                   "path text, size integer, mtime real, partial_hash text, "
+                   "mutagen pythonrepr, movie_data pythonrepr, "
+                   "cover_art text, screenshot text)")
+    cursor.execute("CREATE INDEX metadata_cache_size ON metadata_cache (size)")
+    cursor.execute("CREATE UNIQUE INDEX metadata_cache_path ON "
+                   "metadata_cache (path)")
+
+@run_on_both
+def upgrade204(cursor):
+    """Add the entry_metadata column to metadata_status.
+
+    NULL means that we haven't calculated it yet, so this works with older
+    versions of miro.
+    """
+    cursor.execute("ALTER TABLE metadata_status "
+                   "ADD COLUMN entry_metadata pythonrepr")
+
+def upgrade205(cursor):
+    """Add the echonest_response_cache table."""
+    cursor.execute("CREATE TABLE echonest_response_cache "
+                   "(id integer PRIMARY KEY, key text, body blob, "
+                   "expires real)")
+    cursor.execute("CREATE INDEX echonest_response_cache_expires ON "
+                   "echonest_response_cache (expires)")
+    cursor.execute("CREATE UNIQUE INDEX echonest_response_cache_key ON "
+                   "echonest_response_cache (key)")
+
+def upgrade206(cursor):
+    """Add last_used to metadata_cache."""
+    cursor.execute("ALTER TABLE metadata_cache ADD COLUMN last_used real")
+    cursor.execute("UPDATE metadata_cache SET last_used=?", (time.time(),))
+    cursor.execute("CREATE INDEX metadata_cache_last_used ON "
+                   "metadata_cache (last_used)")
+    cursor.execute("CREATE INDEX metadata_cache_cover_art ON "
+                   "metadata_cache (cover_art)")
@@ -111,13 +111,23 @@ class RemoveHTTPAuthCommand(Command):
 
 class BatchUpdateDownloadStatus(Command):
     spammy = True
+
+    def __init__(self, daemon, statuses, cmd_done=False):
+        Command.__init__(self, daemon, statuses, cmd_done)
+
     def action(self):
         from miro.downloader import RemoteDownloader
         from miro.messages import DownloaderSyncCommandComplete
 
         cmd_done = self.args[1]
-        fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done)
-                    for status in self.args[0])
+        # Don't stop at the first stale status, we need to merge all of the
+        # deltas to stay in sync with the downloader.  All of these get
+        # saved in one transaction, since the eventloop commits after each
+        # callback.
+        results = [RemoteDownloader.update_status_delta(status,
+                                                        cmd_done=cmd_done)
+                   for status in self.args[0]]
+        fresh = all(results)
         if cmd_done and fresh:
             DownloaderSyncCommandComplete().send_to_frontend()
 
@@ -219,6 +229,15 @@ class DownloaderBatchCommand(Command):
         if mark_reply:
             download.DOWNLOAD_UPDATER.set_cmds_done()
  
+class SetVisibleDownloadsCommand(Command):
+    """Tell the downloader which downloads the user can see.
+
+    args are the same as DownloadStatusUpdater.set_visible().
+    """
+    def action(self):
+        from miro.dl_daemon import download
+        download.DOWNLOAD_UPDATER.set_visible(*self.args)
+
 class MigrateDownloadCommand(Command):
     def action(self):
         from miro.dl_daemon import download
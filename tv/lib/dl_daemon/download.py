@@ -37,6 +37,7 @@ import datetime
 import logging
 import tempfile
 import base64
+import json
 
 from miro.gtcache import gettext as _
 
@@ -55,11 +56,12 @@ from miro import prefs
 
 from miro.dl_daemon import command
 from miro.dl_daemon import daemon
+from miro.dl_daemon import fastresume
 from miro.util import (
-    check_f, check_u, stringify, MAX_TORRENT_SIZE, returns_filename,
+    check_f, check_u, stringify, MAX_TORRENT_SIZE,
     info_hash_from_magnet, is_magnet_uri)
 from miro.plat.utils import (
-    get_available_bytes_for_movies, utf8_to_filename, PlatformFilenameType)
+    get_available_bytes_for_movies, utf8_to_filename)
 
 # Don't remove - it is used for unit tests.
 chatter = True
@@ -121,6 +123,7 @@ def stop_download(dlid, delete):
     try:
         download = _downloads[dlid]
         del _downloads[dlid]
+        DOWNLOAD_UPDATER.download_removed(dlid)
     except KeyError:
         # There is no download with this id
         return True
@@ -135,6 +138,7 @@ def stop_upload(dlid):
         if download.state not in (u"uploading", u"uploading-paused"):
             return
         del _downloads[dlid]
+        DOWNLOAD_UPDATER.download_removed(dlid)
     except KeyError:
         # There is no download with this id
         return
@@ -149,6 +153,7 @@ def pause_upload(dlid):
         if download.state != u"uploading":
             return
         del _downloads[dlid]
+        DOWNLOAD_UPDATER.download_removed(dlid)
     except KeyError:
         # There is no download with this id
         return
@@ -180,7 +185,12 @@ def get_download_status(dlids=None):
 def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
+    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+    FAST_RESUME_STORE.open(os.path.join(support_dir, 'fastresume.sqlite'),
+                           legacy_dir=os.path.join(support_dir, 'fastresume'))
+    FAST_RESUME_STORE.start()
     TORRENT_SESSION.startup()
+    HTTP_SESSION.startup()
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -188,6 +198,9 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    HTTP_SESSION.shutdown()
+    logging.info("Writing fast resume data...")
+    FAST_RESUME_STORE.stop()
     # Flush the status updates.
     logging.info('flushing status updates...')
     DOWNLOAD_UPDATER.flush_update()
@@ -221,6 +234,8 @@ class TorrentSession(object):
         self.torrents = set()
         self.info_hash_to_downloader = {}
         self.session = None
+        # Can we use post_torrent_updates()?  (libtorrent >= 0.16)
+        self.use_alerts = False
         self.pnp_on = None
         self.dht_on = None
         self.pe_set = None
@@ -242,6 +257,12 @@ class TorrentSession(object):
         # MR is for Miro.
         fingerprint = lt.fingerprint("MR", major, minor, 0, 0)
         self.session = lt.session(fingerprint)
+        self.use_alerts = hasattr(self.session, 'post_torrent_updates')
+        if self.use_alerts:
+            self.session.set_alert_mask(
+                lt.alert.category_t.status_notification |
+                lt.alert.category_t.storage_notification |
+                lt.alert.category_t.error_notification)
         self.listen()
         self.set_upnp()
         self.set_dht()
@@ -384,71 +405,253 @@ class TorrentSession(object):
             info_hash = info_hash_to_long(downloader.torrent.info_hash())
             del self.info_hash_to_downloader[info_hash]
 
-    def update_torrents(self):
+    def update_torrents(self, filter_func=None):
+        """Update the status of our torrents.
+
+        If libtorrent supports it, we ask it to post a state_update_alert
+        with the torrents whose status changed since the last call, then
+        handle all pending alerts.  Otherwise we fall back to calling
+        status() for every torrent.
+
+        :param filter_func: if given, only poll torrents that it returns
+            True for.  This is ignored when we use alerts, since idle
+            torrents don't cost anything then.
+        """
+        if self.use_alerts:
+            self.session.post_torrent_updates()
+            self.handle_alerts()
+            return
         # Copy this set into a list in case any of the torrents gets
         # removed during the iteration.
         for torrent in [x for x in self.torrents]:
-            torrent.update_status()
+            if filter_func is None or filter_func(torrent):
+                torrent.update_status()
+
+    def handle_alerts(self):
+        """Handle all of the alerts that libtorrent has queued up."""
+        alert = self.session.pop_alert()
+        while alert is not None:
+            try:
+                self.handle_alert(alert)
+            except StandardError:
+                logging.exception("Error handling libtorrent alert: %s",
+                                  alert.message())
+            alert = self.session.pop_alert()
+
+    def handle_alert(self, alert):
+        if isinstance(alert, lt.state_update_alert):
+            for status in alert.status:
+                downloader = self.downloader_for_handle(status.handle)
+                if downloader is not None:
+                    downloader.handle_status(status)
+        elif isinstance(alert, lt.save_resume_data_alert):
+            if self.downloader_for_handle(alert.handle) is None:
+                # The torrent was stopped or removed after it asked for the
+                # data.  Its resume data was already saved or removed then,
+                # don't write the stale data over that.
+                return
+            info_hash = str(alert.handle.info_hash())
+            FAST_RESUME_STORE.save(info_hash, alert.resume_data)
+        elif isinstance(alert, lt.save_resume_data_failed_alert):
+            logging.warning("Error saving fast resume data: %s",
+                            alert.message())
+
+    def downloader_for_handle(self, handle):
+        """Get the BTDownloader for a torrent handle.
+
+        :returns: the BTDownloader or None if the torrent isn't active
+        """
+        info_hash = info_hash_to_long(handle.info_hash())
+        return self.info_hash_to_downloader.get(info_hash)
 
 TORRENT_SESSION = TorrentSession()
 
+class HTTPSession(object):
+    """Applies the HTTP bandwidth prefs to the libcurl thread."""
+    def __init__(self):
+        self.callback_handle = None
+
+    def startup(self):
+        self.set_download_limit()
+        self.callback_handle = app.downloader_config_watcher.connect(
+                'changed', self.on_config_changed)
+
+    def shutdown(self):
+        if self.callback_handle is not None:
+            app.downloader_config_watcher.disconnect(self.callback_handle)
+            self.callback_handle = None
+
+    def set_download_limit(self):
+        limit = 0
+        if app.config.get(prefs.LIMIT_DOWNSTREAM_HTTP):
+            limit = app.config.get(prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS)
+            limit = limit * (2 ** 10)
+        httpclient.curl_manager.set_rate_limits(download_limit=limit)
+
+    def on_config_changed(self, obj, key, value):
+        if key in (prefs.LIMIT_DOWNSTREAM_HTTP.key,
+                   prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS.key):
+            self.set_download_limit()
+
+HTTP_SESSION = HTTPSession()
+
 class DownloadStatusUpdater(object):
     """Handles updating status for all in progress downloaders.
 
     On OS X and gtk if the user is on the downloads page and has a
     bunch of downloads going, this can be a fairly CPU intensive task.
-    DownloadStatusUpdaters mitigate this in 2 ways.
+    DownloadStatusUpdaters mitigate this in 3 ways.
 
     1. DownloadStatusUpdater objects batch all status updates into one
        big update which takes much less CPU.
 
-    2. The update don't happen fairly infrequently (currently every 5
-       seconds).
+    2. Only the fields that changed since the last update get sent (see
+       calc_delta()).
 
-    Because updates happen infrequently, DownloadStatusUpdaters should
-    only be used for progress updates, not events like downloads
-    starting/finishing.  For those just call update_client() since
-    they are more urgent, and don't happen often enough to cause CPU
-    problems.
+    3. The update rate depends on what the user can see.  The frontend
+       tells us which downloads are visible (see set_visible()).  Those get
+       updated every UPDATE_CLIENT_INTERVAL seconds.  The rest only get
+       updated every HEARTBEAT_INTERVAL seconds, unless their state
+       changes.
+
+    Because updates can be delayed, DownloadStatusUpdaters should only be
+    used for progress updates, not events like downloads
+    starting/finishing.  For those just call update_client() since they
+    are more urgent, and don't happen often enough to cause CPU problems.
     """
 
-    UPDATE_CLIENT_INTERVAL = 1
+    UPDATE_CLIENT_INTERVAL = 0.5
+    HEARTBEAT_INTERVAL = 10
+    # how often we poll libtorrent for torrents that aren't visible
+    TORRENT_UPDATE_INTERVAL = 1
+    # changes to these fields get sent right away
+    IMMEDIATE_FIELDS = ('state', 'activity')
 
     def __init__(self):
         self.to_update = set()
         self.cmds_done = False
+        # maps dlid -> last status dict that we sent to the frontend
+        self.last_sent = {}
+        # maps dlid -> time that we last sent a status
+        self.last_sent_time = {}
+        # dlids for removed downloads, we forget them after the next update
+        self.removed_dlids = set()
+        self.last_torrent_update = 0
+        self.all_visible = False
+        self.visible_dlids = set()
 
     def start_updates(self):
         eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL, self.do_update,
                 "Download status update")
 
     def flush_update(self):
-        self.do_update(periodic=False)
+        self.do_update(periodic=False, send_all=True)
+
+    def set_visible(self, all_visible, dlids):
+        """Set which downloads the user can see.
+
+        :param all_visible: True if the user can see all downloads (they're
+            looking at the downloads tab)
+        :param dlids: dlids of the other visible downloads
+        """
+        self.all_visible = all_visible
+        self.visible_dlids = set(dlids)
+
+    def is_visible(self, downloader):
+        return self.all_visible or downloader.dlid in self.visible_dlids
 
-    def do_update(self, periodic=True):
+    def do_update(self, periodic=True, send_all=False):
         try:
-            TORRENT_SESSION.update_torrents()
+            now = clock()
+            if now - self.last_torrent_update >= self.TORRENT_UPDATE_INTERVAL:
+                TORRENT_SESSION.update_torrents()
+                self.last_torrent_update = now
+            else:
+                TORRENT_SESSION.update_torrents(self.is_visible)
+            # If the frontend is waiting for a reply to a command, send
+            # everything we have.
+            send_all = send_all or self.cmds_done
             statuses = []
+            delayed = set()
             for downloader in self.to_update:
-                statuses.append(downloader.get_status())
-            self.to_update = set()
+                status = downloader.get_status()
+                delta = self._diff_status(status)
+                if len(delta) == 1 and not self.cmds_done:
+                    # nothing changed
+                    continue
+                if not (send_all or self._should_send(downloader, delta,
+                                                      now)):
+                    delayed.add(downloader)
+                    continue
+                self._mark_sent(status, now)
+                statuses.append(delta)
+            self.to_update = delayed
             if statuses or self.cmds_done:
                 command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
                                                   statuses,
                                                   self.cmds_done).send()
                 self.cmds_done = False
+            for dlid in self.removed_dlids:
+                self.last_sent.pop(dlid, None)
+                self.last_sent_time.pop(dlid, None)
+            self.removed_dlids = set()
         finally:
             if periodic:
                 eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL,
                                       self.do_update,
                                       "Download status update")
 
+    def _should_send(self, downloader, delta, now):
+        if self.is_visible(downloader):
+            return True
+        for field in self.IMMEDIATE_FIELDS:
+            if field in delta:
+                return True
+        last_time = self.last_sent_time.get(downloader.dlid, 0)
+        return now - last_time >= self.HEARTBEAT_INTERVAL
+
+    def calc_delta(self, status):
+        """Get the part of a status dict that's changed since the last
+        time we sent it.
+
+        The frontend merges the delta with the last status that it got (see
+        RemoteDownloader.update_status_delta()).  Call this right before
+        sending the status, since it records it as the last one sent.
+
+        :returns: dict with the changed fields and the dlid
+        """
+        delta = self._diff_status(status)
+        self._mark_sent(status, clock())
+        return delta
+
+    def _diff_status(self, status):
+        dlid = status['dlid']
+        last = self.last_sent.get(dlid)
+        if last is None:
+            return status
+        delta = dict((key, value) for key, value in status.iteritems()
+                     if key not in last or last[key] != value)
+        delta['dlid'] = dlid
+        return delta
+
+    def _mark_sent(self, status, now):
+        self.last_sent[status['dlid']] = status
+        self.last_sent_time[status['dlid']] = now
+
     def set_cmds_done(self):
         self.cmds_done = True
 
     def queue_update(self, downloader):
         self.to_update.add(downloader)
 
+    def download_removed(self, dlid):
+        """Call this when a download is removed from _downloads.
+
+        We send any queued status for it, then forget the last status that
+        we sent.
+        """
+        self.removed_dlids.add(dlid)
+
 DOWNLOAD_UPDATER = DownloadStatusUpdater()
 
 # retry times in seconds.  60 seconds, 5 minutes, ...
@@ -504,8 +707,9 @@ class BGDownloader(object):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
+            delta = DOWNLOAD_UPDATER.calc_delta(self.get_status())
             command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+                                              [delta]).send()
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
@@ -722,6 +926,87 @@ class BGDownloader(object):
             accept = (size <= available)
         return accept
 
+# Don't split up downloads into segments smaller than this
+SEGMENT_MIN_SIZE = 4 * (2 ** 20)
+# Max number of segments for a download.  One segment uses a regular download
+# connection, the others use the connections that httpclient allows per host
+# for PRIORITY_SEGMENT.
+MAX_SEGMENTS = (httpclient.HOST_CONNECTION_LIMITS[
+    httpclient.PRIORITY_SEGMENT] + 1)
+# How often to save the segment state while a segmented download is running
+SEGMENT_STATE_SAVE_INTERVAL = 10
+
+def segment_state_path(filename):
+    """Path to the file that stores the segment state for a download."""
+    return filename + '.segments'
+
+class Segment(object):
+    """Byte range of a segmented HTTP download.
+
+    Each segment is downloaded over its own connection and written directly
+    into its part of the preallocated file.
+
+    :attribute start: first byte of the range
+    :attribute end: last byte of the range (inclusive)
+    :attribute done: number of bytes stored for finished transfers
+    """
+    def __init__(self, start, end, done=0):
+        self.start = start
+        self.end = end
+        self.done = done
+        self.client = None
+        self.sink = None
+
+    def length(self):
+        return self.end - self.start + 1
+
+    def current_done(self):
+        """Number of bytes we have, including the running transfer."""
+        if self.sink is not None:
+            return self.done + self.sink.bytes_written
+        return self.done
+
+    def is_finished(self):
+        """Check if all our data is stored.
+
+        The running transfer doesn't count, even if it has written all of
+        its bytes, since its file might still be open and unflushed.
+        """
+        return self.sink is None and self.done >= self.length()
+
+    def start_transfer(self, url, path, callback, errback,
+                       priority=httpclient.PRIORITY_SEGMENT):
+        offset = self.start + self.done
+        self.sink = httpclient.RangeFileSink(path, offset)
+        self.client = httpclient.grab_url(url,
+                lambda info: callback(self, info),
+                lambda error: errback(self, error),
+                body_sink=self.sink, byte_range=(offset, self.end),
+                priority=priority)
+
+    def transfer_done(self):
+        """Call when our transfer finishes, fails or gets canceled."""
+        if self.sink is not None:
+            # Note: if we got canceled, the sink might still be getting
+            # written to.  That's okay, undercounting just means that we
+            # download a couple bytes twice.
+            self.done += self.sink.bytes_written
+            self.sink = None
+        self.client = None
+
+    def stop(self):
+        if self.client is not None:
+            self.client.cancel()
+        self.transfer_done()
+
+    def get_rate(self):
+        if self.client is None:
+            return 0
+        return self.client.get_stats().download_rate
+
+    def to_list(self):
+        return [self.start, self.end, self.current_done()]
+
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
 
@@ -738,6 +1023,10 @@ class HTTPDownloader(BGDownloader):
             self.restartOnError = False
         self.client = None
         self.rate = None
+        # list of Segment objects when we're doing a segmented download
+        self.segments = None
+        self.segmented_ok = True
+        self.last_segment_save = 0
         if self.state == u'downloading':
             self.start_download()
         elif self.state == u'offline':
@@ -755,6 +1044,18 @@ class HTTPDownloader(BGDownloader):
         if self.retry_dc:
             self.retry_dc.cancel()
             self.retry_dc = None
+        if self._should_use_segments():
+            if resume and self._load_segment_state():
+                self._start_segments()
+                return
+            if not resume or self.current_size == 0:
+                self._probe_for_segments()
+                return
+        if os.path.exists(segment_state_path(self.filename)):
+            # The file was preallocated for a segmented download.  We can't
+            # resume it by appending, so start over.
+            self._remove_segment_state()
+            resume = False
         if resume:
             resume = self._resume_sanity_check()
 
@@ -763,9 +1064,192 @@ class HTTPDownloader(BGDownloader):
         self.client = httpclient.grab_url(
             self.url, self.on_download_finished, self.on_download_error,
             header_callback=self.on_headers, write_file=self.filename,
-            resume=resume)
+            resume=resume, priority=httpclient.PRIORITY_DOWNLOAD)
+        self.update_stats()
+
+    def _should_use_segments(self):
+        return (self.segmented_ok and
+                app.config.get(prefs.HTTP_SEGMENTED_DOWNLOADS) and
+                app.config.get(prefs.HTTP_SEGMENT_COUNT) > 1)
+
+    def _probe_for_segments(self):
+        """Check if the server supports ranges before segmenting."""
+        logging.debug("probing for segmented download: %s", self.url)
+        self.current_size = 0
+        self._remove_segment_state()
+        self.client = httpclient.grab_headers(self.url,
+                self.on_probe_headers, self.on_probe_error)
+
+    def on_probe_headers(self, info):
+        self.client = None
+        if self.state != u'downloading':
+            return
+        size = info.get('total-size')
+        if (info.get('status') == 200 and size is not None and
+                size >= SEGMENT_MIN_SIZE * 2 and
+                info.get('accept-ranges', '').lower() == 'bytes'):
+            self.on_headers(info)
+            if self.state != u'downloading':
+                # on_headers() failed the download
+                return
+            try:
+                self._create_segments(size)
+            except (OSError, IOError), e:
+                logging.warn("error preallocating %s: %s", self.filename, e)
+                self._fallback_from_segments()
+                return
+            self._start_segments()
+        else:
+            self._fallback_from_segments()
+
+    def on_probe_error(self, error):
+        self.client = None
+        if self.state != u'downloading':
+            return
+        # Let the regular download code deal with any errors
+        self._fallback_from_segments()
+
+    def _fallback_from_segments(self):
+        self.segmented_ok = False
+        self.start_download(resume=False)
+
+    def _create_segments(self, size):
+        count = min(app.config.get(prefs.HTTP_SEGMENT_COUNT), MAX_SEGMENTS,
+                size // SEGMENT_MIN_SIZE)
+        segment_size = size // count
+        self.segments = []
+        for i in xrange(count):
+            start = i * segment_size
+            if i < count - 1:
+                end = start + segment_size - 1
+            else:
+                end = size - 1
+            self.segments.append(Segment(start, end))
+        self.total_size = size
+        self.current_size = 0
+        # Save our state before preallocating, so that we never try to
+        # resume from the preallocated file by appending to it.
+        self._save_segment_state()
+        f = fileutil.open_file(self.filename, 'wb')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+    def _start_segments(self):
+        logging.debug("starting segmented download: %s (%d segments)",
+                self.url, len(self.segments))
+        # The first segment that we start gets a regular download
+        # connection, so the download always makes progress even if the
+        # extra segment connections for the host are in use.
+        priority = httpclient.PRIORITY_DOWNLOAD
+        for segment in self.segments:
+            if not segment.is_finished() and segment.client is None:
+                segment.start_transfer(self.url, self.filename,
+                        self.on_segment_finished, self.on_segment_error,
+                        priority)
+                priority = httpclient.PRIORITY_SEGMENT
+        if self._check_segments_finished():
+            return
         self.update_stats()
 
+    def _stop_segments(self, remove_file=False):
+        for segment in self.segments:
+            segment.stop()
+        if remove_file:
+            self._remove_segment_state()
+        else:
+            self._save_segment_state()
+        self.current_size = sum(seg.done for seg in self.segments)
+        self.segments = None
+
+    def on_segment_finished(self, segment, info):
+        if self.segments is None or segment not in self.segments:
+            return
+        segment.transfer_done()
+        if not segment.is_finished():
+            self.on_segment_error(segment, httpclient.ServerClosedConnection(
+                info.get('original-url', self.url)))
+            return
+        self._check_segments_finished()
+
+    def _check_segments_finished(self):
+        if not all(seg.is_finished() for seg in self.segments):
+            return False
+        self.segments = None
+        self._remove_segment_state()
+        self.current_size = self.total_size
+        self.on_download_finished(None)
+        return True
+
+    def on_segment_error(self, segment, error):
+        if self.segments is None or segment not in self.segments:
+            return
+        segment.transfer_done()
+        self._stop_segments()
+        if isinstance(error, httpclient.ResumeFailed):
+            # The server ignored our Range header, use a single connection
+            # from now on.
+            self.segmented_ok = False
+        self.on_download_error(error)
+
+    def _save_segment_state(self):
+        data = {
+            'url': self.url,
+            'total_size': self.total_size,
+            'segments': [seg.to_list() for seg in self.segments],
+        }
+        path = segment_state_path(self.filename)
+        try:
+            f = fileutil.open_file(path, 'wb')
+            try:
+                json.dump(data, f)
+            finally:
+                f.close()
+        except (OSError, IOError), e:
+            logging.warn("error saving segment state for %s: %s",
+                    self.filename, e)
+        self.last_segment_save = clock()
+
+    def _load_segment_state(self):
+        """Try to load segments saved by _save_segment_state().
+
+        :returns: True if we loaded the segments
+        """
+        path = segment_state_path(self.filename)
+        if not os.path.exists(path):
+            return False
+        try:
+            f = fileutil.open_file(path, 'rb')
+            try:
+                data = json.load(f)
+            finally:
+                f.close()
+            if data['url'] != self.url:
+                raise ValueError("URL changed")
+            segments = [Segment(start, end, done)
+                        for (start, end, done) in data['segments']]
+            total_size = data['total_size']
+            if os.stat(self.filename)[stat.ST_SIZE] != total_size:
+                raise ValueError("file size changed")
+        except (OSError, IOError, ValueError, KeyError, TypeError), e:
+            logging.warn("error loading segment state for %s: %s",
+                    self.filename, e)
+            self._remove_segment_state()
+            return False
+        self.segments = segments
+        self.total_size = total_size
+        self.current_size = sum(seg.done for seg in segments)
+        return True
+
+    def _remove_segment_state(self):
+        path = segment_state_path(self.filename)
+        if os.path.exists(path):
+            try:
+                fileutil.remove(path)
+            except OSError:
+                pass
+
     def _resume_sanity_check(self):
         """Do sanity checks to test if we should try HTTP Resume.
 
@@ -802,6 +1286,13 @@ class HTTPDownloader(BGDownloader):
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
+        if self.segments is not None:
+            self._stop_segments(remove_file=remove_file)
+            if remove_file:
+                try:
+                    fileutil.remove(self.filename)
+                except OSError:
+                    pass
         # if it's in a retrying state, we want to nix that, too
         if self.retry_dc:
             self.retry_dc.cancel()
@@ -810,6 +1301,7 @@ class HTTPDownloader(BGDownloader):
     def handle_error(self, short_reason, reason):
         BGDownloader.handle_error(self, short_reason, reason)
         self.cancel_request()
+        self._remove_segment_state()
         if os.path.exists(self.filename):
             try:
                 fileutil.remove(self.filename)
@@ -896,16 +1388,29 @@ class HTTPDownloader(BGDownloader):
         """Update the download rate and eta based on receiving length
         bytes.
         """
-        if self.client is None or self.state != u'downloading':
+        if self.state != u'downloading':
             return
-        stats = self.client.get_stats()
-        if stats.status_code in (200, 206):
-            # Only upload current_size/rate if we are currently
-            # downloading something.  Don't change them before the
-            # transfer starts, while we are handling redirects, etc.
-            self.current_size = stats.downloaded + stats.initial_size
-            self.rate = stats.download_rate
-        eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
+        if self.segments is not None:
+            self.current_size = sum(seg.current_done()
+                                    for seg in self.segments)
+            self.rate = sum(seg.get_rate() for seg in self.segments)
+            if clock() - self.last_segment_save > SEGMENT_STATE_SAVE_INTERVAL:
+                self._save_segment_state()
+        elif self.client is None:
+            return
+        else:
+            stats = self.client.get_stats()
+            if stats.status_code in (200, 206):
+                # Only upload current_size/rate if we are currently
+                # downloading something.  Don't change them before the
+                # transfer starts, while we are handling redirects, etc.
+                self.current_size = stats.downloaded + stats.initial_size
+                self.rate = stats.download_rate
+        timeout = self.CHECK_STATS_TIMEOUT
+        if DOWNLOAD_UPDATER.is_visible(self):
+            # poll faster so that the user sees smooth progress
+            timeout = min(timeout, DOWNLOAD_UPDATER.UPDATE_CLIENT_INTERVAL)
+        eventloop.add_timeout(timeout, self.update_stats,
                 'update http downloader stats')
         self.update_client()
 
@@ -954,81 +1459,7 @@ class HTTPDownloader(BGDownloader):
         self.update_client()
 
 
-@returns_filename
-def generate_fast_resume_filename(info_hash):
-    filename = PlatformFilenameType(clean_filename(info_hash) + ".fastresume")
-
-    support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
-    fast_resume_file = os.path.join(support_dir, 'fastresume', filename)
-
-    return fast_resume_file
-
-def save_fast_resume_data(info_hash, fast_resume_data):
-    """Saves fast_resume_data to disk.
-
-    If it encounters problems, then it prints something to the log
-    and otherwise eats the exceptions.
-
-    :param info_hash: the torrent handle info hash--this is unique to
-        a torrent.
-    :param fast_resume_data: the bencoded fast resume data to save to
-        disk
-    """
-    fast_resume_file = generate_fast_resume_filename(info_hash)
-    fast_resume_dir = os.path.dirname(fast_resume_file)
-
-    if not os.path.exists(fast_resume_dir):
-        try:
-            fileutil.makedirs(fast_resume_dir)
-        except OSError:
-            logging.exception("can't save fast_resume_data")
-            return
-
-    try:
-        with open(fast_resume_file, 'wb') as f:
-            f.write(fast_resume_data)
-    except (OSError, IOError):
-        logging.exception("Error occured trying to write fast_resume_data")
-        try:
-            os.unlink(fast_resume_file)
-        except (OSError, IOError):
-            pass
-
-def load_fast_resume_data(info_hash):
-    """Loads fast_resume_data from file on disk.
-
-    :param info_hash: the torrent handle info hash--this is unique to
-        a torrent.
-
-    :returns: None if there are errors or it doesn't exist, or
-        the bencoded fast resume data
-    """
-    fast_resume_file = generate_fast_resume_filename(info_hash)
-    if not os.path.exists(fast_resume_file):
-        return None
-
-    try:
-        f = open(fast_resume_file, "rb")
-        fast_resume_data = f.read()
-        f.close()
-        return fast_resume_data
-    except StandardError:
-        logging.exception("exception kicked up when loading fast "
-                          "resume data")
-    return None
-
-def remove_fast_resume_data(info_hash):
-    """Removes fast_resume_data from file on disk.
-
-    :param info_hash: the torrent handle info hash--this is unique to
-        a torrent.
-    """
-    fast_resume_file = generate_fast_resume_filename(info_hash)
-    if os.path.exists(fast_resume_file):
-        try:
-            fileutil.remove(fast_resume_file)
-        except OSError:
-            logging.exception("remove_fast_resume_data kicked up exception")
+FAST_RESUME_STORE = fastresume.FastResumeStore()
 
 # update fast resume data every 5 seconds
 FRD_UPDATE_LIMIT = 5
@@ -1126,9 +1557,9 @@ class BTDownloader(BGDownloader):
                 params["storage_mode"] = lt.storage_mode_t.storage_mode_compact
 
             if self.info_hash:
-                self.fast_resume_data = load_fast_resume_data(self.info_hash)
+                self.fast_resume_data = FAST_RESUME_STORE.load(self.info_hash)
                 if self.fast_resume_data:
-                    params["resume_data"] = lt.bencode(self.fast_resume_data)
+                    params["resume_data"] = self.fast_resume_data
 
             if self.magnet:
                 self.torrent = lt.add_magnet_uri(TORRENT_SESSION.session,
@@ -1254,7 +1685,12 @@ class BTDownloader(BGDownloader):
                       self.current_size)
 
     def update_status(self):
-        """
+        """Poll libtorrent for our status."""
+        self.handle_status(self.torrent.status())
+
+    def handle_status(self, status):
+        """Update our attributes from a libtorrent torrent_status.
+
         activity -- string specifying what's currently happening or None for
                 normal operations.
         upload_rate -- upload rate in B/s
@@ -1268,7 +1704,6 @@ class BTDownloader(BGDownloader):
         leechers -- number of leechers for this torrent
         connecting -- nummber of peers we're connected to
         """
-        status = self.torrent.status()
         self.total_size = status.total_wanted
         self.rate = int(status.download_payload_rate)
         self.upload_rate = int(status.upload_payload_rate)
@@ -1340,12 +1775,15 @@ class BTDownloader(BGDownloader):
             return
         self._last_frd_update = time_now
 
+        if TORRENT_SESSION.use_alerts and not force:
+            # libtorrent will send a save_resume_data_alert, see
+            # TorrentSession.handle_alert().  We can't do this when forced,
+            # since the torrent is about to be removed.
+            self.torrent.save_resume_data()
+            return
+
         try:
-            # FIXME - we should switch to save_resume_data which uses
-            # an alert to save resume data rather than
-            # write_resume_data which looks deprecated in 0.15.5.
-            self.fast_resume_data = lt.bencode(
-                self.torrent.write_resume_data())
+            resume_data = self.torrent.write_resume_data()
         except RuntimeError, rte:
             # write_resume_data can kick up a
             # boost::filesystem::exists: Access is denied error.  If
@@ -1356,7 +1794,7 @@ class BTDownloader(BGDownloader):
                 "RuntimeError kicked up in update_fast_resume_data: %s", rte)
             return
 
-        save_fast_resume_data(self.info_hash, self.fast_resume_data)
+        FAST_RESUME_STORE.save(self.info_hash, resume_data)
 
     def handle_error(self, short_reason, reason):
         self._shutdown_torrent()
@@ -1431,7 +1869,7 @@ class BTDownloader(BGDownloader):
                 pass
 
             if self.info_hash:
-                remove_fast_resume_data(self.info_hash)
+                FAST_RESUME_STORE.remove(self.info_hash)
 
     def stop_upload(self):
         self.state = u"finished"
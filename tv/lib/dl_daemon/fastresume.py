@@ -0,0 +1,237 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""fastresume.py -- Store fast resume data for torrents.
+
+All of the fast resume data is kept in a single sqlite database.  Older
+versions wrote one file per torrent to the fastresume directory, which meant
+a lot of files to read at startup, and a crash in the middle of a write
+could leave a torn file.
+
+Writes happen in a background thread.  That thread handles all of the jobs
+that are queued up in a single transaction, so a batch of saves is atomic
+and takes one commit.  At startup we read every row in one query and keep
+the data in memory.
+"""
+
+import logging
+import os
+import threading
+import Queue
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+import libtorrent as lt
+
+from miro import fileutil
+from miro.plat.utils import thread_body
+
+LEGACY_SUFFIX = '.fastresume'
+
+class FastResumeStore(object):
+    """Stores fast resume data for all of our torrents.
+
+    Call open() to load the data, then start() to start the writer thread.
+    Before start() is called, writes happen right away in the calling
+    thread.  Jobs run in the order they were added, so a removal always
+    happens after any earlier saves for the same torrent.
+    """
+    def __init__(self):
+        self.connection = None
+        # maps info hashes to resume data.  Data loaded from the database is
+        # bencoded, data from save() is what libtorrent gave us.  load()
+        # takes care of the difference.
+        self.cache = {}
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def open(self, path, legacy_dir=None):
+        """Open the database and load all of the resume data.
+
+        :param path: path to the sqlite database
+        :param legacy_dir: directory with resume data files from older
+            versions.  If it exists, they get moved into the database and
+            the directory is removed.
+        """
+        try:
+            self.connection = sqlite3.connect(path, isolation_level=None,
+                                              check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS "
+                                    "fast_resume(info_hash TEXT PRIMARY KEY, "
+                                    "data BLOB NOT NULL)")
+            if legacy_dir is not None and os.path.isdir(legacy_dir):
+                self._migrate_files(legacy_dir)
+            cursor = self.connection.execute("SELECT info_hash, data "
+                                              "FROM fast_resume")
+            self.cache = dict((str(info_hash), str(data))
+                              for info_hash, data in cursor)
+        except sqlite3.DatabaseError:
+            logging.exception("Error opening fast resume database")
+            self.close()
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _migrate_files(self, legacy_dir):
+        """Move the resume data files from older versions into the
+        database.
+        """
+        rows = []
+        for filename in os.listdir(legacy_dir):
+            if not filename.endswith(LEGACY_SUFFIX):
+                continue
+            info_hash = filename[:-len(LEGACY_SUFFIX)]
+            try:
+                f = open(os.path.join(legacy_dir, filename), 'rb')
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except (OSError, IOError):
+                logging.warning("Error reading fast resume data for %s",
+                                info_hash, exc_info=True)
+                continue
+            rows.append((info_hash, buffer(data)))
+        self._run_in_transaction(self.connection.executemany,
+                                 "INSERT OR REPLACE INTO fast_resume "
+                                 "(info_hash, data) VALUES (?, ?)", rows)
+        logging.info("Migrated fast resume data for %d torrents", len(rows))
+        try:
+            fileutil.rmtree(legacy_dir)
+        except OSError:
+            logging.warning("Error removing %s", legacy_dir, exc_info=True)
+
+    def start(self):
+        self.thread = threading.Thread(target=thread_body,
+                                       args=[self.loop],
+                                       name="Fast Resume Writer")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Finish all pending writes, stop the thread and close the
+        database.
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self.close()
+
+    def load(self, info_hash):
+        """Get the resume data for a torrent.
+
+        :returns: bencoded resume data, or None if we don't have any
+        """
+        data = self.cache.get(info_hash)
+        if data is not None and not isinstance(data, str):
+            data = lt.bencode(data)
+        return data
+
+    def save(self, info_hash, resume_data):
+        """Save the resume data for a torrent.
+
+        :param info_hash: info hash of the torrent
+        :param resume_data: resume data as returned by libtorrent.  We
+            bencode it in the writer thread.
+        """
+        # Update the cache now, so that load() sees the new data even if the
+        # writer thread hasn't gotten to it yet.
+        self.cache[info_hash] = resume_data
+        self.add_job(self._save, info_hash, resume_data)
+
+    def remove(self, info_hash):
+        """Remove the resume data for a torrent."""
+        self.cache.pop(info_hash, None)
+        self.add_job(self._remove, info_hash)
+
+    def add_job(self, func, *args):
+        if self.thread is None:
+            self._run_jobs([(func, args)])
+        else:
+            self.queue.put((func, args))
+
+    def _save(self, info_hash, resume_data):
+        if self.connection is not None:
+            data = lt.bencode(resume_data)
+            self.connection.execute("INSERT OR REPLACE INTO fast_resume "
+                                    "(info_hash, data) VALUES (?, ?)",
+                                    (info_hash, buffer(data)))
+
+    def _remove(self, info_hash):
+        if self.connection is not None:
+            self.connection.execute("DELETE FROM fast_resume "
+                                    "WHERE info_hash=?", (info_hash,))
+
+    def _run_jobs(self, jobs):
+        try:
+            self._run_in_transaction(self._run_job_list, jobs)
+        except sqlite3.DatabaseError:
+            logging.exception("Error writing fast resume data")
+
+    def _run_job_list(self, jobs):
+        for func, args in jobs:
+            try:
+                func(*args)
+            except sqlite3.DatabaseError:
+                raise
+            except StandardError:
+                logging.exception("Error in fast resume job")
+
+    def _run_in_transaction(self, func, *args):
+        if self.connection is None:
+            func(*args)
+            return
+        self.connection.execute("BEGIN")
+        try:
+            func(*args)
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        else:
+            self.connection.execute("COMMIT")
+
+    def loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            # Handle everything that's queued up in one transaction
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in jobs
+            self._run_jobs([job for job in jobs if job is not None])
+            if stop:
+                break
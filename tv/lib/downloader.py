@@ -84,6 +84,12 @@ class DownloadStateManager(object):
         self.startup_commands = dict()
         self.commands = dict()
         self.bulk_mode = False
+        # Maps dlids to the last status dict we got from the downloader
+        # daemon.  The daemon only sends the fields that changed, so we need
+        # to remember the rest.
+        self.daemon_statuses = {}
+        # (all_visible, dlids) for the downloads that the user can see
+        self.visible_downloads = (False, set())
 
     def set_bulk_mode(self):
         self.bulk_mode = True
@@ -138,6 +144,32 @@ class DownloadStateManager(object):
     def daemon_started(self):
         return self.daemon_starter and self.daemon_starter.started
 
+    def set_visible_downloads(self, all_visible, downloader_ids):
+        """Set which downloads the user can see.
+
+        The downloader daemon sends frequent progress updates for these and
+        only occasional ones for the rest.
+
+        :param all_visible: True if all downloads are visible
+        :param downloader_ids: ids of other RemoteDownloaders that are
+            visible
+        """
+        dlids = set()
+        for downloader_id in downloader_ids:
+            try:
+                dlids.add(RemoteDownloader.get_by_id(downloader_id).dlid)
+            except ObjectNotFoundError:
+                pass
+        self.visible_downloads = (all_visible, dlids)
+        if self.daemon_started():
+            self.send_visible_downloads()
+
+    def send_visible_downloads(self):
+        all_visible, dlids = self.visible_downloads
+        c = command.SetVisibleDownloadsCommand(RemoteDownloader.dldaemon,
+                                               all_visible, dlids)
+        c.send()
+
     def queue(self, identifier, cmd, args):
         if not self.downloads.has_key(identifier):
             raise ValueError('add_download() not called before queue()')
@@ -195,6 +227,7 @@ class DownloadStateManager(object):
         self.daemon_starter.startup()
         # Now that the daemon has started, we can process updates.
         self.send_initial_updates()
+        self.send_visible_downloads()
         self.start_updates()
     
     def shutdown_downloader(self, callback=None):
@@ -443,10 +476,38 @@ class RemoteDownloader(DDBObject):
 
     @classmethod
     def update_status(cls, data, cmd_done=False):
+        """Update a downloader from a status dict.
+
+        :returns: False if the update was stale and got ignored
+        """
+        cls._unicodify_status(data)
+        return cls._apply_status(data, cmd_done)
+
+    @classmethod
+    def update_status_delta(cls, delta, cmd_done=False):
+        """Update a downloader from a status sent by the downloader daemon.
+
+        The daemon only sends the fields that have changed since the last
+        status it sent for a dlid, we merge them with the previous ones.
+        The merged status is stored even if the update turns out to be
+        stale, so that we stay in sync with the daemon.
+
+        :returns: False if the update was stale and got ignored
+        """
+        cls._unicodify_status(delta)
+        daemon_statuses = app.download_state_manager.daemon_statuses
+        status = daemon_statuses.setdefault(delta['dlid'], {})
+        status.update(delta)
+        return cls._apply_status(status.copy(), cmd_done)
+
+    @staticmethod
+    def _unicodify_status(data):
         for field in data:
             if field not in ['filename', 'short_filename', 'metainfo']:
                 data[field] = unicodify(data[field])
 
+    @classmethod
+    def _apply_status(cls, data, cmd_done):
         self = get_downloader_by_dlid(dlid=data['dlid'])
         # FIXME: how do we get all of the possible bit torrent
         # activity strings into gettext? --NN
@@ -770,6 +831,7 @@ class RemoteDownloader(DDBObject):
                              "but state is %s", self.get_state())
         self.stop(self.delete_files)
         self.after_changing_rates()
+        app.download_state_manager.daemon_statuses.pop(self.dlid, None)
         DDBObject.remove(self)
 
     def get_type(self):
@@ -31,13 +31,16 @@
 
 import collections
 import difflib
+import hashlib
 import logging
 import os
 import os.path
+import time
 import urllib
 from xml.dom import minidom
 from xml.parsers import expat
 
+from miro import database
 from miro import filetags
 from miro import httpclient
 from miro import util
@@ -62,6 +65,124 @@ class ResponseParsingError(StandardError):
 class CodegenNotSupported(StandardError):
     """ENMFP can't run in the user's architecture."""
 
+class ResponseCacheEntry(database.DDBObject):
+    """Cached reply from echonest or 7digital.
+
+    Replies that found something are kept for POSITIVE_TTL seconds.  Replies
+    that didn't find anything are kept for NEGATIVE_TTL seconds, since
+    echonest and 7digital add to their catalogs over time.  We don't cache
+    HTTP errors or replies that we can't parse.
+    """
+    POSITIVE_TTL = 30 * 24 * 60 * 60
+    NEGATIVE_TTL = 24 * 60 * 60
+
+    def setup_new(self, key, body, ttl):
+        self.key = key
+        self.body = body
+        self.expires = time.time() + ttl
+
+    def is_expired(self):
+        return self.expires < time.time()
+
+    @classmethod
+    def get_by_key(cls, key, db_info=None):
+        return cls.make_view('key=?', (key,), db_info=db_info).get_singleton()
+
+    @classmethod
+    def remove_expired(cls, db_info=None):
+        view = cls.make_view('expires < ?', (time.time(),), db_info=db_info)
+        for entry in view:
+            entry.remove()
+
+def _request_key(url, **kwargs):
+    digest = hashlib.sha1(url)
+    for key in sorted(kwargs.keys()):
+        digest.update(repr((key, kwargs[key])))
+    return unicode(digest.hexdigest())
+
+# maps request keys to the (callback, errback) pairs for requests that are
+# waiting on the same reply
+_requests_in_flight = {}
+
+def _grab_url_cached(url, callback, errback, ttl_func=None, **kwargs):
+    """Call httpclient.grab_url() using ResponseCacheEntry.
+
+    If there's an unexpired cache entry for the request, we call callback
+    with its body from an idle callback.  If another identical request is
+    in progress, we wait for its reply rather than sending a new one.
+
+    :param ttl_func: function that takes the body of a reply and returns
+        how many seconds to cache it for, or None to not cache it.  If
+        ttl_func is None, we don't use the cache at all.
+    :param kwargs: keyword arguments to pass to grab_url()
+    """
+    key = _request_key(url, **kwargs)
+    if ttl_func is not None:
+        try:
+            entry = ResponseCacheEntry.get_by_key(key)
+        except database.ObjectNotFoundError:
+            pass
+        else:
+            if not entry.is_expired():
+                eventloop.add_idle(callback, 'echonest cache hit',
+                                   args=({'body': entry.body},))
+                return
+            entry.remove()
+
+    if key in _requests_in_flight:
+        _requests_in_flight[key].append((callback, errback))
+        return
+    _requests_in_flight[key] = [(callback, errback)]
+
+    def grab_url_callback(data):
+        waiting = _requests_in_flight.pop(key, [])
+        if ttl_func is not None:
+            _cache_response(key, data['body'], ttl_func)
+        for callback, errback in waiting:
+            trapcall.trap_call('echonest response callback', callback, data)
+
+    def grab_url_errback(error):
+        waiting = _requests_in_flight.pop(key, [])
+        for callback, errback in waiting:
+            trapcall.trap_call('echonest response errback', errback, error)
+
+    httpclient.grab_url(url, grab_url_callback, grab_url_errback, **kwargs)
+
+def _cache_response(key, body, ttl_func):
+    try:
+        ttl = ttl_func(body)
+    except (StandardError, expat.ExpatError):
+        # We'll log the error when we handle the reply
+        return
+    if ttl is not None:
+        try:
+            ResponseCacheEntry.get_by_key(key).remove()
+        except database.ObjectNotFoundError:
+            pass
+        ResponseCacheEntry(key, body, ttl)
+
+def _echonest_reply_ttl(echonest_reply):
+    response = json.loads(echonest_reply.decode('utf-8'))['response']
+    if response['status']['code'] != 0:
+        return None
+    songs = response['songs']
+    for song in songs:
+        if 'error' in song:
+            return None
+    if len(songs) == 0:
+        return ResponseCacheEntry.NEGATIVE_TTL
+    else:
+        return ResponseCacheEntry.POSITIVE_TTL
+
+def _seven_digital_reply_ttl(seven_digital_reply):
+    doc = minidom.parseString(seven_digital_reply)
+    if len(doc.getElementsByTagName('error')) != 0:
+        return ResponseCacheEntry.NEGATIVE_TTL
+    elif len(doc.getElementsByTagName('release')) != 0:
+        return ResponseCacheEntry.POSITIVE_TTL
+    else:
+        return None
+
 def exec_codegen(codegen_info, media_path, callback, errback):
     """Run an echonest codegen in a worker thread.
 
@@ -137,8 +258,6 @@ class _EchonestQuery(object):
     Since we use a couple deferred calls, it's simpler to work with an object
     than nesting everything inside a function.
     """
-    # cache album names for 7digital release ids
-    seven_digital_cache = {}
 
     def __init__(self, path, cover_art_dir, code, version, metadata, callback,
                  errback):
@@ -175,9 +294,8 @@ class _EchonestQuery(object):
             'query': self._make_echonest_query(code, version, metadata),
         }
         url = 'http://echonest.pculture.org/api/v4/song/identify?'
-        httpclient.grab_url(url,
-                            self.echonest_callback, self.echonest_errback,
-                            post_vars=post_vars)
+        _grab_url_cached(url, self.echonest_callback, self.echonest_errback,
+                         _echonest_reply_ttl, post_vars=post_vars)
 
     def query_echonest_with_tags(self, metadata):
         url_data = [
@@ -194,8 +312,8 @@ class _EchonestQuery(object):
                 url_data.append((key, metadata[key].encode('utf-8')))
         url = ('http://echonest.pculture.org/api/v4/song/search?' +
                 urllib.urlencode(url_data))
-        httpclient.grab_url(url, self.echonest_callback,
-                            self.echonest_errback)
+        _grab_url_cached(url, self.echonest_callback, self.echonest_errback,
+                         _echonest_reply_ttl)
 
     def query_echonest_with_echonest_id(self, echonest_id):
         url_data = [
@@ -206,8 +324,8 @@ class _EchonestQuery(object):
         ]
         url = ('http://echonest.pculture.org/api/v4/song/profile?' +
                 urllib.urlencode(url_data))
-        httpclient.grab_url(url,
-                            self.echonest_callback, self.echonest_errback)
+        _grab_url_cached(url, self.echonest_callback, self.echonest_errback,
+                         _echonest_reply_ttl)
 
     def _make_echonest_query(self, code, version, metadata):
         echonest_metadata = {'version': version}
@@ -286,14 +404,9 @@ class _EchonestQuery(object):
         self.invoke_errback(error)
 
     def query_7digital(self, release_id):
-        if release_id not in self.seven_digital_cache:
-            self.release_id = release_id
-            seven_digital_url = self._make_7digital_url(release_id)
-            httpclient.grab_url(seven_digital_url,
-                                self.seven_digital_callback,
-                                self.seven_digital_errback)
-        else:
-            self.handle_7digital_cache_hit(release_id)
+        seven_digital_url = self._make_7digital_url(release_id)
+        _grab_url_cached(seven_digital_url, self.seven_digital_callback,
+                         self.seven_digital_errback, _seven_digital_reply_ttl)
 
     def _make_7digital_url(self, release_id):
         # data in all query strings
@@ -305,10 +418,6 @@ class _EchonestQuery(object):
         return ('http://7digital.pculture.org/1.2/release/details?' +
                 urllib.urlencode(url_data))
 
-    def handle_7digital_cache_hit(self, release_id):
-        cached_result = self.seven_digital_cache[release_id]
-        self.handle_7_digital_result(cached_result)
-
     def handle_7_digital_result(self, result):
         self.seven_digital_results.append(result)
         # wait until we get replies for each release_id we queried finish this 
@@ -318,8 +427,6 @@ class _EchonestQuery(object):
 
     def seven_digital_callback(self, data):
         result = self.parse_seven_digital_callback(data['body'])
-        if result is not None:
-            self.seven_digital_cache[result['id']] = result
         self.handle_7_digital_result(result)
 
     def parse_seven_digital_callback(self, seven_digital_reply):
@@ -430,10 +537,9 @@ class _EchonestQuery(object):
             return None
 
     def fetch_cover_art(self):
-        httpclient.grab_url(self.cover_art_url,
-                            self.cover_art_callback,
-                            self.cover_art_errback,
-                            write_file=self.grab_url_dest)
+        _grab_url_cached(self.cover_art_url, self.cover_art_callback,
+                         self.cover_art_errback,
+                         write_file=self.grab_url_dest)
 
     def cover_art_callback(self, data):
         # we don't care about the data sent back, since grab_url wrote our
@@ -48,7 +48,7 @@ from miro.xhtmltools import (unescape, xhtmlify, fix_xml_header,
                              fix_html_header)
 
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.httpclient import grab_url
+from miro.httpclient import grab_url, PRIORITY_FEED, TempFileSink
 from miro import app
 from miro import autodler
 from miro import iconcache
@@ -237,9 +237,60 @@ def run_feedparser(html, callback, errback):
                            lambda msg, result: callback(result),
                            lambda msg, error: errback(error))
 
+def run_feedparser_file(path, charset, callback, errback,
+                        known_fingerprints=None, stop_after=None):
+    """Run feedparser on feed data stored in a file.
+
+    This works like run_feedparser(), but we only send the path to the
+    worker process.  The file gets deleted once the parsing is done.
+
+    If known_fingerprints is given, we only get back new and changed
+    entries.  See feedparserutil.parse() for details.
+    """
+    def callback_wrapper(result):
+        _remove_body_file(path)
+        callback(result)
+    def errback_wrapper(error):
+        _remove_body_file(path)
+        errback(error)
+
+    if _RUN_FEED_PARSER_INLINE:
+        try:
+            rv = feedparserutil.parse_file(path, charset, known_fingerprints,
+                                           stop_after)
+        except StandardError, e:
+            errback_wrapper(e)
+        else:
+            callback_wrapper(rv)
+    else:
+        task = workerprocess.FeedparserTask(path=path, charset=charset,
+                known_fingerprints=known_fingerprints, stop_after=stop_after)
+        workerprocess.send(task,
+                           lambda msg, result: callback_wrapper(result),
+                           lambda msg, error: errback_wrapper(error))
+
+def _remove_body_file(path):
+    try:
+        fileutil.remove(path)
+    except OSError:
+        logging.warn("error removing feed data file: %s", path)
+
 # Wait X seconds before updating the feeds at startup
 INITIAL_FEED_UPDATE_DELAY = 5.0
 
+# For feeds with at least this many entries, we only ask the worker process
+# for new and changed entries...
+INCREMENTAL_MIN_ENTRIES = 100
+# ...and it stops after this many known entries in a row...
+INCREMENTAL_STOP_AFTER = 20
+# ...but every so often we parse the entire feed, so that we can expire
+# items that were removed from it.
+MAX_INCREMENTAL_UPDATES = 10
+
+# Counts how often we skipped work for an RSS feed update because the body
+# ('body') or the parsed entries ('entries') hadn't changed.
+unchanged_feed_counts = {'body': 0, 'entries': 0}
+
 class FeedImpl(DDBObject):
     """Actual implementation of a basic feed.
     """
@@ -315,6 +366,10 @@ class FeedImpl(DDBObject):
                              self.updateFreq,
                              self.title)
 
+    def schedule_startup_update_events(self, firstTriggerDelay):
+        """Schedule the first update after startup."""
+        self.schedule_update_events(firstTriggerDelay)
+
     def cancel_update_events(self):
         if hasattr(self, 'scheduler') and self.scheduler is not None:
             self.scheduler.cancel()
@@ -554,7 +609,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             self.loading = True
             eventloop.add_idle(lambda: self.generate_feed(True), "generate_feed")
         else:
-            self.schedule_update_events(INITIAL_FEED_UPDATE_DELAY)
+            self.schedule_startup_update_events(INITIAL_FEED_UPDATE_DELAY)
 
     def clean_old_items(self):
         if self.actualFeed:
@@ -779,7 +834,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         self.maxNew = max_new
         self.signal_change()
         if self.maxNew >= oldMaxNew or self.maxNew < 0:
-            autodler.AUTO_DOWNLOADER.start_downloads()
+            autodler.AUTO_DOWNLOADER.retry_feed(self)
 
     def set_max_old_items(self, maxOldItems):
         self.confirm_db_thread()
@@ -1069,7 +1124,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         return property(getter)
 
     for name in ( 'set_update_frequency', 'schedule_update_events',
-            'cancel_update_events',
+            'schedule_startup_update_events', 'cancel_update_events',
             'get_url', 'get_base_url',
             'get_base_href', 'get_link',
             'get_thumbnail_url', 'get_license', 'url', 'title', 'created',
@@ -1139,6 +1194,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if isinstance(self.actualFeed, DirectoryWatchFeedImpl):
             move_items_to = None
         self.cancel_update_events()
+        feedupdate.remove_feed(self)
         if self.download is not None:
             self.download.cancel()
             self.download = None
@@ -1200,8 +1256,16 @@ class ThrottledUpdateFeedImpl(FeedImpl):
                     self.update)
         else:
             if self.updateFreq > 0:
-                feedupdate.schedule_update(self.updateFreq, self.ufeed,
-                        self.update)
+                feedupdate.schedule_periodic_update(self.updateFreq,
+                        self.ufeed, self.update)
+
+    def schedule_startup_update_events(self, firstTriggerDelay):
+        feedupdate.cancel_update(self.ufeed)
+        feedupdate.schedule_startup_update(firstTriggerDelay, self.ufeed,
+                self.update)
+
+    def cancel_update_events(self):
+        feedupdate.cancel_update(self.ufeed)
 
 class RSSFeedImplBase(ThrottledUpdateFeedImpl):
     """
@@ -1269,13 +1333,17 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
 
         items_byid = {}
         items_byURLTitle = {}
-        items_nokey = []
+        # Items without an rss_id, keyed by their enclosure signature.  This
+        # way we don't have to compare every entry to every one of them.
+        items_nokey = {}
         for item in self.items:
             rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
+            rss_id = item.get_rss_id()
+            if rss_id is not None:
+                items_byid[rss_id] = item
+            else:
+                signature = FeedParserValues.item_enclosure_signature(item)
+                items_nokey.setdefault(signature, []).append(item)
             by_url_title_key = (item.url, item.entry_title)
             if by_url_title_key != (None, None):
                 items_byURLTitle[by_url_title_key] = item
@@ -1303,9 +1371,11 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                         new = False
                         self.old_items.discard(item)
             if new:
-                for item in items_nokey:
+                signature = fp_values.enclosure_signature()
+                for item in items_nokey.get(signature, ()):
                     if fp_values.compare_to_item(item):
                         new = False
+                        self.old_items.discard(item)
                     else:
                         try:
                             if fp_values.compare_to_item_enclosures(item):
@@ -1398,6 +1468,10 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.initialHTML = initialHTML
         self.etag = etag
         self.modified = modified
+        self.body_digest = None
+        self.entries_digest = None
+        self.entry_fingerprints = set()
+        self.incremental_updates = 0
         self.download = None
 
     @returns_unicode
@@ -1426,9 +1500,10 @@ class RSSFeedImpl(RSSFeedImplBase):
         if not self.ufeed.id_exists():
             return
         logging.warning("Error updating feed: %s: %s", self.url, e)
+        feedupdate.record_error(self.ufeed)
         self.feedparser_finished()
 
-    def feedparser_callback(self, parsed):
+    def feedparser_callback(self, parsed, body_digest=None):
         self.ufeed.confirm_db_thread()
         if not self.ufeed.id_exists():
             return
@@ -1438,8 +1513,34 @@ class RSSFeedImpl(RSSFeedImplBase):
             return
         start = clock()
         self.parsed = parsed
-        self.remember_old_items()
-        self.create_items_for_parsed(parsed)
+        self.body_digest = body_digest
+        incremental = parsed.get('incremental', False)
+        fingerprints = parsed.get('entry_fingerprints', ())
+        if incremental:
+            self.entry_fingerprints.update(fingerprints)
+            self.incremental_updates += 1
+        else:
+            self.entry_fingerprints = set(fingerprints)
+            self.incremental_updates = 0
+        entries_digest = unicodify(parsed.get('entries_digest'))
+        if (entries_digest is not None and
+                entries_digest == self.entries_digest):
+            # The body changed, but nothing that we create items from did.
+            # Skip reconciling the items.
+            logging.debug("RSSFeedImpl: entries unchanged (%s)", self.ufeed)
+            unchanged_feed_counts['entries'] += 1
+        else:
+            if incremental:
+                # We only got the new and changed entries, so we can't tell
+                # which items aren't in the feed anymore.  Don't expire any
+                # until the next full update.
+                self.old_items = set()
+            else:
+                self.remember_old_items()
+            self.create_items_for_parsed(parsed)
+            self.entries_digest = entries_digest
+        feedupdate.record_entries(self.ufeed, parsed.get('release_times', ()),
+                                  parsed.get('skip_hours', ()))
 
         try:
             updateFreq = self.parsed["feed"]["ttl"]
@@ -1458,6 +1559,18 @@ class RSSFeedImpl(RSSFeedImplBase):
         run_feedparser(html, self.feedparser_callback,
                 self.feedparser_errback)
 
+    def call_feedparser_for_file(self, path, charset, body_digest=None):
+        self.ufeed.confirm_db_thread()
+        if (len(self.entry_fingerprints) >= INCREMENTAL_MIN_ENTRIES and
+                self.incremental_updates < MAX_INCREMENTAL_UPDATES):
+            known_fingerprints = self.entry_fingerprints
+        else:
+            known_fingerprints = None
+        run_feedparser_file(path, charset,
+                lambda parsed: self.feedparser_callback(parsed, body_digest),
+                self.feedparser_errback, known_fingerprints,
+                INCREMENTAL_STOP_AFTER)
+
     def update(self):
         """Updates a feed
         """
@@ -1485,30 +1598,37 @@ class RSSFeedImpl(RSSFeedImplBase):
             logging.debug("updating %s", self.url)
             self.download = grab_url(self.url, self._update_callback,
                     self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+                                    default_mime_type=u'application/rss+xml',
+                                    priority=PRIORITY_FEED,
+                                    body_sink=TempFileSink())
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
             return
         logging.warn("WARNING: error in Feed.update for %s -- %s",
             self.ufeed, stringify(error))
+        feedupdate.record_error(self.ufeed)
         self.schedule_update_events(-1)
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
 
     def _update_callback(self, info):
+        # The body was written to a temp file by TempFileSink.  We pass the
+        # path on to the worker process, so that we never have to load the
+        # feed data in this process.
+        body_path = info['body-path']
         if not self.ufeed.id_exists():
+            _remove_body_file(body_path)
             return
+        feedupdate.record_response(self.ufeed, info)
         if info.get('status') == 304:
             logging.debug("RSSFeedImpl: _update_callback: "
                           "status 304 (%s)", self.ufeed)
+            _remove_body_file(body_path)
             self.schedule_update_events(-1)
             self.updating = False
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
 
         # FIXME HTML can be non-unicode here --NN
         self.url = unicodify(info['updated-url'])
@@ -1520,7 +1640,22 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
-        self.call_feedparser(html)
+        body_digest = info.get('body-digest')
+        if (body_digest is not None and body_digest == self.body_digest and
+                hasattr(self, 'parsed')):
+            # Lots of servers ignore our etag and modified headers.  If we
+            # got the same data as last time, there's no need to parse it.
+            logging.debug("RSSFeedImpl: _update_callback: "
+                          "body unchanged (%s)", self.ufeed)
+            unchanged_feed_counts['body'] += 1
+            _remove_body_file(body_path)
+            feedupdate.record_unchanged(self.ufeed)
+            self.schedule_update_events(-1)
+            self.updating = False
+            self.ufeed.signal_change()
+            return
+        self.call_feedparser_for_file(body_path, info.get('charset'),
+                                      body_digest)
 
     @returns_unicode
     def get_license(self):
@@ -1542,10 +1677,16 @@ class RSSFeedImpl(RSSFeedImplBase):
         """
         FeedImpl.setup_restored(self)
         self.download = None
+        self.body_digest = None
+        self.entry_fingerprints = set()
+        self.incremental_updates = 0
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        self.body_digest = None
+        self.entries_digest = None
+        self.entry_fingerprints = set()
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
@@ -1637,7 +1778,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                 lambda x, url=url: self._update_callback(x, url),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
-                default_mime_type=u'application/rss+xml',)
+                default_mime_type=u'application/rss+xml',
+                priority=PRIORITY_FEED)
             self.updating += 1
         self.ufeed.signal_change(needs_save=False)
 
@@ -1782,7 +1924,8 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
                             error)
             self.check_done()
         download = grab_url(url, callback, errback, etag=etag,
-                modified=modified, default_mime_type='text/html')
+                modified=modified, default_mime_type='text/html',
+                priority=PRIORITY_FEED)
         self.downloads.add(download)
 
     def process_downloaded_html(self, info, urlList, depth, link_number,
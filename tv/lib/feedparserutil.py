@@ -33,7 +33,11 @@
 from datetime import datetime
 from time import struct_time
 from types import NoneType
+import calendar
+import hashlib
+import re
 import threading
+import time
 
 from miro.clock import clock
 
@@ -42,6 +46,7 @@ from miro import feedparser
 from miro import filetypes
 from miro import flashscraper
 from miro import util
+from miro import xhtmltools
 
 # values from feedparser dicts that don't have to convert in
 # normalize_feedparser_dict()
@@ -79,17 +84,186 @@ def _convert_if_feedparser_dict(obj):
         return normalize_feedparser_dict(obj)
     return obj
 
-def parse(url_file_stream_or_string):
+def parse(url_file_stream_or_string, known_fingerprints=None,
+          stop_after=None):
     """Parse a feed.
 
     This method runs the feed data through feedparser.parse, then does some
     other things like unicodify it and fix issues with certain feed providers.
+
+    We also add these keys to the result:
+
+    * entry_fingerprints: list of entry_fingerprint() values for the entries
+    * entries_digest: value of entries_digest(), or None if we didn't look
+      at all the entries
+    * release_times: entry_release_times() for all entries in the feed,
+      including the ones that we filtered out below
+    * skip_hours: hours listed in the feed's <skipHours> element
+
+    If known_fingerprints is given, we only return entries whose fingerprint
+    isn't in it, set the 'incremental' key to True and
+    entry_fingerprints only has the fingerprints for the returned entries.
+
+    :param known_fingerprints: fingerprints of the entries from previous
+        updates
+    :param stop_after: If this many entries in a row are known and the
+        feed is ordered by date, assume that the rest of the entries are
+        known too and stop looking at them.
     """
     parsed = feedparser.parse(url_file_stream_or_string)
     parsed = util.unicodify(parsed)
     _yahoo_hack(parsed['entries'])
+    parsed['release_times'] = entry_release_times(parsed['entries'])
+    parsed['skip_hours'] = skip_hours(url_file_stream_or_string)
+    if known_fingerprints is None:
+        fingerprints = [entry_fingerprint(e) for e in parsed['entries']]
+        parsed['entry_fingerprints'] = fingerprints
+        parsed['entries_digest'] = entries_digest(parsed, fingerprints)
+    else:
+        _filter_known_entries(parsed, known_fingerprints, stop_after)
     return parsed
 
+def _filter_known_entries(parsed, known_fingerprints, stop_after):
+    new_entries = []
+    new_fingerprints = []
+    all_fingerprints = []
+    known_run = 0
+    last_date = None
+    date_ordered = True
+    stopped_early = False
+    for entry in parsed['entries']:
+        fingerprint = entry_fingerprint(entry)
+        all_fingerprints.append(fingerprint)
+        if fingerprint in known_fingerprints:
+            known_run += 1
+        else:
+            known_run = 0
+            new_entries.append(entry)
+            new_fingerprints.append(fingerprint)
+        date = entry.get('published_parsed') or entry.get('updated_parsed')
+        if date is None:
+            date_ordered = False
+        else:
+            if last_date is not None and tuple(date) > tuple(last_date):
+                date_ordered = False
+            last_date = date
+        if (stop_after is not None and known_run >= stop_after and
+                date_ordered):
+            stopped_early = True
+            break
+    parsed['entries'] = new_entries
+    parsed['entry_fingerprints'] = new_fingerprints
+    parsed['incremental'] = True
+    if stopped_early:
+        parsed['entries_digest'] = None
+    else:
+        parsed['entries_digest'] = entries_digest(parsed, all_fingerprints)
+
+_skip_hours_re = re.compile(r'<(?:\w+:)?skipHours\b[^>]*>(.*?)'
+                            r'</(?:\w+:)?skipHours\s*>', re.I | re.S)
+_hour_re = re.compile(r'<(?:\w+:)?hour\b[^>]*>\s*(\d+)\s*'
+                      r'</(?:\w+:)?hour\s*>', re.I)
+
+def skip_hours(data):
+    """Get the hours from the <skipHours> element of a feed.
+
+    feedparser doesn't handle <skipHours>: it gives us an empty skiphours
+    value and only the last <hour>, so we have to look at the feed document
+    ourselves.
+
+    :param data: the feed document.  If this isn't a string (e.g. a file
+        object), we can't look at it and return an empty list.
+    :returns: list of ints
+    """
+    if not isinstance(data, str):
+        return []
+    match = _skip_hours_re.search(data)
+    if match is None:
+        return []
+    return [int(hour) for hour in _hour_re.findall(match.group(1))]
+
+def entry_release_times(entries):
+    """Get timestamps for a list of feed entries.
+
+    Entries without a date, or with a date in the future, are skipped.
+    """
+    release_times = []
+    now = time.time()
+    for entry in entries:
+        release_date = (entry.get('published_parsed') or
+                        entry.get('updated_parsed'))
+        if release_date is None:
+            continue
+        try:
+            timestamp = calendar.timegm(tuple(release_date)[:6])
+        except (TypeError, ValueError, OverflowError):
+            continue
+        # ignore entries from the future, they're probably bogus
+        if timestamp <= now:
+            release_times.append(timestamp)
+    return release_times
+
+def entry_fingerprint(entry):
+    """Calculate a short digest of a feed entry.
+
+    Entries with the same fingerprint are the same as far as we're
+    concerned.
+    """
+    digest = hashlib.sha1()
+    _update_digest(digest, entry)
+    return digest.hexdigest()[:16]
+
+def entries_digest(parsed, fingerprints):
+    """Calculate a digest of the parts of a parsed feed that we use to
+    create items.
+
+    This covers the entries and the feed's title and image, but not things
+    like the build date that change whenever the feed is regenerated.
+
+    :param fingerprints: entry_fingerprint() for each entry in the feed
+    :returns: SHA1 hex digest
+    """
+    digest = hashlib.sha1()
+    feed = parsed.get('feed', {})
+    _update_digest(digest, feed.get('title'))
+    _update_digest(digest, feed.get('image'))
+    _update_digest(digest, fingerprints)
+    return digest.hexdigest()
+
+def _update_digest(digest, value):
+    if isinstance(value, dict):
+        digest.update('{')
+        for key in sorted(value.keys()):
+            digest.update(repr(key))
+            _update_digest(digest, value[key])
+        digest.update('}')
+    elif isinstance(value, (list, tuple)):
+        digest.update('[')
+        for item in value:
+            _update_digest(digest, item)
+        digest.update(']')
+    else:
+        digest.update(repr(value))
+
+def parse_file(path, charset=None, known_fingerprints=None,
+               stop_after=None):
+    """Parse a feed stored in a file.
+
+    :param path: path to the feed data
+    :param charset: charset from the HTTP headers.  If given, we use it to fix
+        the XML header before parsing.
+    :param known_fingerprints: passed to parse()
+    :param stop_after: passed to parse()
+    """
+    f = open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if charset is not None:
+        data = xhtmltools.fix_xml_header(data, charset)
+    return parse(data, known_fingerprints, stop_after)
+
 def _yahoo_hack(feedparser_entries):
     """Hack yahoo search to provide enclosures"""
     for entry in feedparser_entries:
@@ -32,18 +32,112 @@
 Our basic strategy is to limit the number of feeds that are
 simultaniously updating at any given time.  Right now the limit is set
 to 3.
+
+We also try to avoid polling feeds more often than they change.  For each
+feed we track:
+
+* how often it publishes new entries, based on the release dates of its
+  entries
+* how many times in a row it's been unchanged (HTTP 304 or no new entries)
+* how many times in a row updating it has failed
+* the max-age from its Cache-Control header and its skipHours
+
+and use that to stretch the regular update interval.  We never stretch the
+interval past the point where a feed is due to publish its next entry, so
+that new entries aren't found later than they would be otherwise.
 """
 
 import collections
+import logging
+import random
+import re
+import time
 
 from miro import eventloop
 
 MAX_UPDATES = 3
 
+# Never stretch the update interval past this (in seconds)
+MAX_ADAPTIVE_DELAY = 24 * 60 * 60
+# Multiply the update interval by this for each update that didn't find
+# anything new.
+UNCHANGED_BACKOFF = 1.5
+# Multiply the update interval by this for each failed update.
+ERROR_BACKOFF = 2
+# Stop backing off after this many unchanged/failed updates
+MAX_BACKOFF_STEPS = 4
+# Number of recent release dates to use to calculate a feed's cadence
+CADENCE_SAMPLES = 10
+# Poll a feed that publishes every N seconds about every
+# N * CADENCE_FRACTION seconds...
+CADENCE_FRACTION = 0.25
+# ...until it's been N * DUE_FRACTION seconds since its last entry.  After
+# that we use the regular update interval.
+DUE_FRACTION = 0.75
+# Add up to this fraction of the delay as random jitter, so that feeds that
+# were scheduled together don't stay together.
+JITTER_FRACTION = 0.1
+# Spread the updates at startup over this many seconds
+STARTUP_SPREAD = 120
+
+_max_age_re = re.compile(r'max-age\s*=\s*"?(\d+)')
+
+class FeedPollState(object):
+    """What we've learned about how often a feed changes.
+
+    :attribute cadence: median number of seconds between entries, or None
+    :attribute last_release: timestamp of the newest entry, or None
+    :attribute unchanged_count: updates in a row that found nothing new
+    :attribute error_count: updates in a row that failed
+    :attribute max_age: max-age from the Cache-Control header, or None
+    :attribute skip_hours: set of hours (GMT) that we shouldn't poll in
+    """
+    def __init__(self):
+        self.cadence = None
+        self.last_release = None
+        self.unchanged_count = 0
+        self.error_count = 0
+        self.max_age = None
+        self.skip_hours = frozenset()
+
+    def record_release_times(self, release_times):
+        release_times = sorted(set(release_times))[-CADENCE_SAMPLES:]
+        if not release_times:
+            return
+        newest = release_times[-1]
+        if self.last_release is not None and newest <= self.last_release:
+            self.unchanged_count += 1
+        else:
+            self.unchanged_count = 0
+        self.last_release = newest
+        if len(release_times) >= 3:
+            intervals = sorted(b - a for a, b in zip(release_times,
+                                                     release_times[1:]))
+            self.cadence = intervals[len(intervals) // 2]
+        else:
+            self.cadence = None
+
+def parse_max_age(cache_control):
+    """Get the max-age value from a Cache-Control header.
+
+    :returns: max-age in seconds, or None if there isn't one
+    """
+    if not cache_control:
+        return None
+    cache_control = cache_control.lower()
+    if 'no-cache' in cache_control or 'no-store' in cache_control:
+        return None
+    match = _max_age_re.search(cache_control)
+    if match is None:
+        return None
+    return int(match.group(1))
+
 class FeedUpdateQueue(object):
     def __init__(self):
         self.update_queue = collections.deque()
         self.timeouts = {}
+        self.next_update_times = {}
+        self.poll_states = {}
         self.callback_handles = {}
         self.currently_updating = set()
 
@@ -51,8 +145,20 @@ class FeedUpdateQueue(object):
         name = "Feed update (%s)" % feed.get_title()
         self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
                 name, args=(feed, update_callback))
+        self.next_update_times[feed.id] = time.time() + delay
+
+    def schedule_periodic_update(self, update_freq, feed, update_callback):
+        delay = self.calc_delay(feed, update_freq)
+        logging.debug("scheduling update in %s seconds (%s)", delay,
+                      feed.get_title())
+        self.schedule_update(delay, feed, update_callback)
+
+    def schedule_startup_update(self, delay, feed, update_callback):
+        delay += random.uniform(0, STARTUP_SPREAD)
+        self.schedule_update(delay, feed, update_callback)
 
     def cancel_update(self, feed):
+        self.next_update_times.pop(feed.id, None)
         try:
             timeout = self.timeouts.pop(feed.id)
         except KeyError:
@@ -60,8 +166,88 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def remove_feed(self, feed):
+        self.cancel_update(feed)
+        self.poll_states.pop(feed.id, None)
+
+    def next_update_time(self, feed):
+        """Get the time that feed will next be updated.
+
+        :returns: timestamp, or None if no update is scheduled
+        """
+        return self.next_update_times.get(feed.id)
+
+    def _get_poll_state(self, feed):
+        try:
+            return self.poll_states[feed.id]
+        except KeyError:
+            state = self.poll_states[feed.id] = FeedPollState()
+            return state
+
+    def record_response(self, feed, info):
+        """Record the HTTP response for a feed update."""
+        state = self._get_poll_state(feed)
+        state.error_count = 0
+        state.max_age = parse_max_age(info.get('cache-control'))
+        if info.get('status') == 304:
+            state.unchanged_count += 1
+
+    def record_unchanged(self, feed):
+        """Record that a feed update got the same data as last time."""
+        self._get_poll_state(feed).unchanged_count += 1
+
+    def record_error(self, feed):
+        """Record that updating a feed failed."""
+        self._get_poll_state(feed).error_count += 1
+
+    def record_entries(self, feed, release_times, skip_hours=()):
+        """Record the entries we got after parsing a feed.
+
+        :param release_times: timestamps for the entries in the feed
+        :param skip_hours: hours (GMT) that the feed asks not to be polled in
+        """
+        state = self._get_poll_state(feed)
+        state.record_release_times(release_times)
+        state.skip_hours = frozenset(h for h in skip_hours if 0 <= h < 24)
+
+    def calc_delay(self, feed, update_freq, now=None):
+        """Calculate how long to wait before updating feed again.
+
+        :param update_freq: regular update interval for the feed
+        """
+        if now is None:
+            now = time.time()
+        state = self.poll_states.get(feed.id)
+        if state is None:
+            return update_freq
+        if state.error_count > 0:
+            steps = min(state.error_count, MAX_BACKOFF_STEPS)
+            delay = update_freq * (ERROR_BACKOFF ** steps)
+        else:
+            steps = min(state.unchanged_count, MAX_BACKOFF_STEPS)
+            delay = update_freq * (UNCHANGED_BACKOFF ** steps)
+            if state.cadence:
+                delay = max(delay, state.cadence * CADENCE_FRACTION)
+                due = state.last_release + state.cadence * DUE_FRACTION
+                delay = min(delay, due - now)
+        if state.max_age is not None:
+            delay = max(delay, state.max_age)
+        delay = max(update_freq, min(delay, MAX_ADAPTIVE_DELAY))
+        delay += random.uniform(0, delay * JITTER_FRACTION)
+        return self._skip_hours_delay(state, now, delay)
+
+    def _skip_hours_delay(self, state, now, delay):
+        if not state.skip_hours or len(state.skip_hours) >= 24:
+            return delay
+        update_time = now + delay
+        while time.gmtime(update_time).tm_hour in state.skip_hours:
+            # move to the start of the next hour
+            update_time = (int(update_time) // 3600 + 1) * 3600
+        return update_time - now
+
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
+        self.next_update_times.pop(feed.id, None)
         self.update_queue.append((feed, update_callback))
         self.run_update_queue()
 
@@ -92,8 +278,44 @@ def cancel_update(feed):
     """Cancel any pending updates for feed."""
     global_update_queue.cancel_update(feed)
 
+def remove_feed(feed):
+    """Cancel pending updates for feed and forget what we know about it."""
+    global_update_queue.remove_feed(feed)
+
 def schedule_update(delay, feed, update_callback):
     """Schedules a feed to be updated sometime around delay seconds in
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def schedule_periodic_update(update_freq, feed, update_callback):
+    """Schedules the next regular update for a feed.
+
+    update_freq is the regular update interval.  The actual delay may be
+    longer depending on how often the feed changes.
+    """
+    global_update_queue.schedule_periodic_update(update_freq, feed,
+                                                 update_callback)
+
+def schedule_startup_update(delay, feed, update_callback):
+    """Schedules the first update for a feed after startup.
+
+    The updates are spread out so that all feeds don't update at once.
+    """
+    global_update_queue.schedule_startup_update(delay, feed, update_callback)
+
+def next_update_time(feed):
+    """Get the time that feed will next be updated, or None."""
+    return global_update_queue.next_update_time(feed)
+
+def record_response(feed, info):
+    global_update_queue.record_response(feed, info)
+
+def record_unchanged(feed):
+    global_update_queue.record_unchanged(feed)
+
+def record_error(feed):
+    global_update_queue.record_error(feed)
+
+def record_entries(feed, release_times, skip_hours=()):
+    global_update_queue.record_entries(feed, release_times, skip_hours)
@@ -231,7 +231,7 @@ def _make_cover_art_file(album_name, objects, cover_art_directory):
         cover_image = images[0]
 
     try:
-        cover_image.write_to_file(path)
+        coverart.save_image(cover_image, cover_art_directory, path)
     except EnvironmentError:
         logging.warn("Couldn't write cover art file: {0}".format(path))
         return None
@@ -98,6 +98,49 @@ def open_file(path, *args, **kwargs):
     path = expand_filename(path)
     return file(path, *args, **kwargs)
 
+_fallocate = None
+
+def _get_fallocate():
+    """Get libc's fallocate() function, or False if it's not available."""
+    global _fallocate
+    if _fallocate is None:
+        _fallocate = False
+        try:
+            import ctypes
+            import ctypes.util
+            libc_name = ctypes.util.find_library('c')
+            if libc_name is None:
+                # no libc, for example on Windows
+                return _fallocate
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            func = libc.fallocate64
+        except (ImportError, OSError, AttributeError, TypeError):
+            pass
+        else:
+            func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                    ctypes.c_int64]
+            func.restype = ctypes.c_int
+            _fallocate = func
+    return _fallocate
+
+# don't change the file size, just reserve the blocks
+FALLOC_FL_KEEP_SIZE = 1
+
+def preallocate(fileobj, size):
+    """Reserve disk space for a file that we're about to write.
+
+    This avoids fragmenting files that are written a chunk at a time.  The
+    size of the file isn't changed, so code that looks at the file size to
+    see how much has been written still works.  Only supported on systems
+    with fallocate(2), elsewhere this does nothing.
+
+    :returns: True if the space was reserved
+    """
+    fallocate = _get_fallocate()
+    if not fallocate:
+        return False
+    return fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) == 0
+
 def access(path, *args, **kwargs):
     path = expand_filename(path)
     return os.access(path, *args, **kwargs)
@@ -241,11 +284,12 @@ def delete(path, retry_after=10, retry_for=60, firsttime=True):
                     "Delete File Retry", args=(path, retry_after,
                         retry_for - retry_after, False))
             if firsttime:
-                from miro.workerprocess import _subprocess_manager
-                if _subprocess_manager.is_running:
-                    logging.debug('restarting subprocess_manager to hopefully '
-                                  'free file references')
-                    _subprocess_manager.restart(clean=True)
+                from miro.workerprocess import _all_managers
+                for manager in _all_managers():
+                    if manager.is_running:
+                        logging.debug('restarting subprocess_manager to '
+                                      'hopefully free file references')
+                        manager.restart(clean=True)
 
     else:
         deletes_in_progress.discard(path)
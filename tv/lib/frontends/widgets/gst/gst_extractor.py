@@ -65,10 +65,16 @@ def scaled_size(from_size, to_size):
 
 
 class Extractor:
-    def __init__(self, filename, thumbnail_filename):
+    def __init__(self, filename, thumbnail_filename, known_duration=None):
         logging.info("running gstreamer Extractor on %s", filename)
         self.thumbnail_filename = thumbnail_filename
         self.filename = filename
+        # duration in nanoseconds that we got from the container headers
+        # (mutagen).  If we have it, we don't need to query the pipeline.
+        if known_duration is not None:
+            self.known_duration = known_duration * gst.MSECOND
+        else:
+            self.known_duration = None
 
         self.timeout = None
         self.grabit = False
@@ -125,10 +131,13 @@ class Extractor:
                                 self.buffer_probe_handler, name)
                             break
 
+                    # Seek to the keyframe nearest to our target rather than
+                    # the exact position.  That way we don't have to decode
+                    # all the frames between the keyframe and the target.
                     seek_amount = min(self.duration / 2, 20 * gst.SECOND)
                     seek_result = self.thumbnail_pipeline.seek(
                         1.0, gst.FORMAT_TIME,
-                        gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_ACCURATE,
+                        gst.SEEK_FLAG_FLUSH | gst.SEEK_FLAG_KEY_UNIT,
                         gst.SEEK_TYPE_SET, seek_amount,
                         gst.SEEK_TYPE_NONE, 0)
                     logging.info("seek finished.  Result: %s", seek_result)
@@ -173,6 +182,8 @@ class Extractor:
         return (media_type, duration, success)
 
     def get_duration(self, pipeline, attempts=0):
+        if self.known_duration is not None:
+            return self.known_duration
         if attempts == 5:
             return 0
         try:
@@ -319,8 +330,12 @@ def make_verbose():
         if callable(fun):
             Extractor.__dict__[mem] = wrap_func(fun)
 
-def run(movie_file, thumbnail_file):
-    extractor = Extractor(movie_file, thumbnail_file)
+def run(movie_file, thumbnail_file, duration=None):
+    """Get the media type, duration and a thumbnail for a file.
+
+    :param duration: duration in milliseconds, if we already know it
+    """
+    extractor = Extractor(movie_file, thumbnail_file, duration)
     extractor.run()
     return extractor.get_result()
 
@@ -1093,6 +1093,22 @@ class ItemListController(object):
         # selected items changed
         self._selection_changed()
         self.update_item_details()
+        if app.item_list_controller_manager.displayed is self:
+            app.item_list_controller_manager.update_visible_downloads()
+
+    def calc_visible_downloads(self):
+        """Calculate which downloads are visible in this list.
+
+        :returns: (all_visible, downloader_ids) tuple.  all_visible is True
+            if every download is visible.  downloader_ids is a set of ids for
+            the other ones.
+        """
+        downloader_ids = set()
+        for info in self.item_list.get_loaded_items():
+            if ((info.downloader_id is not None and
+                 (info.is_download or info.is_seeding))):
+                downloader_ids.add(info.downloader_id)
+        return False, downloader_ids
 
     def check_for_empty_list(self):
         self.widget.set_list_empty_mode(self.calc_list_empty_mode())
@@ -1313,6 +1329,7 @@ class ItemListControllerManager(object):
         self.displayed = None
         self.primary = None
         self.controllers = {}
+        self.visible_downloads = (False, set())
 
     def focus_view(self):
         """Focus the currently displayed item list.
@@ -1369,6 +1386,7 @@ class ItemListControllerManager(object):
                 self.primary.no_longer_primary()
             self.primary = item_list_controller
             self.primary.on_become_primary()
+        self.update_visible_downloads()
 
     def controller_no_longer_displayed(self, item_list_controller):
         if item_list_controller is not self.displayed:
@@ -1377,6 +1395,19 @@ class ItemListControllerManager(object):
         else:
             self.displayed.no_longer_displayed()
         self.displayed = None
+        self.update_visible_downloads()
+
+    def update_visible_downloads(self):
+        """Tell the backend which downloads the user can see, if they've
+        changed.
+        """
+        if self.displayed is None:
+            visible_downloads = (False, set())
+        else:
+            visible_downloads = self.displayed.calc_visible_downloads()
+        if visible_downloads != self.visible_downloads:
+            self.visible_downloads = visible_downloads
+            messages.SetVisibleDownloads(*visible_downloads).send_to_backend()
 
     @staticmethod
     def _key_for_controller(controller):
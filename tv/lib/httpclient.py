@@ -35,11 +35,16 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import hashlib
+import heapq
+import itertools
 import logging
 import os
 import stat
+import tempfile
 import threading
 import urllib
+import zlib
 import Queue
 from cStringIO import StringIO
 
@@ -67,6 +72,36 @@ except:
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# Max number of idle libcurl easy handles that LibCURLManager keeps around for
+# reuse
+MAX_FREE_HANDLES = 20
+# When downloading to a file, we write in chunks of this size (aligned to
+# multiples of it in the file), rather than for each chunk libcurl gives us
+WRITE_BUFFER_SIZE = 256 * 1024
+# Max number of chunks waiting for the file writer thread.  If the disk can't
+# keep up, the libcurl thread blocks once it hits this.
+MAX_QUEUED_WRITES = 64
+
+# Transfer priority classes.  Lower values get started first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_FEED = 1
+PRIORITY_ICON = 2
+PRIORITY_DOWNLOAD = 3
+# Extra connections for a segmented download (see dl_daemon/download.py)
+PRIORITY_SEGMENT = 4
+
+# Max number of simultaneous connections to a single host for each priority
+# class.  None means unlimited.  Each class is counted separately, so feed
+# updates never have to wait for big downloads from the same host to finish.
+# Downloads aren't limited, since the downloader already limits how many
+# run at once and a queued download would look like it was stalled.
+HOST_CONNECTION_LIMITS = {
+    PRIORITY_INTERACTIVE: None,
+    PRIORITY_FEED: 4,
+    PRIORITY_ICON: 2,
+    PRIORITY_DOWNLOAD: None,
+    PRIORITY_SEGMENT: 3,
+}
 
 _logged_noproxy_error = False
 
@@ -196,6 +231,235 @@ class WriteError(NetworkError):
             {"filename": util.stringify(path)})
         NetworkError.__init__(self, _('Write error'), msg)
 
+class BodySink(object):
+    """Receives the body of a grab_url() transfer as it's downloaded.
+
+    Pass a BodySink to grab_url() to avoid buffering the whole response in
+    memory.  write(), finish() and reset() get called in the libcurl thread
+    (or the eventloop thread for file: URLs), so subclasses need to be
+    careful about threading issues.
+    """
+
+    def write(self, data):
+        """Handle a chunk of the body."""
+        raise NotImplementedError()
+
+    def reset(self):
+        """Throw away any data written so far.
+
+        This is called when we need to re-send a request, for example after
+        asking the user for a password.
+        """
+        raise NotImplementedError()
+
+    def finish(self, info):
+        """Called when the transfer succeeded.
+
+        :param info: dict that will be passed to the grab_url() callback.
+            Subclasses can add keys to it.
+        """
+        pass
+
+    def discard(self):
+        """Called when the transfer failed or was canceled."""
+        pass
+
+class TempFileSink(BodySink):
+    """BodySink that writes the body to a temporary file.
+
+    Once the transfer finishes, the path to the file is stored in the
+    'body-path' key of the info dict.  The callback is responsible for
+    removing the file.  A SHA1 hex digest of the body is stored in the
+    'body-digest' key.
+    """
+
+    def __init__(self):
+        self.path = None
+        self._file = None
+        self._digest = None
+
+    def _open(self):
+        fd, self.path = tempfile.mkstemp(prefix='miro-body-')
+        self._file = os.fdopen(fd, 'wb')
+        self._digest = hashlib.sha1()
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        self._file.write(data)
+        self._digest.update(data)
+
+    def reset(self):
+        self.discard()
+
+    def finish(self, info):
+        if self._file is None:
+            self._open()
+        self._file.close()
+        self._file = None
+        info['body-path'] = self.path
+        info['body-digest'] = self._digest.hexdigest()
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+class RangeFileSink(BodySink):
+    """BodySink that writes the body into an existing file at an offset.
+
+    This is used to download byte ranges of a file over separate
+    connections.  bytes_written tracks how much data we've stored.
+    """
+
+    def __init__(self, path, offset):
+        self.path = path
+        self.offset = offset
+        self.bytes_written = 0
+        self._file = None
+
+    def write(self, data):
+        if self._file is None:
+            self._file = fileutil.open_file(self.path, 'r+b')
+            self._file.seek(self.offset + self.bytes_written)
+        self._file.write(data)
+        self.bytes_written += len(data)
+
+    def reset(self):
+        self.discard()
+        self.bytes_written = 0
+
+    def finish(self, info):
+        self.discard()
+
+    def discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class FileWriterThread(object):
+    """Thread that writes downloaded data to disk.
+
+    CurlTransfers that have a write_file use a BufferedFileWriter, which
+    sends its data here.  This way a slow disk (or network share) doesn't
+    stall every other transfer in the libcurl thread.  Jobs are run in the
+    order they were added, so the writes for a file always happen in order.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue(MAX_QUEUED_WRITES)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=utils.thread_body,
+                                       args=[self.loop],
+                                       name="HTTP File Writer")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def add_job(self, func, *args):
+        self.queue.put((func, args))
+
+    def loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            func, args = job
+            trap_call('file writer job', func, *args)
+
+class BufferedFileWriter(object):
+    """Writes data for a CurlTransfer with as few syscalls as possible.
+
+    libcurl hands us data in small (usually 16k) chunks.  We collect them and
+    send WRITE_BUFFER_SIZE aligned blocks to a FileWriterThread.
+
+    Errors from the writer thread get stored in the error attribute.
+    """
+
+    def __init__(self, fileobj, writer_thread, offset=0):
+        """Create a BufferedFileWriter.
+
+        :param fileobj: file object to write to
+        :param writer_thread: FileWriterThread to do the writing in
+        :param offset: position in the file that we start writing at
+        """
+        self.fileobj = fileobj
+        self.writer_thread = writer_thread
+        self.offset = offset
+        self.chunks = []
+        self.buffered = 0
+        self.error = None
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered < WRITE_BUFFER_SIZE:
+            return
+        end = self.offset + self.buffered
+        aligned_end = end - (end % WRITE_BUFFER_SIZE)
+        if aligned_end > self.offset:
+            data = ''.join(self.chunks)
+            split = aligned_end - self.offset
+            self.writer_thread.add_job(self._write, data[:split])
+            rest = data[split:]
+            if rest:
+                self.chunks = [rest]
+            else:
+                self.chunks = []
+            self.buffered = len(rest)
+            self.offset = aligned_end
+
+    def flush(self):
+        if self.chunks:
+            self.writer_thread.add_job(self._write, ''.join(self.chunks))
+            self.offset += self.buffered
+            self.chunks = []
+            self.buffered = 0
+
+    def preallocate(self, size):
+        """Reserve disk space for the file.
+
+        :param size: total size that the file will have
+        """
+        self.writer_thread.add_job(fileutil.preallocate, self.fileobj, size)
+
+    def close(self, callback=None):
+        """Write out any buffered data, then close the file.
+
+        :param callback: function to call in the writer thread after the
+            file is closed.  It's passed the error that happened while
+            writing, or None.
+        """
+        self.flush()
+        self.writer_thread.add_job(self._close, callback)
+
+    def _write(self, data):
+        if self.error is None:
+            try:
+                self.fileobj.write(data)
+            except EnvironmentError, e:
+                self.error = e
+
+    def _close(self, callback):
+        try:
+            self.fileobj.close()
+        except EnvironmentError, e:
+            if self.error is None:
+                self.error = e
+        if callback is not None:
+            callback(self.error)
+
 class TransferOptions(object):
     """Holds data about an upcoming transfer.
 
@@ -209,8 +473,11 @@ class TransferOptions(object):
 
     def __init__(self, url, etag=None, modified=None, resume=False,
             post_vars=None, post_files=None, write_file=None,
-                 extra_headers=None):
+                 extra_headers=None, priority=PRIORITY_INTERACTIVE,
+                 byte_range=None):
         self.url = url
+        self.priority = priority
+        self.byte_range = byte_range
         self.etag = etag
         self.modified = modified
         self.extra_headers = extra_headers
@@ -244,9 +511,12 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
-        """Build a libCURL handle.  This should only be called inside the
-        LibCURLManager thread.
+    def build_handle(self, handle, out_headers):
+        """Setup a libCURL handle for this transfer.  This should only be
+        called inside the LibCURLManager thread.
+
+        :param handle: a fresh (or freshly reset) pycurl.Curl object
+        :param out_headers: dict to fill in with the headers we send
         """
         if self.etag is not None:
             out_headers['etag'] = self.etag
@@ -255,13 +525,12 @@ class TransferOptions(object):
         if self.extra_headers is not None:
             out_headers.update(self.extra_headers)
 
-        handle = self._init_handle()
+        self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle):
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -280,8 +549,9 @@ class TransferOptions(object):
         handle.setopt(pycurl.URL, self.url)
         if self.head_request:
             handle.setopt(pycurl.NOBODY, 1)
+        if self.byte_range is not None:
+            handle.setopt(pycurl.RANGE, '%d-%d' % self.byte_range)
         self._setup_proxy(handle)
-        return handle
 
     def _setup_proxy(self, handle):
         if not app.config.get(prefs.HTTP_PROXY_ACTIVE):
@@ -336,15 +606,18 @@ class CurlTransfer(object):
     """
 
     def __init__(self, options, callback, errback, header_callback=None,
-            content_check_callback=None):
+            content_check_callback=None, body_sink=None):
         """Create a CurlTransfer object.
 
         :param options: TransferOptions object.  The object shouldn't be
             modified after passing it in.
         :param callback: function to call when the transfer succeeds
         :param errback: function to call when the transfer fails
+        :param body_sink: BodySink to send the response body to
         """
         self.options = options
+        self.body_sink = body_sink
+        self._writer = None
         self._reset_transfer_data()
         self.callback = callback
         self.header_callback = header_callback
@@ -365,12 +638,23 @@ class CurlTransfer(object):
         self.buffer = StringIO()
         self.saw_temporary_redirect = False
         self.headers_finished = False
-        self._filehandle = None
+        if self._writer is not None:
+            # we're starting a new request before the old one finished
+            # (HEAD requests, HTTP auth).  Don't leak the file.
+            self._writer.close()
+        self._writer = None
+        self._write_status_code = None
+        self._write_ok = False
+        self._write_failed = False
         self.resume_from = 0
         self.out_headers = {}
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self._decompressor = None
+        self._range_ignored = False
+        if self.body_sink is not None:
+            self.body_sink.reset()
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -464,7 +748,8 @@ class CurlTransfer(object):
         """Build a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = self.options.build_handle(curl_manager.get_handle(),
+                self.out_headers)
         # don't authenticate SSL certificates see #15180
         self.handle.setopt(pycurl.SSL_VERIFYPEER, 0)
 
@@ -485,6 +770,8 @@ class CurlTransfer(object):
                 self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.content_check_callback is not None:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
+        elif self.body_sink is not None:
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_sink)
         else:
             self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
@@ -493,9 +780,74 @@ class CurlTransfer(object):
             self.handle.setopt(pycurl.VERBOSE, 1)
             self.handle.setopt(pycurl.DEBUGFUNCTION, self.debug_func)
 
+    def set_rate_limits(self, download_limit, upload_limit):
+        """Limit the bandwidth for this transfer.  This should only be called
+        inside the LibCURLManager thread.
+
+        :param download_limit: max bytes/second to download (0 = unlimited)
+        :param upload_limit: max bytes/second to upload (0 = unlimited)
+        """
+        self.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE, download_limit)
+        self.handle.setopt(pycurl.MAX_SEND_SPEED_LARGE, upload_limit)
+
     def _write_file(self, buf):
-        if self.check_response_code(self.status_code):
-            self._filehandle.write(buf)
+        if self._write_failed or self._writer is None:
+            # returning a value other than len(buf) aborts the transfer
+            return 0
+        if self.status_code != self._write_status_code:
+            # The status code only changes between responses (redirects,
+            # auth), so there's no need to check it for every chunk.
+            self._write_status_code = self.status_code
+            self._write_ok = self.check_response_code(self.status_code)
+            if self._write_ok:
+                self._preallocate_file()
+        if not self._write_ok:
+            return
+        if self._writer.error is not None:
+            self._write_failed = True
+            logging.warn("Error writing to %s: %s",
+                    self.options.write_file, self._writer.error)
+            self.call_errback(WriteError(self.options.write_file))
+            return 0
+        self._writer.write(buf)
+
+    def _preallocate_file(self):
+        try:
+            length = int(self.headers['content-length'])
+        except (KeyError, ValueError):
+            return
+        if length > 0:
+            self._writer.preallocate(self.resume_from + length)
+
+    def _write_sink(self, data):
+        if self.options.byte_range is not None and self.status_code != 206:
+            # Don't write error pages to the sink.  If the server ignored our
+            # Range header, bail out now, before we write the entire file.
+            if self.status_code == 200:
+                if not self._range_ignored:
+                    self._range_ignored = True
+                    self.call_errback(ResumeFailed(self.options.host))
+                # returning a value other than len(data) aborts the transfer
+                return 0
+            return
+        if (self._decompressor is None and gzip and
+                self.headers.get('content-encoding', '') == 'gzip'):
+            # 16 + MAX_WBITS tells zlib to expect a gzip header
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if self._decompressor:
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error:
+                logging.warning("Received header with content-encoding "
+                                "gzip, but content is not gzip encoded")
+                self._decompressor = False
+        try:
+            self.body_sink.write(data)
+        except EnvironmentError, e:
+            logging.warn("Error writing to body sink (%s): %s",
+                    self.options.url, e)
+            # returning a value other than len(data) aborts the transfer
+            return 0
 
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
@@ -555,9 +907,11 @@ class CurlTransfer(object):
         else:
             mode = 'wb'
         try:
-            self._filehandle = fileutil.open_file(self.options.write_file, mode)
+            filehandle = fileutil.open_file(self.options.write_file, mode)
         except IOError:
             raise WriteError(self.options.write_file)
+        self._writer = BufferedFileWriter(filehandle, curl_manager.file_writer,
+                self.resume_from)
 
     def should_debug_request(self):
         # return True here to debug HTTP requests in the log file
@@ -645,7 +999,7 @@ class CurlTransfer(object):
 
     def check_response_code(self, code):
         expected_codes = set([200])
-        if self.options.resume:
+        if self.options.resume or self.options.byte_range is not None:
             expected_codes.add(206)
         if self.options.etag or self.options.modified:
             expected_codes.add(304)
@@ -675,7 +1029,7 @@ class CurlTransfer(object):
     def on_finished(self):
         info = self._make_callback_info()
         self.last_url = self.handle.getinfo(pycurl.EFFECTIVE_URL)
-        if self.options.write_file is None:
+        if self.options.write_file is None and self.body_sink is None:
             if gzip and info.get('content-encoding', '') == 'gzip':
                 try:
                     self.buffer.seek(0)
@@ -727,12 +1081,22 @@ class CurlTransfer(object):
             self.call_errback(UnexpectedStatusCode(info['status']))
 
     def on_cancel(self, remove_file):
-        self._cleanup_filehandle()
-        if remove_file and self.options.write_file:
+        if self._writer is not None:
+            # Don't wait for the writer thread, it may be stuck on a slow
+            # disk.  curl_manager holds off transfers for the same file until
+            # it's closed (and removed if remove_file is set).
+            path = self.options.write_file
+            curl_manager.file_closing(path)
+            self._writer.close(lambda error:
+                    curl_manager.file_closed(path, remove_file))
+            self._writer = None
+        elif remove_file and self.options.write_file:
             try:
                 fileutil.remove(self.options.write_file)
             except OSError:
                 pass
+        if self.body_sink is not None:
+            self.body_sink.discard()
 
     def find_value_from_header(self, header, target):
         """Finds a value from a response header that uses key=value pairs with
@@ -773,6 +1137,10 @@ class CurlTransfer(object):
                 clean=True)
 
     def on_error(self, code, handle):
+        if self._range_ignored or self._write_failed:
+            # _write_sink() or _write_file() aborted the transfer and already
+            # sent the errback
+            return
         if code in (pycurl.E_URL_MALFORMAT, pycurl.E_UNSUPPORTED_PROTOCOL):
             error = MalformedURL(self.options.url)
         elif code == pycurl.E_COULDNT_CONNECT:
@@ -806,19 +1174,47 @@ class CurlTransfer(object):
         self.call_errback(error)
 
     def call_callback(self, info):
-        self._cleanup_filehandle()
+        if self.body_sink is not None:
+            if self._decompressor:
+                self.body_sink.write(self._decompressor.flush())
+            self.body_sink.finish(info)
+        self._cleanup_filehandle(lambda write_error:
+                self._send_callback(info, write_error))
+
+    def call_errback(self, error):
+        if self.body_sink is not None:
+            self.body_sink.discard()
+        self._cleanup_filehandle(lambda write_error:
+                self._send_errback(error))
+
+    def _send_callback(self, info, write_error):
+        if write_error is not None:
+            logging.warn("Error writing to %s: %s", self.options.write_file,
+                    write_error)
+            self._send_errback(WriteError(self.options.write_file))
+            return
         msg = 'curl transfer callback: %s' % (self.callback,)
         eventloop.add_idle(self.callback, msg, args=(info,))
 
-    def call_errback(self, error):
-        self._cleanup_filehandle()
+    def _send_errback(self, error):
         msg = 'curl transfer errback: %s' % (self.errback,)
         eventloop.add_idle(self.errback, msg, args=(error,))
 
-    def _cleanup_filehandle(self):
-        if self._filehandle is not None:
-            self._filehandle.close()
-            self._filehandle = None
+    def _cleanup_filehandle(self, on_closed):
+        """Close the file we're writing to.
+
+        :param on_closed: function to call once the file is closed.  It gets
+            passed the error that happened while writing the file, or None.
+            If we were writing a file, it gets called in the file writer
+            thread after all of our data is on disk, otherwise it gets called
+            immediately.
+        """
+        writer = self._writer
+        self._writer = None
+        if writer is not None:
+            writer.close(on_closed)
+        else:
+            on_closed(None)
 
     def build_stats(self):
         stats = TransferStats()
@@ -880,42 +1276,146 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Keeps a pool of libcurl easy handles to reuse between transfers
+      - Manages a libcurl share object so that DNS lookups and SSL sessions are
+        shared between all of our handles
+      - Schedules transfers: they are started in priority order, subject to
+        per-host connection limits (see HOST_CONNECTION_LIMITS) and the
+        global bandwidth limits are split evenly between the running
+        transfers.
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.share = self._make_share()
+        self.free_handles = []
+        self.handles_created = 0
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
+        # paths that the file writer thread has closed, see file_closed()
+        self.closed_files = Queue.Queue()
+        # maps paths to the number of canceled transfers that are still
+        # closing them
+        self.closing_files = {}
         self.after_perform_callbacks = []
+        # heap of (priority, counter, transfer) tuples for transfers that are
+        # waiting to be started
+        self.pending = []
+        self.pending_counter = itertools.count()
+        # maps (host, priority) to the number of running transfers
+        self.host_counts = {}
+        self.download_limit = self.upload_limit = 0
+        self.needs_rebalance = False
+        self.limits_applied = False
+        self.file_writer = FileWriterThread()
+
+    def _make_share(self):
+        share = pycurl.CurlShare()
+        for name in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION'):
+            try:
+                share.setopt(pycurl.SH_SHARE, getattr(pycurl, name))
+            except (AttributeError, pycurl.error):
+                logging.warn("libcurl: can't share %s", name)
+        return share
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
                                        args=[self.loop],
                                        name="LibCURL Event Loop")
+        self.file_writer.start()
         self.thread.start()
 
     def stop(self):
         self.quit_flag = True
         self.wakeup()
         self.thread.join()
+        self.file_writer.stop()
 
     def loop(self):
         eventloop.SimpleEventLoop.loop(self)
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+            # make sure any buffered data gets written out
+            transfer.on_cancel(remove_file=False)
+        for handle in self.free_handles:
+            handle.close()
+        self.free_handles = []
         self.multi.close()
+        self.share.close()
+
+    def get_handle(self):
+        """Get a libcurl easy handle to use for a transfer.
+
+        We try to reuse handles from previous transfers, which lets libcurl
+        reuse open connections.  The handle is attached to our share object.
+        """
+        try:
+            handle = self.free_handles.pop()
+        except IndexError:
+            handle = pycurl.Curl()
+            self.handles_created += 1
+        handle.setopt(pycurl.SHARE, self.share)
+        return handle
+
+    def release_handle(self, transfer, handle):
+        """Put a handle back in the pool once a transfer is done with it.
+        """
+        if transfer.handle is handle:
+            transfer.handle = None
+        if len(self.free_handles) < MAX_FREE_HANDLES:
+            # reset() clears all options (including our callbacks, which
+            # reference the transfer) but keeps the connection and SSL
+            # session caches around.
+            handle.reset()
+            self.free_handles.append(handle)
+        else:
+            handle.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
         self.wakeup()
 
+    def set_rate_limits(self, download_limit=0, upload_limit=0):
+        """Set the total bandwidth that our transfers can use.
+
+        :param download_limit: max download rate in bytes/second, or 0 for
+            no limit
+        :param upload_limit: max upload rate in bytes/second, or 0 for no
+            limit
+        """
+        self.download_limit = download_limit
+        self.upload_limit = upload_limit
+        self.needs_rebalance = True
+        self.wakeup()
+
     def remove_transfer(self, transfer, remove_file=False):
         self.transfers_to_remove.put((transfer, remove_file))
         self.wakeup()
 
+    def file_closing(self, path):
+        """Note that a canceled transfer is closing path in the file writer
+        thread.
+
+        We don't start transfers for path until file_closed() gets called.
+        Otherwise, a resumed transfer could see the file before all of the
+        data is written to it.
+        """
+        self.closing_files[path] = self.closing_files.get(path, 0) + 1
+
+    def file_closed(self, path, remove_file):
+        """Called in the file writer thread when it's done closing path."""
+        if remove_file:
+            try:
+                fileutil.remove(path)
+            except OSError:
+                pass
+        self.closed_files.put(path)
+        if not self.quit_flag:
+            self.wakeup()
+
     def call_after_perform(self, callback):
         self.after_perform_callbacks.append(callback)
 
@@ -933,6 +1433,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
+        self.start_pending()
         while True:
             rv, num_handles = self.multi.perform()
             self.update_stats()
@@ -943,6 +1444,9 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 break
         self.process_queues()
         self.check_finished()
+        self.start_pending()
+        if self.needs_rebalance:
+            self.rebalance()
 
     def update_stats(self):
         for transfer in self.transfer_map.values():
@@ -951,45 +1455,138 @@ class LibCURLManager(eventloop.SimpleEventLoop):
     def process_queues(self):
         while True:
             try:
-                transfer = self.transfers_to_add.get_nowait()
+                path = self.closed_files.get_nowait()
             except Queue.Empty:
                 break
+            count = self.closing_files.get(path, 0) - 1
+            if count > 0:
+                self.closing_files[path] = count
+            else:
+                self.closing_files.pop(path, None)
+
+        while True:
             try:
-                transfer.build_handle()
-            except NetworkError, e:
-                transfer.call_errback(e)
-                continue
-            self.transfer_map[transfer.handle] = transfer
-            self.multi.add_handle(transfer.handle)
+                transfer = self.transfers_to_add.get_nowait()
+            except Queue.Empty:
+                break
+            heapq.heappush(self.pending, (transfer.options.priority,
+                self.pending_counter.next(), transfer))
 
         while True:
             try:
                 transfer, remove_file = self.transfers_to_remove.get_nowait()
             except Queue.Empty:
                 break
-            transfer.on_cancel(remove_file)
             try:
-                del self.transfer_map[transfer.handle]
-            except KeyError:
+                transfer.on_cancel(remove_file)
+            except StandardError:
+                logging.warning("Error calling on_cancel()", exc_info=True)
+            finally:
+                try:
+                    del self.transfer_map[transfer.handle]
+                except KeyError:
+                    self.remove_pending(transfer)
+                else:
+                    self.multi.remove_handle(transfer.handle)
+                    self.transfer_stopped(transfer)
+                    self.release_handle(transfer, transfer.handle)
+
+    def remove_pending(self, transfer):
+        new_pending = [entry for entry in self.pending
+                if entry[2] is not transfer]
+        if len(new_pending) != len(self.pending):
+            heapq.heapify(new_pending)
+            self.pending = new_pending
+
+    def start_pending(self):
+        """Start as many pending transfers as our host limits allow."""
+        blocked = []
+        while self.pending:
+            entry = heapq.heappop(self.pending)
+            transfer = entry[2]
+            if (not self.host_has_room(transfer) or
+                    transfer.options.write_file in self.closing_files):
+                blocked.append(entry)
                 continue
-            self.multi.remove_handle(transfer.handle)
+            try:
+                transfer.build_handle()
+            except NetworkError, e:
+                transfer.call_errback(e)
+                if transfer.handle is not None:
+                    self.release_handle(transfer, transfer.handle)
+                continue
+            self.transfer_map[transfer.handle] = transfer
+            self.multi.add_handle(transfer.handle)
+            key = self.host_key(transfer)
+            self.host_counts[key] = self.host_counts.get(key, 0) + 1
+            self.needs_rebalance = True
+        for entry in blocked:
+            heapq.heappush(self.pending, entry)
+
+    def host_key(self, transfer):
+        return (transfer.options.host, transfer.options.priority)
+
+    def host_has_room(self, transfer):
+        limit = HOST_CONNECTION_LIMITS.get(transfer.options.priority)
+        if limit is None:
+            return True
+        return self.host_counts.get(self.host_key(transfer), 0) < limit
+
+    def transfer_stopped(self, transfer):
+        key = self.host_key(transfer)
+        count = self.host_counts.get(key, 0) - 1
+        if count > 0:
+            self.host_counts[key] = count
+        else:
+            self.host_counts.pop(key, None)
+        self.needs_rebalance = True
+
+    def rebalance(self):
+        """Split the bandwidth limits between the running transfers."""
+        self.needs_rebalance = False
+        has_limits = bool(self.download_limit or self.upload_limit)
+        if not (has_limits or self.limits_applied):
+            # Nothing to do.  Handles start out without any limits.
+            return
+        self.limits_applied = has_limits
+        transfers = self.transfer_map.values()
+        for transfer in transfers:
+            transfer.set_rate_limits(
+                    self.calc_rate_share(self.download_limit, len(transfers)),
+                    self.calc_rate_share(self.upload_limit, len(transfers)))
+
+    def calc_rate_share(self, limit, transfer_count):
+        if limit <= 0:
+            return 0
+        return max(1, limit // transfer_count)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                transfer.on_finished()
             except StandardError:
                 logging.warning("Error calling on_finished()", exc_info=True)
+            finally:
+                if transfer is not None:
+                    self.release_handle(transfer, handle)
         for handle, code, message in errors:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.warning("Error calling on_error()", exc_info=True)
+            finally:
+                if transfer is not None:
+                    self.release_handle(transfer, handle)
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
+        self.transfer_stopped(transfer)
         return transfer
 
 class HTTPClient(object):
@@ -1024,7 +1621,8 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None, extra_headers=None):
+        post_files=None, extra_headers=None, priority=PRIORITY_INTERACTIVE,
+        body_sink=None, byte_range=None):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -1046,11 +1644,21 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
     :param extra_headers: an option dictionary of extra headers to send
+    :param priority: priority class for the transfer (one of the PRIORITY_*
+        constants).  This controls the order transfers are started in, how
+        many connections we open to a host and how the bandwidth gets split
+        up.
+    :param body_sink: BodySink object to send the body to as it downloads,
+        rather than keeping it in memory.  Can't be used with write_file.
+    :param byte_range: (start, end) tuple to only request part of the
+        resource (end is inclusive).  This must be used with a body_sink.  If
+        the server doesn't support ranges, errback gets a ResumeFailed error.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
         'status': HTTP response code
-        'body': The request body (if write_file is not given)
+        'body': The request body (if write_file and body_sink are not
+            given)
         'content-length': Length of the downloads as an int
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
@@ -1066,16 +1674,17 @@ def grab_url(url, callback, errback, header_callback=None,
     """
     url = sanitize_url(url)
     if url.startswith("file://"):
-        return _grab_file_url(url, callback, errback, default_mime_type)
+        return _grab_file_url(url, callback, errback, default_mime_type,
+                body_sink)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file, extra_headers)
+                post_files, write_file, extra_headers, priority, byte_range)
         transfer = CurlTransfer(options, callback, errback, header_callback,
-                content_check_callback)
+                content_check_callback, body_sink)
         transfer.start()
         return HTTPClient(transfer)
 
-def _grab_file_url(url, callback, errback, default_mime_type):
+def _grab_file_url(url, callback, errback, default_mime_type, body_sink=None):
     path = download_utils.get_file_url_path(url)
     try:
         f = file(path)
@@ -1089,11 +1698,15 @@ def _grab_file_url(url, callback, errback, default_mime_type):
             eventloop.add_idle(errback, 'grab file url errback',
                     args=(FileURLReadError(path),))
         else:
-            info = {"body": data,
-                          "updated-url":url,
+            info = {"updated-url":url,
                           "redirected-url":url,
                           "content-type": default_mime_type,
                           }
+            if body_sink is not None:
+                body_sink.write(data)
+                body_sink.finish(info)
+            else:
+                info['body'] = data
             eventloop.add_idle(callback, 'grab file url callback',
                     args=(info,))
 
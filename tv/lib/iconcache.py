@@ -300,7 +300,8 @@ class IconCache(DDBObject):
 
         # Last try, get the icon from HTTP.
         httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+                lambda error: self.error_callback(url, error),
+                priority=httpclient.PRIORITY_ICON)
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
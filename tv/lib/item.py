@@ -101,6 +101,10 @@ class FeedParserValues(object):
     attribute for various attributes using in Item (entry_title,
     rss_id, url, etc...).
     """
+    # attributes that compare_to_item_enclosures() checks
+    ENCLOSURE_KEYS = ('url', 'enclosure_size', 'enclosure_type',
+                      'enclosure_format')
+
     def __init__(self, entry):
         self.entry = entry
         self.first_video_enclosure = get_first_video_enclosure(entry)
@@ -133,15 +137,24 @@ class FeedParserValues(object):
         return True
 
     def compare_to_item_enclosures(self, item):
-        compare_keys = (
-            'url', 'enclosure_size', 'enclosure_type',
-            'enclosure_format'
-            )
-        for key in compare_keys:
+        for key in self.ENCLOSURE_KEYS:
             if getattr(item, key) != self.data[key]:
                 return False
         return True
 
+    def enclosure_signature(self):
+        """Get a hashable value for our enclosure.
+
+        If compare_to_item() or compare_to_item_enclosures() is True for an
+        item, then item_enclosure_signature() returns the same value for it.
+        """
+        return tuple(self.data[key] for key in self.ENCLOSURE_KEYS)
+
+    @classmethod
+    def item_enclosure_signature(cls, item):
+        """Get the enclosure_signature() value for an Item."""
+        return tuple(getattr(item, key) for key in cls.ENCLOSURE_KEYS)
+
     def _calc_title(self):
         if hasattr(self.entry, "title"):
             # The title attribute shouldn't use entities, but some in
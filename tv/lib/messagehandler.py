@@ -1240,6 +1240,10 @@ New ids: %s""", playlist_item_ids, message.item_ids)
         else:
             feed_.set_auto_download_mode(message.setting)
 
+    def handle_set_visible_downloads(self, message):
+        app.download_state_manager.set_visible_downloads(
+            message.all_visible, message.downloader_ids)
+
     def handle_track_download_count(self, message):
         if self.download_count_tracker is None:
             self.download_count_tracker = DownloadCountTracker()
@@ -868,6 +868,22 @@ class SetNetLookupEnabled(BackendMessage):
         self.item_ids = item_ids
         self.enabled = enabled
 
+class SetVisibleDownloads(BackendMessage):
+    """Tell the backend which downloads the user can currently see.
+
+    Visible downloads get frequent progress updates, the others only get
+    occasional ones.
+    """
+    def __init__(self, all_visible, downloader_ids):
+        """Create a new message
+
+        :param all_visible: True if the downloads tab is displayed
+        :param downloader_ids: set of downloader ids for the downloads in the
+            displayed item list
+        """
+        self.all_visible = all_visible
+        self.downloader_ids = downloader_ids
+
 class ClogBackend(BackendMessage):
     """Dev message: intentionally clog the backend for a specified number of 
     seconds.
@@ -36,12 +36,15 @@ Module properties:
 
 import collections
 import contextlib
+import hashlib
 import logging
 import os.path
+import shutil
 import time
 
 from miro import app
 from miro import clock
+from miro import coverart
 from miro import database
 from miro import echonest
 from miro import eventloop
@@ -52,8 +55,9 @@ from miro import messages
 from miro import net
 from miro import prefs
 from miro import signals
+from miro import util
 from miro import workerprocess
-from miro.plat.utils import (filename_to_unicode,
+from miro.plat.utils import (filename_to_unicode, utf8_to_filename,
                              get_enmfp_executable_info)
 
 attribute_names = set([
@@ -92,6 +96,10 @@ class MetadataStatus(database.DDBObject):
         u'echonest': 'echonest_status',
     }
 
+    # metadata keys that store filenames.  We convert these to unicode when
+    # storing them in entry_metadata
+    FILENAME_KEYS = ('cover_art', 'screenshot')
+
     def setup_new(self, path, net_lookup_enabled):
         self.path = path
         self.net_lookup_enabled = net_lookup_enabled
@@ -116,9 +124,18 @@ class MetadataStatus(database.DDBObject):
         # This hopefully is allows us to track if metadata processing is
         # finished, even as the database schema changes between miro versions.
         self.finished_status = 0
+        # entry_metadata stores the metadata from each of our
+        # MetadataEntry objects, keyed by source.  It's kept up to date as
+        # entries are added and changed, so that get_merged_metadata()
+        # doesn't have to query the metadata table.  None means we haven't
+        # calculated it yet (rows created before it was added, or created by
+        # an older version on a device).
+        self.entry_metadata = {}
+        self._merged_metadata = None
         self._add_to_cache()
 
     def setup_restored(self):
+        self._merged_metadata = None
         self._set_current_processor(update_finished_status=False)
         self.db_info.db.cache.set('metadata', self.path, self)
 
@@ -135,6 +152,7 @@ class MetadataStatus(database.DDBObject):
         # also copy current_processor, which doesn't get stored in the DB and
         # thus isn't returned by schema_fields()
         self.current_processor = other_status.current_processor
+        self._merged_metadata = None
         self.signal_change()
 
     @classmethod
@@ -322,6 +340,75 @@ class MetadataStatus(database.DDBObject):
         self._set_current_processor()
         self.signal_change()
 
+    def set_entry_metadata(self, entry):
+        """Update our stored metadata for one of our MetadataEntry objects.
+
+        Call this whenever an entry is created, updated or disabled.
+        """
+        if self.entry_metadata is None:
+            self._calc_entry_metadata()
+        # Make a new dict rather than changing the current one, since
+        # copy_status() can share entry_metadata between objects.
+        entry_metadata = self.entry_metadata.copy()
+        if entry.disabled:
+            entry_metadata.pop(entry.source, None)
+        else:
+            entry_metadata[entry.source] = self._data_for_entry(entry)
+        self.entry_metadata = entry_metadata
+        self._merged_metadata = None
+        self.signal_change()
+
+    def _data_for_entry(self, entry):
+        data = entry.get_metadata()
+        for key in self.FILENAME_KEYS:
+            if key in data:
+                data[key] = filename_to_unicode(data[key])
+        return data
+
+    def _calc_entry_metadata(self):
+        """Calculate entry_metadata for statuses from before we stored it.
+
+        This only saves the status once, no matter how many entries it has.
+        """
+        entry_metadata = {}
+        for entry in MetadataEntry.metadata_for_status(self, self.db_info):
+            entry_metadata[entry.source] = self._data_for_entry(entry)
+        self.entry_metadata = entry_metadata
+        self._merged_metadata = None
+        self.signal_change()
+
+    def get_merged_metadata(self):
+        """Get the metadata from all our entries.
+
+        Values from higher priority entries override lower priority ones.
+
+        :returns: dict of metadata
+        """
+        if self.entry_metadata is None:
+            self._calc_entry_metadata()
+        if self._merged_metadata is None:
+            merged = {}
+            priority_map = MetadataEntry.source_priority_map
+            for source in sorted(self.entry_metadata, key=priority_map.get):
+                merged.update(self.entry_metadata[source])
+            for key in self.FILENAME_KEYS:
+                if key in merged:
+                    value = merged[key].encode('utf-8')
+                    merged[key] = utf8_to_filename(value)
+            self._merged_metadata = merged
+        return self._merged_metadata.copy()
+
+    def get_source_metadata(self, source):
+        """Get the metadata from one of our entries.
+
+        :param source: source name of the entry
+        :returns: dict of metadata, empty if we don't have an enabled entry
+            for source
+        """
+        if self.entry_metadata is None:
+            self._calc_entry_metadata()
+        return self.entry_metadata.get(source, {}).copy()
+
     def rename(self, new_path):
         """Change the path for this object."""
         self.db_info.db.cache.remove('metadata', self.path)
@@ -412,14 +499,26 @@ class MetadataEntry(database.DDBObject):
                              db_info=db_info)
         return view.get_singleton()
 
+    # if echonest didn't find the song, then title will be NULL if 7digital
+    # didn't find the album, then album will be NULL.  If either of those are
+    # true, then we want to retry re-querying
+    INCOMPLETE_ECHONEST_WHERE = ('source="echonest" AND '
+                                 '(album IS NULL or title IS NULL)')
+
     @classmethod
-    def incomplete_echonest_view(cls, db_info=None):
-        # if echonest didn't find the song, then title will be NULL if
-        # 7digital didn't find the album, then album will be NULL.  If either
-        # of those are true, then we want to retry re-querying
-        return cls.make_view('source="echonest" AND '
-                             '(album IS NULL or title IS NULL)',
-                             db_info=None)
+    def incomplete_echonest_select(cls, columns, db_info=None):
+        return cls.select(columns, cls.INCOMPLETE_ECHONEST_WHERE,
+                          db_info=db_info)
+
+    @classmethod
+    def mutagen_album_count(cls, album, db_info=None):
+        """Count the mutagen entries for an album.
+
+        Cover art files are named after the mutagen album, so this tells us
+        if we still need the cover art file for album.
+        """
+        return cls.make_view("source='mutagen' AND album=?", (album,),
+                             db_info=db_info).count()
 
     @classmethod
     def set_disabled(cls, source, status, disabled, db_info=None):
@@ -434,8 +533,281 @@ class MetadataEntry(database.DDBObject):
         else:
             entry.disabled = disabled
             entry.signal_change()
+            status.set_entry_metadata(entry)
             return True
 
+# how much data to read from the start and end of files for _partial_hash()
+PARTIAL_HASH_SIZE = 64 * 1024
+# MetadataCacheEntry.remove_old() removes entries that haven't been used for
+# this many seconds, then the least recently used entries until there are at
+# most METADATA_CACHE_MAX_ENTRIES left.
+METADATA_CACHE_MAX_AGE = 180 * 24 * 60 * 60
+METADATA_CACHE_MAX_ENTRIES = 50000
+# types of metadata values that we can store in MetadataCacheEntry.  These
+# need to be valid for a SchemaReprContainer.
+_CACHEABLE_TYPES = (bool, int, long, float, unicode)
+
+def _partial_hash(path):
+    """Calculate a hash of a file using just its start and end.
+
+    :returns: hex digest or None if the file can't be read
+    """
+    digest = hashlib.sha1()
+    try:
+        f = open(path, 'rb')
+        try:
+            digest.update(f.read(PARTIAL_HASH_SIZE))
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size > PARTIAL_HASH_SIZE:
+                f.seek(max(PARTIAL_HASH_SIZE, size - PARTIAL_HASH_SIZE))
+                digest.update(f.read(PARTIAL_HASH_SIZE))
+        finally:
+            f.close()
+    except EnvironmentError:
+        return None
+    return digest.hexdigest()
+
+class MetadataCacheEntry(database.DDBObject):
+    """Cached mutagen and movie data results for a file.
+
+    We use these to avoid re-running the extractors when a file gets added
+    to the metadata system again, for example when a watched folder is
+    re-added or the database for a device gets reset.  Entries match a file
+    if the path, size and mtime are the same, or if the file has the same
+    size and _partial_hash() as the file the entry was created for.
+
+    Entries outlive their files, so the cover art and screenshot files that
+    they reference are kept until the entry is removed.  remove_old()
+    keeps the table from growing forever.
+
+    Entries are always stored in the library database, so they are shared
+    between the library and devices.
+    """
+
+    # NOTE: like MetadataStatus, this class uses the database cache so that
+    # get_by_path() finds entries that are waiting to be inserted by the
+    # bulk_sql_manager.  The category is "metadata_cache", the key is the
+    # path.
+
+    # maps source names to the attribute that stores their result and the
+    # metadata key for the image that they create
+    source_info = {
+        u'mutagen': ('mutagen', 'cover_art'),
+        u'movie-data': ('movie_data', 'screenshot'),
+    }
+
+    def setup_new(self, path, size, mtime):
+        self.path = path
+        self.last_used = time.time()
+        self._reset(size, mtime)
+        self.db_info.db.cache.set('metadata_cache', self.path, self)
+
+    def setup_restored(self):
+        self.db_info.db.cache.set('metadata_cache', self.path, self)
+
+    def insert_into_db_failed(self):
+        self.db_info.db.cache.remove('metadata_cache', self.path)
+
+    def _reset(self, size, mtime):
+        self.size = size
+        self.mtime = mtime
+        # calculated by get_partial_hash() when we need it
+        self.partial_hash = None
+        self.mutagen = None
+        self.movie_data = None
+        self.cover_art = None
+        self.screenshot = None
+
+    def file_changed(self, size, mtime):
+        """Forget our results because the file has changed."""
+        self._remove_unused_images()
+        self._reset(size, mtime)
+        self.signal_change()
+
+    def mark_used(self):
+        """Call this when we use one of our results."""
+        self.last_used = time.time()
+        self.signal_change()
+
+    def get_partial_hash(self):
+        """Get the _partial_hash() value for our file.
+
+        We only read the file the first time that this is called, since most
+        files never have another file with the same size to compare against.
+
+        :returns: hex digest, or None if our file changed or can't be read
+        """
+        if self.partial_hash is None:
+            try:
+                stat = os.stat(self.path)
+            except EnvironmentError:
+                return None
+            if (stat.st_size, stat.st_mtime) != (self.size, self.mtime):
+                return None
+            self.partial_hash = _partial_hash(self.path)
+            if self.partial_hash is not None:
+                self.signal_change()
+        return self.partial_hash
+
+    def set_result(self, source, result):
+        """Store the result of running a metadata extractor."""
+        attr_name, image_key = self.source_info[source]
+        # cover art and screenshot paths get their own column, since we can't
+        # store filenames in a repr container
+        data = dict((key, value) for key, value in result.items()
+                    if key in MetadataEntry.metadata_columns and
+                    key != image_key and
+                    isinstance(value, _CACHEABLE_TYPES))
+        image_path = result.get(image_key)
+        if (data == getattr(self, attr_name) and
+                image_path == getattr(self, image_key)):
+            # this happens when the result came from the cache
+            return
+        setattr(self, attr_name, data)
+        setattr(self, image_key, image_path)
+        self.signal_change()
+
+    def get_result(self, source, path, image_directory):
+        """Get a cached result for a metadata extractor.
+
+        Cover art is shared between files, so we just make sure that it's in
+        image_directory.  Screenshots are per-file, so we make a copy if the
+        result is for a different path.
+
+        :param source: metadata source name
+        :param path: path to the file we want the result for
+        :param image_directory: directory that the result's image should be
+            in
+        :returns: result dict, or None if we don't have a usable result
+        """
+        attr_name, image_key = self.source_info[source]
+        data = getattr(self, attr_name)
+        if data is None:
+            return None
+        result = data.copy()
+        image_path = getattr(self, image_key)
+        if image_path is not None:
+            if not fileutil.exists(image_path):
+                return None
+            if image_key == 'screenshot' and path != self.path:
+                dest_path = os.path.join(image_directory,
+                                         os.path.basename(path) + '.png')
+                image_path = self._copy_image(image_path, dest_path)
+            elif os.path.dirname(image_path) != image_directory:
+                dest_path = os.path.join(image_directory,
+                                         os.path.basename(image_path))
+                if fileutil.exists(dest_path):
+                    image_path = dest_path
+                else:
+                    image_path = self._copy_image(image_path, dest_path)
+            if image_path is None:
+                return None
+            result[image_key] = image_path
+        return result
+
+    def _copy_image(self, image_path, dest_path):
+        """Copy an image file.
+
+        :returns: path of the copy, or None if there was an error
+        """
+        try:
+            dest_path, dest_file = util.next_free_filename(dest_path)
+            try:
+                source_file = open(image_path, 'rb')
+                try:
+                    shutil.copyfileobj(source_file, dest_file)
+                finally:
+                    source_file.close()
+            finally:
+                dest_file.close()
+        except EnvironmentError, e:
+            logging.warn("MetadataCacheEntry: error copying %s (%s)",
+                         image_path, e)
+            return None
+        return dest_path
+
+    @classmethod
+    def get_by_path(cls, path):
+        try:
+            return app.db_info.db.cache.get('metadata_cache', path)
+        except KeyError:
+            view = cls.make_view('path=?', (filename_to_unicode(path),))
+            return view.get_singleton()
+
+    @classmethod
+    def get_for_path(cls, path):
+        """Get the entry for a path, or None if there isn't one."""
+        try:
+            return cls.get_by_path(path)
+        except database.ObjectNotFoundError:
+            return None
+
+    @classmethod
+    def cover_art_count(cls, cover_art):
+        """Count the entries that use a cover art file."""
+        return cls.make_view('cover_art=?',
+                             (filename_to_unicode(cover_art),)).count()
+
+    @classmethod
+    def remove_old(cls):
+        """Remove entries that we probably won't use again.
+
+        This removes entries that haven't been used for
+        METADATA_CACHE_MAX_AGE seconds, then the least recently used entries
+        until we have at most METADATA_CACHE_MAX_ENTRIES.
+        """
+        view = cls.make_view('last_used < ?',
+                             (time.time() - METADATA_CACHE_MAX_AGE,))
+        for entry in view:
+            entry.remove()
+        extra = cls.make_view().count() - METADATA_CACHE_MAX_ENTRIES
+        if extra > 0:
+            for entry in cls.make_view(order_by='last_used', limit=extra):
+                entry.remove()
+
+    def remove(self):
+        self.db_info.db.cache.remove('metadata_cache', self.path)
+        database.DDBObject.remove(self)
+        self._remove_unused_images()
+
+    def _remove_unused_images(self):
+        """Delete our images if nothing else uses them."""
+        if self.screenshot is not None:
+            view = MetadataEntry.make_view(
+                'screenshot=?', (filename_to_unicode(self.screenshot),))
+            if view.count() == 0:
+                fileutil.delete(self.screenshot)
+        if (self.cover_art is not None and
+                self.cover_art_count(self.cover_art) == 0):
+            view = MetadataEntry.make_view(
+                'cover_art=?', (filename_to_unicode(self.cover_art),))
+            if view.count() == 0 and fileutil.exists(self.cover_art):
+                coverart.remove_image(self.cover_art)
+
+    @classmethod
+    def entries_for_file(cls, path, size, mtime):
+        """Find entries that match a file.
+
+        The entry for the path comes first, then entries for other paths that
+        have the same contents.
+        """
+        try:
+            entry = cls.get_by_path(path)
+        except database.ObjectNotFoundError:
+            pass
+        else:
+            if entry.size == size and entry.mtime == mtime:
+                yield entry
+        others = list(cls.make_view('size=? AND path!=?',
+                                    (size, filename_to_unicode(path))))
+        if others:
+            partial_hash = _partial_hash(path)
+            if partial_hash is not None:
+                for entry in others:
+                    if entry.get_partial_hash() == partial_hash:
+                        yield entry
+
 class _MetadataProcessor(signals.SignalEmitter):
     """Base class for processors that handle getting metadata somehow.
 
@@ -537,14 +909,111 @@ class _TaskProcessor(_MetadataProcessor):
         self.emit('task-error', task.source_path, error)
         self.remove_task_for_path(task.source_path)
 
+class _MutagenProcessor(_TaskProcessor):
+    """_TaskProcessor that sends mutagen tasks in batches.
+
+    MutagenTasks that are waiting to be sent get combined into
+    MutagenBatchTasks with up to batch_size paths.  We keep
+    BATCHES_PER_PROCESS batches in flight for each worker process, so that
+    every process has work and the next batch is queued when one finishes.
+
+    Signals:
+
+    - batch-complete(batch) -- we handled the results for a batch
+    """
+
+    BATCHES_PER_PROCESS = 2
+
+    def __init__(self, source_name, batch_size):
+        _TaskProcessor.__init__(self, source_name, None)
+        self.create_signal('batch-complete')
+        self.batch_size = batch_size
+        # map MutagenBatchTasks to the set of paths we're still waiting on
+        self._active_batches = {}
+
+    def add_task(self, task):
+        self.add_tasks([task])
+
+    def add_tasks(self, tasks):
+        for task in tasks:
+            self._pending_tasks[task.source_path] = task
+        self._send_pending_tasks()
+
+    def path_limit(self):
+        """Get the max number of paths to have in flight."""
+        return (self.batch_size * self.BATCHES_PER_PROCESS *
+                workerprocess.process_count())
+
+    def _send_pending_tasks(self):
+        limit = self.path_limit()
+        while len(self._active_tasks) < limit and self._pending_tasks:
+            count = min(self.batch_size, len(self._pending_tasks),
+                        limit - len(self._active_tasks))
+            tasks = [self._pending_tasks.popitem()[1] for i in xrange(count)]
+            self._send_batch(tasks)
+
+    def _send_batch(self, tasks):
+        batch = workerprocess.MutagenBatchTask(
+            [task.source_path for task in tasks],
+            tasks[0].cover_art_directory)
+        for task in tasks:
+            self._active_tasks[task.source_path] = task
+        self._active_batches[batch] = set(batch.source_paths)
+        workerprocess.send(batch, self._batch_callback, self._batch_errback)
+
+    def remove_tasks_for_paths(self, paths):
+        for path in paths:
+            if self._active_tasks.pop(path, None) is None:
+                self._pending_tasks.pop(path, None)
+        for batch, remaining in self._active_batches.items():
+            remaining.difference_update(paths)
+            if not remaining:
+                del self._active_batches[batch]
+        self._send_pending_tasks()
+
+    def _batch_callback(self, batch, results):
+        for path, result in results:
+            if path not in self._active_tasks:
+                logging.debug("%s done but already removed: %r",
+                              self.source_name, path)
+                continue
+            del self._active_tasks[path]
+            if isinstance(result, Exception):
+                logging.warn("Error running %s for %r: %s", batch, path,
+                             result)
+                self.emit('task-error', path, result)
+            else:
+                logging.debug("%s done: %r", self.source_name, path)
+                self._check_for_none_values(result)
+                self.emit('task-complete', path, result)
+        self._finish_batch_paths(batch, [path for path, result in results])
+
+    def _batch_errback(self, batch, error):
+        logging.warn("Error running %s: %s", batch, error)
+        for path in batch.source_paths:
+            if self._active_tasks.pop(path, None) is not None:
+                self.emit('task-error', path, error)
+        self._finish_batch_paths(batch, batch.source_paths)
+
+    def _finish_batch_paths(self, batch, paths):
+        remaining = self._active_batches.get(batch)
+        if remaining is not None:
+            remaining.difference_update(paths)
+            if not remaining:
+                del self._active_batches[batch]
+                self.emit('batch-complete', batch)
+        self._send_pending_tasks()
+
 class _EchonestQueue(object):
     """Queue for echonest tasks.
 
     _EchonestQueue is a modified FIFO.  Each queue item is stored as a path +
-    optional additional data.
+    optional additional data.  Items are indexed by path, so removing paths
+    doesn't require scanning the whole queue.
     """
     def __init__(self):
-        self.queue = collections.deque()
+        # maps paths to their extra data, in the order they were added
+        self.queue = collections.OrderedDict()
 
     def add(self, path, *extra_data):
         """Add a path to the queue.
@@ -552,7 +1021,7 @@ class _EchonestQueue(object):
         *extra_data can be used to store related data to the path.  It will be
         returned along with the path in pop()
         """
-        self.queue.append((path, extra_data))
+        self.queue[path] = extra_data
 
     def pop(self):
         """Pop a path from the active queue.
@@ -563,7 +1032,10 @@ class _EchonestQueue(object):
 
         :raises IndexError: no path to pop
         """
-        path, extra_data = self.queue.popleft()
+        try:
+            path, extra_data = self.queue.popitem(last=False)
+        except KeyError:
+            raise IndexError("pop from empty _EchonestQueue")
         if extra_data:
             return (path,) + extra_data
         else:
@@ -571,12 +1043,16 @@ class _EchonestQueue(object):
 
     def remove_paths(self, path_set):
         """Remove all paths that are in a set."""
+        if len(path_set) < len(self.queue):
+            for path in path_set:
+                self.queue.pop(path, None)
+        else:
+            for path in self.queue.keys():
+                if path in path_set:
+                    del self.queue[path]
 
-        def filter_removed(item):
-            return item[0] not in path_set
-        new_items = filter(filter_removed, self.queue)
-        self.queue.clear()
-        self.queue.extend(new_items)
+    def __contains__(self, path):
+        return path in self.queue
 
     def __len__(self):
         """Get the number of items in the queue that are not disabled because
@@ -602,6 +1078,8 @@ class _EchonestProcessor(_MetadataProcessor):
     # pause.
     PAUSE_AFTER_HTTP_ERROR_COUNT = 3
     PAUSE_AFTER_HTTP_ERROR_TIMEOUT = 60 * 5
+    # max number of echonest queries to run at once
+    ECHONEST_QUERY_LIMIT = 3
 
     # NOTE: _EchonestProcessor dosen't inherity from _TaskProcessor because it
     # handles it's work using httpclient rather than making tasks and sending
@@ -621,7 +1099,8 @@ class _EchonestProcessor(_MetadataProcessor):
         self._codegen_queue = _EchonestQueue()
         self._echonest_queue = _EchonestQueue()
         self._running_codegen = False
-        self._querying_echonest = False
+        # paths that we're currently querying echonest for
+        self._echonest_queries = set()
         self._codegen_info = get_enmfp_executable_info()
         self._codegen_cooldown_end = 0
         self._codegen_cooldown_caller = eventloop.DelayedFunctionCaller(
@@ -689,10 +1168,10 @@ class _EchonestProcessor(_MetadataProcessor):
             return
         version = 3.15 # change to 4.11 for echoprint
         metadata = self._metadata_for_path.pop(path)
+        self._echonest_queries.add(path)
         echonest.query_echonest(path, self._cover_art_dir, code, version,
                                 metadata, self._echonest_callback,
                                 self._echonest_errback)
-        self._querying_echonest = True
 
     def _echonest_callback(self, path, metadata):
         if path in self._paths_in_system:
@@ -702,13 +1181,13 @@ class _EchonestProcessor(_MetadataProcessor):
         else:
             logging.warn("_EchonestProcessor._echonest_callback called for "
                          "path not in system: %r", path)
-        self._querying_echonest = False
+        self._echonest_queries.discard(path)
         self._process_queue()
 
     def _echonest_errback(self, path, error):
         logging.warn("Error running echonest for %s (%s)" % (path, error))
         self._paths_in_system.discard(path)
-        self._querying_echonest = False
+        self._echonest_queries.discard(path)
         if isinstance(error, net.NetworkError):
             self._http_error_times.append(clock.clock())
             if (len(self._http_error_times) >
@@ -720,7 +1199,7 @@ class _EchonestProcessor(_MetadataProcessor):
     def _process_queue(self):
         if self._should_process_metadata_fetch_queue():
             self._process_metadata_fetch_queue()
-        if self._should_process_echonest_queue():
+        while self._should_process_echonest_queue():
             self._process_echonest_queue()
         if self._should_process_codegen_queue():
             self._run_codegen(self._codegen_queue.pop())
@@ -743,7 +1222,8 @@ class _EchonestProcessor(_MetadataProcessor):
         return True
 
     def _should_process_echonest_queue(self):
-        return (self._echonest_queue and not self._querying_echonest and
+        return (self._echonest_queue and
+                len(self._echonest_queries) < self.ECHONEST_QUERY_LIMIT and
                 not self._waiting_from_http_errors)
 
     def _process_echonest_queue(self):
@@ -819,17 +1299,26 @@ class ProgressCountTracker(object):
     processing, the number of items finished, and the number of items that
     have finished mutagen/movie-data but still need internet metadata.  Once
     all items are finished, then the counts reset.
+
+    We store the stage that each path is in and keep the counts as integers,
+    so that get_count_info() and the stage changes are cheap.
     """
 
+    # stages that a file goes through.  Files only move forward through the
+    # stages.
+    STARTED = 0
+    FINISHED_LOCAL = 1
+    FINISHED = 2
+
     def __init__(self):
         self.reset()
 
     def reset(self):
         """Reset the counts."""
-        self.all_files = set()
-        self.finished_local = set()
-        self.finished = set()
-        self.all_sets = (self.all_files, self.finished_local, self.finished)
+        # maps paths to the stage they're in
+        self.stages = {}
+        self.finished_local_count = 0
+        self.finished_count = 0
 
     def get_count_info(self):
         """Get the current count info.
@@ -843,13 +1332,22 @@ class ProgressCountTracker(object):
 
         :returns: the tuple (total, finished_local, finished_count)
         """
-        return (len(self.all_files),
-                len(self.finished_local),
-                len(self.finished))
+        return (len(self.stages),
+                self.finished_local_count,
+                self.finished_count)
+
+    def get_stage(self, path):
+        """Get the stage a file is in.
+
+        :returns: STARTED, FINISHED_LOCAL, FINISHED or None if we're not
+            tracking path
+        """
+        return self.stages.get(path)
 
     def file_started(self, path, initial_metadata):
         """Add a file to the counts."""
-        self.all_files.add(path)
+        if path not in self.stages:
+            self.stages[path] = self.STARTED
 
     def file_net_lookup_restarted(self, path):
         self.file_started(path, {})
@@ -862,33 +1360,52 @@ class ProgressCountTracker(object):
 
     def file_finished_local_processing(self, path):
         """Remove a file from our counts."""
-        if path not in self.all_files:
+        if path not in self.stages:
             logging.warn("file_finished_local_processing called for a file "
                          "that we're not tracking: %s", path)
             return
-        self.finished_local.add(path)
+        self._advance_stage(path, self.FINISHED_LOCAL)
 
     def file_finished(self, path):
         """Remove a file from our counts."""
-        if path not in self.all_files:
+        if path not in self.stages:
             logging.warn("file_finished called for a file that we're "
                          "not tracking: %s", path)
             return
-        self.finished.add(path)
-        self.finished_local.add(path)
-        if len(self.finished) == len(self.all_files):
+        self._advance_stage(path, self.FINISHED)
+        if self.finished_count == len(self.stages):
             self.reset()
 
+    def _advance_stage(self, path, stage):
+        old_stage = self.stages[path]
+        if stage <= old_stage:
+            return
+        if old_stage < self.FINISHED_LOCAL:
+            self.finished_local_count += 1
+        if stage == self.FINISHED:
+            self.finished_count += 1
+        self.stages[path] = stage
+
+    def _forget_path(self, path):
+        stage = self.stages.pop(path, None)
+        if stage is None:
+            return
+        if stage >= self.FINISHED_LOCAL:
+            self.finished_local_count -= 1
+        if stage == self.FINISHED:
+            self.finished_count -= 1
+
     def file_moved(self, old_path, new_path):
         """Handle a file changing names."""
-        if old_path not in self.all_files:
+        if old_path not in self.stages:
             logging.warn("file_moved called for a file that we're "
                          "not tracking: %s", old_path)
             return
-        for count_set in self.all_sets:
-            if old_path in count_set:
-                count_set.remove(old_path)
-                count_set.add(new_path)
+        stage = self.stages[old_path]
+        self._forget_path(old_path)
+        self._forget_path(new_path)
+        self.file_started(new_path, {})
+        self._advance_stage(new_path, stage)
 
     def remove_file(self, path):
         """Remove a file from the counts.
@@ -896,9 +1413,8 @@ class ProgressCountTracker(object):
         This is different than finishing the file, since this will lower the
         total count, rather than increase the finished count.
         """
-        for count_set in self.all_sets:
-            count_set.discard(path)
-        if len(self.finished) == len(self.all_files):
+        self._forget_path(path)
+        if self.finished_count == len(self.stages):
             self.reset()
 
 class LibraryProgressCountTracker(object):
@@ -989,15 +1505,16 @@ class LibraryProgressCountTracker(object):
         old_tracker = self.trackers[old_file_type]
         new_tracker = self.trackers[new_file_type]
 
-        if path not in old_tracker.all_files:
+        stage = old_tracker.get_stage(path)
+        if stage is None:
             logging.warn("file_changed_type called for a file we're not "
                          "tracking: %s", path)
             return
 
         new_tracker.file_started(path, metadata)
-        if path in old_tracker.finished:
+        if stage == ProgressCountTracker.FINISHED:
             new_tracker.file_finished(path)
-        elif path in old_tracker.finished_local:
+        elif stage == ProgressCountTracker.FINISHED_LOCAL:
             new_tracker.file_finished_local_processing(path)
 
         old_tracker.remove_file(path)
@@ -1080,6 +1597,36 @@ class _ProcessingCountTracker(object):
     def file_being_processed(self, path):
         return path in self.file_types
 
+class _ChunkedIdRunner(object):
+    """Call a function for a list of object ids, a chunk at a time.
+
+    The first chunk runs right away.  The rest get run using
+    DelayedFunctionCaller.call_when_idle(), so that working through a large
+    list doesn't block the eventloop.
+    """
+    def __init__(self, func, chunk_size):
+        self.func = func
+        self.chunk_size = chunk_size
+        self.ids = collections.deque()
+        self._caller = eventloop.DelayedFunctionCaller(self.run_chunk)
+
+    def add_ids(self, ids):
+        self.ids.extend(ids)
+        self.run_chunk()
+
+    def run_chunk(self):
+        for i in xrange(min(self.chunk_size, len(self.ids))):
+            self.func(self.ids.popleft())
+        if self.ids:
+            self._caller.call_when_idle()
+
+    def cancel(self):
+        self.ids.clear()
+        self._caller.cancel_call()
+
+    def __len__(self):
+        return len(self.ids)
+
 class MetadataManagerBase(signals.SignalEmitter):
     """Extract and track metadata for files.
 
@@ -1103,6 +1650,13 @@ class MetadataManagerBase(signals.SignalEmitter):
     RETRY_TEMPORARY_INTERVAL = 3600
     # how often to re-try net lookups that have failed
     NET_LOOKUP_RETRY_INTERVAL = 60 * 60 * 24 * 7 # 1 week
+    # max number of paths to send in one MutagenBatchTask
+    MUTAGEN_BATCH_SIZE = 50
+    # minimum time between MetadataProgressUpdate messages
+    PROGRESS_UPDATE_INTERVAL = 0.5
+    # how many objects restart_incomplete() and retry_net_lookup() handle
+    # before going back to the eventloop
+    RESTART_CHUNK_SIZE = 500
 
     def __init__(self, cover_art_dir, screenshot_dir, db_info=None):
         signals.SignalEmitter.__init__(self)
@@ -1115,7 +1669,8 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.cover_art_dir = cover_art_dir
         self.screenshot_dir = screenshot_dir
         self.echonest_cover_art_dir = os.path.join(cover_art_dir, 'echonest')
-        self.mutagen_processor = _TaskProcessor(u'mutagen', 100)
+        self.mutagen_processor = _MutagenProcessor(u'mutagen',
+                                                   self.MUTAGEN_BATCH_SIZE)
         self.moviedata_processor = _TaskProcessor(u'movie-data', 100)
         self.echonest_processor = _EchonestProcessor(
             5, self.echonest_cover_art_dir)
@@ -1129,9 +1684,20 @@ class MetadataManagerBase(signals.SignalEmitter):
         for processor in self.metadata_processors:
             processor.connect("task-complete", self._on_task_complete)
             processor.connect("task-error", self._on_task_error)
+        self.mutagen_processor.connect("batch-complete",
+                                       self._on_batch_complete)
         self.count_tracker = self.make_count_tracker()
         self._send_net_lookup_counts_caller = eventloop.DelayedFunctionCaller(
             self._send_net_lookup_counts)
+        self._send_progress_updates_caller = eventloop.DelayedFunctionCaller(
+            self._send_progress_updates_now)
+        # maps targets to the count info we last sent for them
+        self._sent_progress_counts = {}
+        # albums for files that we've removed.  We check if we can remove the
+        # cover art for them in _remove_unused_cover_art()
+        self._removed_albums = set()
+        self._remove_cover_art_caller = eventloop.DelayedFunctionCaller(
+            self._remove_unused_cover_art)
         # List of (processor, path, metadata) tuples for metadata since the
         # last run_updates() call
         self.metadata_finished = []
@@ -1147,6 +1713,10 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._retry_net_lookup_caller = \
                 eventloop.DelayedFunctionCaller(self.retry_net_lookup)
         self._retry_net_lookup_entries = {}
+        self._restart_runner = _ChunkedIdRunner(self._restart_status,
+                                                self.RESTART_CHUNK_SIZE)
+        self._retry_net_lookup_runner = _ChunkedIdRunner(
+            self._retry_net_lookup_for_entry, self.RESTART_CHUNK_SIZE)
         self._setup_path_placeholders()
         self._setup_net_lookup_count()
         # send initial NetLookupCounts message
@@ -1233,8 +1803,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         return self.bulk_add_count != 0
 
     def _send_pending_mutagen_tasks(self):
-        for task in self.pending_mutagen_tasks:
-            self.mutagen_processor.add_task(task)
+        self.mutagen_processor.add_tasks(self.pending_mutagen_tasks)
         self.pending_mutagen_tasks = []
 
     def _translate_path(self, path):
@@ -1272,8 +1841,9 @@ class MetadataManagerBase(signals.SignalEmitter):
             for entry in MetadataEntry.metadata_for_status(local_status):
                 entry_metadata = entry.get_metadata()
                 initial_metadata.update(entry_metadata)
-                MetadataEntry(status, entry.source, entry_metadata,
-                              db_info=self.db_info)
+                new_entry = MetadataEntry(status, entry.source,
+                                          entry_metadata, db_info=self.db_info)
+                status.set_entry_metadata(new_entry)
         if status.current_processor is not None:
             self.count_tracker.file_started(path, initial_metadata)
             self.run_next_processor(status)
@@ -1331,6 +1901,9 @@ class MetadataManagerBase(signals.SignalEmitter):
         if self.closed: # already closed
             return
         self.closed = True
+        self._send_progress_updates_caller.cancel_call()
+        self._restart_runner.cancel()
+        self._retry_net_lookup_runner.cancel()
         paths = [r[0] for r in
                  MetadataStatus.select(['path'], db_info=self.db_info)]
         self._cancel_processing_paths(paths)
@@ -1348,20 +1921,51 @@ class MetadataManagerBase(signals.SignalEmitter):
             if status.net_lookup_enabled:
                 self.net_lookup_count -= 1
             self.total_count -= 1
+            cache_entry = MetadataCacheEntry.get_for_path(
+                self._translate_path(path))
             for entry in MetadataEntry.metadata_for_status(status,
                                                            self.db_info):
-                if entry.screenshot is not None:
+                if (entry.screenshot is not None and
+                        (cache_entry is None or
+                         cache_entry.screenshot != entry.screenshot)):
+                    # keep screenshots that are in the cache, in case the
+                    # file gets added again.
                     self.remove_screenshot(entry.screenshot)
+                if entry.source == 'mutagen' and entry.album is not None:
+                    self._removed_albums.add(entry.album)
                 entry.remove()
             status.remove()
             if status.current_processor is not None:
                 self.count_tracker.file_finished(path)
+        if self._removed_albums:
+            # wait until we're idle, so that the removals are in the database
+            # even if we're in the middle of a bulk SQL operation.
+            self._remove_cover_art_caller.call_when_idle()
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
         self._send_net_lookup_counts_caller.call_when_idle()
 
     def remove_screenshot(self, screenshot):
         fileutil.delete(screenshot)
 
+    def _remove_unused_cover_art(self):
+        """Remove cover art files for albums that no file uses anymore.
+
+        Cover art files are shared by all files with the same mutagen album,
+        so the mutagen entries work like a reference count on the file.
+        """
+        if self.closed:
+            return
+        for album in self._removed_albums:
+            if MetadataEntry.mutagen_album_count(album, self.db_info):
+                continue
+            filename = filetags.calc_cover_art_filename(album)
+            path = os.path.join(self.cover_art_dir, filename)
+            if MetadataCacheEntry.cover_art_count(path):
+                continue
+            if fileutil.exists(path):
+                coverart.remove_image(path)
+        self._removed_albums = set()
+
     def will_move_files(self, paths):
         """Prepare for files to be moved
 
@@ -1414,9 +2018,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         status = self._get_status_for_path(path)
 
         metadata = self._get_metadata_from_filename(path)
-        for entry in MetadataEntry.metadata_for_status(status, self.db_info):
-            entry_metadata = entry.get_metadata()
-            metadata.update(entry_metadata)
+        metadata.update(status.get_merged_metadata())
         metadata['has_drm'] = status.get_has_drm()
         metadata['net_lookup_enabled'] = status.net_lookup_enabled
         self._add_cover_art(metadata)
@@ -1470,7 +2072,9 @@ class MetadataManagerBase(signals.SignalEmitter):
             current_entry.update_metadata(user_data)
         except database.ObjectNotFoundError:
             # make a new entry if none exists
-            MetadataEntry(status, u'user-data', user_data, db_info=self.db_info)
+            current_entry = MetadataEntry(status, u'user-data', user_data,
+                                          db_info=self.db_info)
+        status.set_entry_metadata(current_entry)
 
     def set_net_lookup_enabled(self, paths, enabled):
         """Set if we should do an internet lookup for a list of paths
@@ -1560,20 +2164,22 @@ class MetadataManagerBase(signals.SignalEmitter):
     def restart_incomplete(self):
         """Restart extractors for files with incomplete metadata
 
-        This method queues calls to mutagen, movie data, etc.
+        This method queues calls to mutagen, movie data, etc.  We restart the
+        files in chunks of RESTART_CHUNK_SIZE.
         """
-        for id_ in self.restart_ids:
-            try:
-                status = MetadataStatus.get_by_id(id_, self.db_info)
-            except database.ObjectNotFoundError:
-                continue # just ignore deleted objects
-            self.run_next_processor(status)
-            # get_metadata() is sometimes more accurate than
-            # _get_metadata_from_filename() but slower.  Let's go for speed.
-            metadata = self._get_metadata_from_filename(status.path)
-            self.count_tracker.file_started(status.path, metadata)
-
+        self._restart_runner.add_ids(self.restart_ids)
         del self.restart_ids
+
+    def _restart_status(self, id_):
+        try:
+            status = MetadataStatus.get_by_id(id_, self.db_info)
+        except database.ObjectNotFoundError:
+            return # just ignore deleted objects
+        self.run_next_processor(status)
+        # get_metadata() is sometimes more accurate than
+        # _get_metadata_from_filename() but slower.  Let's go for speed.
+        metadata = self._get_metadata_from_filename(status.path)
+        self.count_tracker.file_started(status.path, metadata)
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
     def schedule_retry_net_lookup(self):
@@ -1587,36 +2193,47 @@ class MetadataManagerBase(signals.SignalEmitter):
         self._retry_net_lookup_caller.call_after_timeout(timeout)
 
     def retry_net_lookup(self):
-        """Re-download incomplete data from internet sources.  """
+        """Re-download incomplete data from internet sources.
+
+        We only select the ids for the entries up front, then restart them in
+        chunks of RESTART_CHUNK_SIZE.
+        """
         logging.info("Retrying incomplete internet lookups")
         self._retry_net_lookup_caller.cancel_call()
-        for entry in MetadataEntry.incomplete_echonest_view(self.db_info):
-            try:
-                status = MetadataStatus.get_by_id(entry.status_id,
-                                                  self.db_info)
-            except database.ObjectNotFoundError:
-                logging.warn("retry_net_lookup: MetadataStatus not found: %i",
-                             entry.status_id)
-                continue
-            # check that we aren't already running metadata lookups for the
-            # file
-            if status.current_processor is not None:
-                logging.warn("retry_net_lookup: current_processor is %s",
-                             status.current_processor)
-                continue
-            if not status.net_lookup_enabled:
-                continue
-            if status.path in self._retry_net_lookup_entries:
-                # already retrying
-                logging.info("retry_net_lookup: already retrying %r",
-                             status.path)
-                continue
-            self.count_tracker.file_net_lookup_restarted(status.path)
-            self._run_echonest(status.path, status.echonest_id)
-            self._retry_net_lookup_entries[status.path] = entry
-
+        self._retry_net_lookup_runner.cancel()
+        rows = MetadataEntry.incomplete_echonest_select(['id'], self.db_info)
+        self._retry_net_lookup_runner.add_ids(row[0] for row in rows)
         app.config.set(prefs.LAST_RETRY_NET_LOOKUP, int(time.time()))
 
+    def _retry_net_lookup_for_entry(self, entry_id):
+        try:
+            entry = MetadataEntry.get_by_id(entry_id, self.db_info)
+        except database.ObjectNotFoundError:
+            return # entry was deleted since retry_net_lookup() was called
+        try:
+            status = MetadataStatus.get_by_id(entry.status_id,
+                                              self.db_info)
+        except database.ObjectNotFoundError:
+            logging.warn("retry_net_lookup: MetadataStatus not found: %i",
+                         entry.status_id)
+            return
+        # check that we aren't already running metadata lookups for the
+        # file
+        if status.current_processor is not None:
+            logging.warn("retry_net_lookup: current_processor is %s",
+                         status.current_processor)
+            return
+        if not status.net_lookup_enabled:
+            return
+        if status.path in self._retry_net_lookup_entries:
+            # already retrying
+            logging.info("retry_net_lookup: already retrying %r",
+                         status.path)
+            return
+        self.count_tracker.file_net_lookup_restarted(status.path)
+        self._run_echonest(status.path, status.echonest_id)
+        self._retry_net_lookup_entries[status.path] = entry
+
     def retry_temporary_failures(self):
         app.bulk_sql_manager.start()
         try:
@@ -1633,10 +2250,55 @@ class MetadataManagerBase(signals.SignalEmitter):
         except database.ObjectNotFoundError:
             raise KeyError(path)
 
+    def _get_cached_result(self, path, source_name):
+        """Get a result from the MetadataCacheEntry for a file.
+
+        :param path: filesystem path to the file
+        :returns: result dict or None if there's nothing usable cached
+        """
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return None
+        if source_name == u'mutagen':
+            image_directory = self.cover_art_dir
+        else:
+            image_directory = self.screenshot_dir
+        for entry in MetadataCacheEntry.entries_for_file(path, stat.st_size,
+                                                         stat.st_mtime):
+            result = entry.get_result(source_name, path, image_directory)
+            if result is not None:
+                logging.debug("using cached %s result for %r", source_name,
+                              path)
+                entry.mark_used()
+                return result
+        return None
+
+    def _cache_result(self, path, source_name, result):
+        """Store a result in the MetadataCacheEntry for a path."""
+        path = self._translate_path(path)
+        try:
+            stat = os.stat(path)
+        except EnvironmentError:
+            return
+        try:
+            entry = MetadataCacheEntry.get_by_path(path)
+        except database.ObjectNotFoundError:
+            entry = MetadataCacheEntry(path, stat.st_size, stat.st_mtime)
+        else:
+            if (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime):
+                entry.file_changed(stat.st_size, stat.st_mtime)
+        entry.set_result(source_name, result)
+
     def _run_mutagen(self, path):
         """Run mutagen on a path."""
         self.check_image_directories()
         path = self._translate_path(path)
+        cached_result = self._get_cached_result(path, u'mutagen')
+        if cached_result is not None:
+            self._on_task_complete(self.mutagen_processor, path,
+                                   cached_result)
+            return
         task = workerprocess.MutagenTask(path, self.cover_art_dir)
         if not self.in_bulk_add():
             self.mutagen_processor.add_task(task)
@@ -1646,10 +2308,33 @@ class MetadataManagerBase(signals.SignalEmitter):
     def _run_movie_data(self, path):
         """Run the movie data program on a path."""
         self.check_image_directories()
+        duration = self._get_mutagen_duration(path)
         path = self._translate_path(path)
-        task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir)
+        cached_result = self._get_cached_result(path, u'movie-data')
+        if cached_result is not None:
+            self._on_task_complete(self.moviedata_processor, path,
+                                   cached_result)
+            return
+        task = workerprocess.MovieDataProgramTask(path, self.screenshot_dir,
+                                                  duration)
         self.moviedata_processor.add_task(task)
 
+    def _get_mutagen_duration(self, path):
+        """Get the duration that mutagen read from the file's headers.
+
+        :returns: duration in milliseconds, or None if mutagen didn't find
+            one
+        """
+        try:
+            status = self._get_status_for_path(path)
+        except KeyError:
+            return None
+        duration = status.get_source_metadata(u'mutagen').get('duration')
+        # a 0 duration usually means mutagen misidentified the file (#18840)
+        if not duration:
+            return None
+        return duration
+
     def _run_echonest(self, path, echonest_id=None):
         """Run echonest and other internet queries on a path."""
         self.check_image_directories()
@@ -1684,6 +2369,14 @@ class MetadataManagerBase(signals.SignalEmitter):
         self.metadata_errors.append((processor, path, error))
         self._run_update_caller.call_after_timeout(self.UPDATE_INTERVAL)
 
+    def _on_batch_complete(self, processor, batch):
+        # Process a batch of results right away.  This handles the entire
+        # batch in one transaction and sends one progress update for it.
+        # Single path batches come from files added one at a time, for those
+        # we keep waiting so that they get grouped together.
+        if len(batch.source_paths) > 1:
+            self._run_update_caller.call_now()
+
     def _get_metadata_from_filename(self, path):
         """Get metadata that we know from a filename alone."""
         return {
@@ -1751,6 +2444,8 @@ class MetadataManagerBase(signals.SignalEmitter):
                          processor.source_name)
             return
         self._make_new_metadata_entry(status, processor, path, result)
+        if processor.source_name in MetadataCacheEntry.source_info:
+            self._cache_result(path, processor.source_name, result)
         self.count_tracker.file_updated(path, result)
         self.run_next_processor(status)
         if status.current_processor == u'echonest':
@@ -1760,6 +2455,7 @@ class MetadataManagerBase(signals.SignalEmitter):
         if status.echonest_id is None and 'echonest_id' in result:
             status.set_echonest_id(result['echonest_id'])
         entry.update_metadata(result)
+        status.set_entry_metadata(entry)
         self.count_tracker.file_finished(path)
         self.new_metadata[path].update(result)
 
@@ -1775,6 +2471,7 @@ class MetadataManagerBase(signals.SignalEmitter):
             can_skip_get_metadata = True
         else:
             can_skip_get_metadata = False
+        status.set_entry_metadata(entry)
         status.update_after_success(entry, result)
         if can_skip_get_metadata:
             self.new_metadata[path].update(result)
@@ -1824,18 +2521,48 @@ class MetadataManagerBase(signals.SignalEmitter):
             self.count_tracker.file_finished(status.path)
 
     def _send_progress_updates(self):
-        for file_type in (u'audio', u'video'):
-            target = (u'library', file_type)
-            count_info = self.count_tracker.get_count_info(file_type)
+        """Schedule sending MetadataProgressUpdate messages to the frontend.
+
+        Calls get coalesced so that we send at most one round of updates
+        every PROGRESS_UPDATE_INTERVAL seconds.
+        """
+        self._send_progress_updates_caller.call_after_timeout(
+            self.PROGRESS_UPDATE_INTERVAL)
+
+    def _send_progress_updates_now(self):
+        """Send MetadataProgressUpdate messages for targets whose counts
+        changed since the last time we sent them.
+        """
+        if self.closed:
+            return
+        for target, count_info in self._get_progress_counts():
+            if self._sent_progress_counts.get(target) == count_info:
+                continue
+            self._sent_progress_counts[target] = count_info
             total, finished_local, finished = count_info
             eta = None
             msg = messages.MetadataProgressUpdate(target, finished,
                                                   finished_local, eta, total)
             msg.send_to_frontend()
 
+    def _get_progress_counts(self):
+        """Get the current progress counts.
+
+        :returns: list of (target, count_info) tuples
+        """
+        return [((u'library', file_type),
+                 self.count_tracker.get_count_info(file_type))
+                for file_type in (u'audio', u'video')]
+
 class LibraryMetadataManager(MetadataManagerBase):
     """MetadataManager for the user's audio/video library."""
 
+    def __init__(self, cover_art_dir, screenshot_dir, db_info=None):
+        MetadataManagerBase.__init__(self, cover_art_dir, screenshot_dir,
+                                     db_info)
+        echonest.ResponseCacheEntry.remove_expired(self.db_info)
+        MetadataCacheEntry.remove_old()
+
     def make_count_tracker(self):
         return LibraryProgressCountTracker()
 
@@ -1891,14 +2618,9 @@ class DeviceMetadataManager(MetadataManagerBase):
         else:
             raise ValueError("%s is not relative to %s" % (path, self.mount))
 
-    def _send_progress_updates(self):
+    def _get_progress_counts(self):
         target = (u'device', self.device_id)
-        count_info = self.count_tracker.get_count_info()
-        total, finished_local, finished = count_info
-        eta = None
-        msg = messages.MetadataProgressUpdate(target, finished,
-                                              finished_local, eta, total)
-        msg.send_to_frontend()
+        return [(target, self.count_tracker.get_count_info())]
 
     def _send_net_lookup_counts(self):
         # This isn't supported for devices yet
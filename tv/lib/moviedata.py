@@ -78,15 +78,18 @@ def _make_screenshot_path(source_path, image_directory):
     # open is not an option.  We'll just have to live with the race condition
     return download_utils.next_free_filename(path)
 
-def process_file(source_path, image_directory):
+def process_file(source_path, image_directory, duration=None):
     """Send a file to the movie data program.
 
     :param source_path: path to the file to process
     :param image_directory: directory to put screenshut files
+    :param duration: duration in milliseconds if we already know it (for
+        example from mutagen).  The extractor will use it instead of
+        calculating the duration itself.
     :returns: dictionary with metadata info
     """
     screenshot, fp = _make_screenshot_path(source_path, image_directory)
-    result = run_media_metadata_extractor(source_path, screenshot)
+    result = run_media_metadata_extractor(source_path, screenshot, duration)
     # we can close the file now, since MDP has written to it
     fp.close()
     return convert_mdp_result(source_path, screenshot, result)
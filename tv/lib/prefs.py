@@ -79,6 +79,10 @@ UPSTREAM_LIMIT_IN_KBS       = Pref(key='upstreamLimitInKBS',    default=12,    p
 UPSTREAM_TORRENT_LIMIT      = Pref(key='upstreamTorrentLimit',  default=10,    platformSpecific=False)
 LIMIT_DOWNSTREAM_BT         = Pref(key='limitDownstreamBT',     default=False, platformSpecific=False)
 DOWNSTREAM_BT_LIMIT_IN_KBS  = Pref(key='downstreamBTLimitInKBS', default=200,   platformSpecific=False)
+LIMIT_DOWNSTREAM_HTTP       = Pref(key='limitDownstreamHTTP',   default=False, platformSpecific=False)
+DOWNSTREAM_HTTP_LIMIT_IN_KBS = Pref(key='downstreamHTTPLimitInKBS', default=200, platformSpecific=False)
+HTTP_SEGMENTED_DOWNLOADS    = Pref(key='httpSegmentedDownloads', default=False, platformSpecific=False)
+HTTP_SEGMENT_COUNT          = Pref(key='httpSegmentCount',      default=3,     platformSpecific=False)
 LIMIT_CONNECTIONS_BT        = Pref(key='limitConnectionsBT',     default=False, platformSpecific=False)
 CONNECTION_LIMIT_BT_NUM     = Pref(key='connectionLimitBTNum', default=100,   platformSpecific=False)
 PRESERVE_DISK_SPACE         = Pref(key='preserveDiskSpace',     default=True,  platformSpecific=False)
@@ -368,6 +368,7 @@ class NoObjectSchema(object):
 from miro.database import DDBObject
 from miro.databaselog import DBLogEntry
 from miro.downloader import RemoteDownloader
+from miro.echonest import ResponseCacheEntry
 from miro.feed import (Feed, FeedImpl, RSSFeedImpl, SavedSearchFeedImpl,
                        ScraperFeedImpl)
 from miro.feed import (SearchFeedImpl, DirectoryWatchFeedImpl,
@@ -378,7 +379,8 @@ from miro.folder import (HideableTab, ChannelFolder, PlaylistFolder,
 from miro.guide import ChannelGuide
 from miro.item import Item, FileItem, DeviceItem, SharingItem
 from miro.iconcache import IconCache
-from miro.metadata import MetadataStatus, MetadataEntry
+from miro.metadata import (MetadataStatus, MetadataEntry,
+                           MetadataCacheEntry)
 from miro.playlist import SavedPlaylist, PlaylistItemMap
 from miro.tabs import TabOrder
 from miro.theme import ThemeHistory
@@ -653,6 +655,7 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('entries_digest', SchemaString(noneOk=True)),
     ]
 
 class SavedSearchFeedImplSchema(FeedImplSchema):
@@ -950,6 +953,7 @@ class MetadataStatusSchema(DDBObjectSchema):
         ('net_lookup_enabled', SchemaBool()),
         ('mutagen_thinks_drm', SchemaBool()),
         ('max_entry_priority', SchemaInt()),
+        ('entry_metadata', SchemaReprContainer(noneOk=True)),
     ]
 
     indexes = (
@@ -998,7 +1002,49 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+class MetadataCacheEntrySchema(DDBObjectSchema):
+    klass = MetadataCacheEntry
+    table_name = 'metadata_cache'
+    fields = DDBObjectSchema.fields + [
+        ('path', SchemaFilename()),
+        ('size', SchemaInt()),
+        ('mtime', SchemaFloat()),
+        ('last_used', SchemaFloat()),
+        ('partial_hash', SchemaString(noneOk=True)),
+        ('mutagen', SchemaReprContainer(noneOk=True)),
+        ('movie_data', SchemaReprContainer(noneOk=True)),
+        ('cover_art', SchemaFilename(noneOk=True)),
+        ('screenshot', SchemaFilename(noneOk=True)),
+    ]
+
+    indexes = (
+        ('metadata_cache_size', ('size',)),
+        ('metadata_cache_last_used', ('last_used',)),
+        ('metadata_cache_cover_art', ('cover_art',)),
+    )
+
+    unique_indexes = (
+        ('metadata_cache_path', ('path',)),
+    )
+
+class ResponseCacheEntrySchema(DDBObjectSchema):
+    klass = ResponseCacheEntry
+    table_name = 'echonest_response_cache'
+    fields = DDBObjectSchema.fields + [
+        ('key', SchemaString()),
+        ('body', SchemaBinary()),
+        ('expires', SchemaFloat()),
+    ]
+
+    indexes = (
+        ('echonest_response_cache_expires', ('expires',)),
+    )
+
+    unique_indexes = (
+        ('echonest_response_cache_key', ('key',)),
+    )
+
+VERSION = 206
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
@@ -1011,7 +1057,7 @@ object_schemas = [
     PlaylistItemMapSchema, PlaylistFolderItemMapSchema,
     TabOrderSchema, ThemeHistorySchema, DisplayStateSchema, GlobalStateSchema,
     DBLogEntrySchema, ViewStateSchema, MetadataStatusSchema,
-    MetadataEntrySchema
+    MetadataEntrySchema, MetadataCacheEntrySchema, ResponseCacheEntrySchema
 ]
 
 device_object_schemas = [
@@ -45,6 +45,7 @@ import os
 import struct
 import subprocess
 import sys
+import tempfile
 import threading
 import trapcall
 import warnings
@@ -73,7 +74,15 @@ def _on_windows():
 #
 # We spawn a child process and communicate to it by sending messages through
 # it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# and a kind byte followed by a pickled object.  If the pickle is bigger than
+# OUT_OF_BAND_THRESHOLD, we write it to a temporary file and the data is the
+# path of that file instead.  The reader loads the pickle from the file, then
+# deletes it.  This keeps big things like feed data from clogging up the
+# pipes.
+#
+# The main process sends messages from the eventloop.  Rather than write
+# and flush each one separately, we buffer them up and write them all out in
+# an idle callback.
 #
 # The communication goes like this:
 #
@@ -261,7 +270,13 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("Q")
+HEADER_FORMAT = "QB"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# values for the kind field of the header
+MESSAGE_INLINE = 0
+MESSAGE_OUT_OF_BAND = 1
+# pickles bigger than this get sent through a temporary file
+OUT_OF_BAND_THRESHOLD = 256 * 1024
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -292,15 +307,19 @@ def _load_obj(pipe):
 
     :returns: Python object send from the other side
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
+    header_data = _read_bytes_from_pipe(pipe, HEADER_SIZE)
+    if len(header_data) < HEADER_SIZE:
         raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
+                "(read %s bytes)" % len(header_data))
+    size, kind = struct.unpack(HEADER_FORMAT, header_data)
     pickle_data = _read_bytes_from_pipe(pipe, size)
     if len(pickle_data) < size:
         raise LoadError("EOF reached while reading pickle data "
                 "(read %s bytes)" % len(pickle_data))
+    if kind == MESSAGE_OUT_OF_BAND:
+        pickle_data = _read_out_of_band_data(pickle_data)
+    elif kind != MESSAGE_INLINE:
+        raise LoadError("Unknown message kind: %s" % kind)
     try:
         return pickle.loads(pickle_data)
     except pickle.PickleError:
@@ -312,6 +331,75 @@ def _load_obj(pipe):
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
 
+def _read_out_of_band_data(path):
+    """Read pickle data that was sent through a temporary file.
+
+    The file gets deleted once we've read it.
+    """
+    try:
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+            os.remove(path)
+    except (IOError, OSError), e:
+        raise LoadError("Error reading out of band data from %r: %s" %
+                (path, e))
+
+def _write_out_of_band_data(pickle_data):
+    """Write pickle data to a temporary file.
+
+    :returns: path to the file
+    """
+    fd, path = tempfile.mkstemp(prefix='miro-message-')
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(pickle_data)
+    finally:
+        f.close()
+    return path
+
+def _discard_encoded_data(data):
+    """Cleanup after encoded messages that we aren't going to send.
+
+    This deletes the temporary files for out of band messages.  Normally the
+    reader does this, but it won't get the chance if the messages never make
+    it through the pipe.
+
+    :param data: string holding messages from _encode_obj()
+    """
+    pos = 0
+    while pos + HEADER_SIZE <= len(data):
+        size, kind = struct.unpack(HEADER_FORMAT,
+                data[pos:pos+HEADER_SIZE])
+        pos += HEADER_SIZE
+        if kind == MESSAGE_OUT_OF_BAND:
+            try:
+                os.remove(data[pos:pos+size])
+            except OSError:
+                # the reader may have already gotten to it
+                pass
+        pos += size
+
+def _encode_obj(obj):
+    """Encode an object to send over a pipe.
+
+    :raises pickle.PickleError: obj could not be pickled
+    :returns: string to write to the pipe
+    """
+    pickle_data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    kind = MESSAGE_INLINE
+    if len(pickle_data) > OUT_OF_BAND_THRESHOLD:
+        try:
+            pickle_data = _write_out_of_band_data(pickle_data)
+        except (IOError, OSError):
+            logging.warn("Error writing out of band data, sending it "
+                         "through the pipe", exc_info=True)
+        else:
+            kind = MESSAGE_OUT_OF_BAND
+    return struct.pack(HEADER_FORMAT, len(pickle_data), kind) + pickle_data
+
 def _dump_obj(obj, pipe):
     """Dump an object to the other side of the pipe.
 
@@ -319,16 +407,20 @@ def _dump_obj(obj, pipe):
     :raises pickle.PickleError: obj could not be pickled
     """
 
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("Q", len(pickle_data))
+    _write_to_pipe(pipe, _encode_obj(obj))
+
+def _write_to_pipe(pipe, data):
+    """Write encoded messages to a pipe and flush it.
+
+    :raises IOError: low-level error while writing to the pipe
+    """
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
     # pushing the data into a Queue.  However, there's some chance that the
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    pipe.write(data)
     pipe.flush()
 
 class SubprocessManager(object):
@@ -368,6 +460,9 @@ class SubprocessManager(object):
         self.thread = None
         self.start_time = 0
         self.restart_delay = restart_delay
+        # encoded messages waiting for flush_messages() to write them
+        self.write_buffer = []
+        self.flush_scheduled = False
 
     # Process management
 
@@ -462,7 +557,8 @@ class SubprocessManager(object):
             #
             # So if the self.thread attribute is None then it means we are done
             # and so things are all good.
-            if self.thread is not None and thread.quit_type != thread.QUIT_NORMAL:
+            if (self.thread is not None and not thread.detached and
+                    thread.quit_type != thread.QUIT_NORMAL):
                 msg = ('_on_thread_quit called by an old thread '
                         'self.thread: %s thread: %s quit_type: %s' %
                         (self.thread.name, thread.name, thread.quit_type))
@@ -509,27 +605,53 @@ class SubprocessManager(object):
         self.thread = None
         self.process = None
         self.is_running = False
+        # anything left in our buffer was meant for the old process
+        _discard_encoded_data(''.join(self.write_buffer))
+        self.write_buffer = []
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        The message gets buffered and written out along with any other
+        messages sent in the meantime when flush_messages() runs.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            self.write_buffer.append(_encode_obj(msg))
+        except pickle.PickleError:
+            logging.warn("Error pickling message in send_message() (%s)", msg)
+            return
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            eventloop.add_idle(self.flush_messages, 'flush subprocess messages')
+
+    def flush_messages(self):
+        """Write out all the messages buffered by send_message()."""
+        self.flush_scheduled = False
+        if not self.write_buffer:
+            return
+        data = ''.join(self.write_buffer)
+        self.write_buffer = []
+        if not self.is_running:
+            _discard_encoded_data(data)
+            return
+        try:
+            _write_to_pipe(self.process.stdin, data)
         except IOError:
-            logging.warn("Broken pipe in send_message()")
+            logging.warn("Broken pipe in flush_messages()")
+            _discard_encoded_data(data)
             # we could try to restart our subprocess here, but if the pipe is
             # really broken, then our thread will quit soon and this will
             # cause a restart.
-        except pickle.PickleError:
-            logging.warn("Error pickling message in send_message() (%s)", msg)
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_messages()
         self.sent_quit = True
 
     def _send_startup_info(self):
@@ -598,11 +720,22 @@ class SubprocessResponderThread(threading.Thread):
         self.responder = responder
         self.quit_callback = quit_callback
         self.quit_type = None
+        self.detached = False
+
+    def detach(self):
+        """Stop passing messages to our responder.
+
+        Call this when we give up on a subprocess and start a new one, so
+        that anything left in the old pipe doesn't get handled as if it came
+        from the new process.
+        """
+        self.detached = True
 
     def run(self):
         try:
             for msg in _read_from_pipe(self.subprocess_stdout):
-                self.responder.handle(msg)
+                if not self.detached:
+                    self.responder.handle(msg)
         except LoadError, e:
             logging.warn("Quiting from bad data from our subprocess in "
                     "SubprocessResponderThread: %s", e)
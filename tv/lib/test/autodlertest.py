@@ -0,0 +1,113 @@
+from miro import app
+from miro import autodler
+from miro import prefs
+from miro.test.framework import MiroTestCase
+
+class FakeItem(object):
+    def __init__(self, feed):
+        self.feed = feed
+
+    def get_feed(self):
+        return self.feed
+
+class FakeFeed(object):
+    def __init__(self, id_, downloader, started):
+        self.id = id_
+        self.orig_url = u'http://example.com/feed%d' % id_
+        self.downloader = downloader
+        self.started = started
+        self.pending = []
+        self.max_new = "unlimited"
+
+    def id_exists(self):
+        return True
+
+    def get_max_new(self):
+        return self.max_new
+
+    def num_unwatched(self):
+        return 0
+
+    def add_pending(self):
+        item = FakeItem(self)
+        self.pending.append(item)
+        self.downloader.pending_on_add(None, item)
+
+    def start_manual_download(self):
+        if self.pending:
+            item = self.pending.pop()
+            self.downloader.pending_on_remove(None, item)
+            self.downloader.running_on_add(None, item)
+            self.started.append(self.id)
+
+    start_auto_download = start_manual_download
+
+class AutoDownloaderTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.MAX_MANUAL_DOWNLOADS, 4)
+        self.downloader = autodler.Downloader(False)
+        # don't start downloads from an idle callback, we call
+        # start_downloads_idle() ourselves.
+        self.downloader.paused = True
+        self.started = []
+
+    def make_feed(self, id_, pending_count):
+        feed = FakeFeed(id_, self.downloader, self.started)
+        for i in xrange(pending_count):
+            feed.add_pending()
+        return feed
+
+    def start_downloads(self):
+        self.downloader.paused = False
+        self.downloader.start_downloads_idle()
+        self.downloader.paused = True
+
+    def test_round_robin(self):
+        self.make_feed(1, 3)
+        self.make_feed(2, 1)
+        self.make_feed(3, 2)
+        self.start_downloads()
+        # feeds with the fewest running downloads should go first, then the
+        # ones that we haven't started a download for in the longest time.
+        self.assertEquals(self.started, [1, 2, 3, 1])
+        self.assertEquals(self.downloader.running_count, 4)
+        self.assertEquals(self.downloader.pending_count, 2)
+
+    def test_running_download_finishes(self):
+        self.make_feed(1, 4)
+        feed2 = self.make_feed(2, 1)
+        self.start_downloads()
+        self.assertEquals(self.started, [1, 2, 1, 1])
+        # feed 2 doesn't have anything pending, so feed 1 should get the
+        # open slot when a download finishes.
+        self.downloader.running_on_remove(None, FakeItem(feed2))
+        self.start_downloads()
+        self.assertEquals(self.started, [1, 2, 1, 1, 1])
+        self.assertEquals(self.downloader.pending_count, 0)
+
+    def test_nothing_to_start(self):
+        feed = self.make_feed(1, 2)
+        # if a feed can't start anything, we should give up on it until it
+        # gets another pending item.
+        feed.pending = []
+        self.start_downloads()
+        self.assertEquals(self.started, [])
+        feed.add_pending()
+        self.start_downloads()
+        self.assertEquals(self.started, [1])
+
+    def test_max_new(self):
+        # feeds that have max_new unwatched items shouldn't start auto
+        # downloads
+        self.downloader = autodler.Downloader(True)
+        self.downloader.paused = True
+        feed = self.make_feed(1, 2)
+        feed.max_new = 1
+        self.downloader.new_on_add(None, FakeItem(feed))
+        self.start_downloads()
+        self.assertEquals(self.started, [])
+        # once the item gets watched, we can start a download
+        self.downloader.new_on_remove(None, FakeItem(feed))
+        self.start_downloads()
+        self.assertEquals(self.started, [1])
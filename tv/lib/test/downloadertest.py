@@ -133,6 +133,31 @@ class DownloaderTest(MiroTestCase):
         self.item.expire()
         self.assertEquals(self.feed.downloaded_items.count(), 0)
 
+    def test_status_delta(self):
+        self.start_download()
+        dl = self.item.downloader
+        update_status_delta = downloader.RemoteDownloader.update_status_delta
+        self.assert_(update_status_delta({
+            'dlid': self.dlid,
+            'state': u'downloading',
+            'total_size': 1000,
+            'current_size': 100,
+            'rate': 10,
+            'filename': self.downloading_path,
+            'type': 'HTTP',
+        }, cmd_done=True))
+        # a delta with just the progress should keep the other fields
+        self.assert_(update_status_delta({
+            'dlid': self.dlid,
+            'current_size': 200,
+            'rate': 20,
+        }))
+        self.assertEquals(dl.current_size, 200)
+        self.assertEquals(dl.rate, 20)
+        self.assertEquals(dl.total_size, 1000)
+        self.assertEquals(dl.filename, self.downloading_path)
+        self.assertEquals(dl.changed_attributes, set())
+
     ## def test_resume(self):
     ##     # FIXME - implement this
     ##     pass
@@ -1,52 +1,95 @@
-import errno
-import sys
 import os
-import tempfile
-import shutil
 
-from miro import prefs
-from miro import app
 from miro.test.framework import MiroTestCase
-from miro.dl_daemon.download import (save_fast_resume_data,
-                                     load_fast_resume_data,
-                                     generate_fast_resume_filename)
+from miro.dl_daemon.fastresume import FastResumeStore
 
 FAKE_INFO_HASH = 'PINKPASTA'
-FAKE_RESUME_DATA = 'BEER'
-  
+FAKE_RESUME_DATA = {'pasta': 'pink'}
+FAKE_RESUME_DATA_BENCODED = 'd5:pasta4:pinke'
+
 class FastResumeTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'fastresume.sqlite')
+        self.legacy_dir = os.path.join(self.tempdir, 'fastresume')
+        self.store = self.open_store()
+
+    def tearDown(self):
+        self.store.stop()
+        MiroTestCase.tearDown(self)
+
+    def open_store(self):
+        store = FastResumeStore()
+        store.open(self.path, legacy_dir=self.legacy_dir)
+        return store
+
+    def reopen_store(self):
+        self.store.stop()
+        self.store = self.open_store()
+
     # test_resume_data: Test easy load/store.
     def test_resume_data(self):
-        save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
-        data = load_fast_resume_data(FAKE_INFO_HASH)
-        self.assertEquals(FAKE_RESUME_DATA, data)
-
-    # Precreate the file but lock down the file so the file open fails.
-    def test_save_fast_resume_data_bad(self):
-        # Grab the filename that will be used
-        filename = generate_fast_resume_filename(FAKE_INFO_HASH)
-        # Create the file
-        os.makedirs(os.path.dirname(filename))
-        f = open(filename, 'wb')
-        f.close()
-        os.chmod(filename, 0)
-        with self.allow_warnings():
-            save_fast_resume_data(FAKE_INFO_HASH, FAKE_RESUME_DATA)
-        # We did not lock down the directory so check save_fast_resume_data
-        # nuked the file for us.
-        self.assertFalse(os.path.exists(filename))
-
-    # Try to load a unreadable file so the load fails.
-    def test_load_fast_resume_data_bad(self):
-        # Grab the filename that will be used
-        filename = generate_fast_resume_filename(FAKE_INFO_HASH)
-        # Create the file
-        os.makedirs(os.path.dirname(filename))
-        f = open(filename, 'wb')
+        self.store.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.assertEquals(self.store.load(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA_BENCODED)
+        self.reopen_store()
+        self.assertEquals(self.store.load(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA_BENCODED)
+
+    def test_remove(self):
+        self.store.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.store.save('OTHERHASH', FAKE_RESUME_DATA)
+        self.store.remove(FAKE_INFO_HASH)
+        self.assertEquals(self.store.load(FAKE_INFO_HASH), None)
+        self.reopen_store()
+        self.assertEquals(self.store.load(FAKE_INFO_HASH), None)
+        self.assertEquals(self.store.load('OTHERHASH'),
+                          FAKE_RESUME_DATA_BENCODED)
+
+    def test_writer_thread(self):
+        self.store.start()
+        self.store.save(FAKE_INFO_HASH, {'pasta': 'green'})
+        self.store.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.store.save('OTHERHASH', FAKE_RESUME_DATA)
+        self.store.remove('OTHERHASH')
+        # stop() should finish writing everything
+        self.reopen_store()
+        self.assertEquals(self.store.load(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA_BENCODED)
+        self.assertEquals(self.store.load('OTHERHASH'), None)
+
+    def test_load_before_write(self):
+        # load() should see saves and removes that the writer thread hasn't
+        # gotten to yet
+        self.store.start()
+        self.store.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.assertEquals(self.store.load(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA_BENCODED)
+        self.store.remove(FAKE_INFO_HASH)
+        self.assertEquals(self.store.load(FAKE_INFO_HASH), None)
+
+    def test_migrate(self):
+        self.store.stop()
+        # write data the way older versions did
+        os.makedirs(self.legacy_dir)
+        f = open(os.path.join(self.legacy_dir,
+                              FAKE_INFO_HASH + '.fastresume'), 'wb')
+        f.write('BEER')
         f.close()
-        old_mode = os.stat(filename).st_mode
-        os.chmod(filename, 0)
+        self.store = self.open_store()
+        self.assertEquals(self.store.load(FAKE_INFO_HASH), 'BEER')
+        self.assertFalse(os.path.exists(self.legacy_dir))
+        self.reopen_store()
+        self.assertEquals(self.store.load(FAKE_INFO_HASH), 'BEER')
+
+    # Try to open a database where we can't so the open fails.
+    def test_open_bad(self):
+        self.store.stop()
+        self.path = self.tempdir
         with self.allow_warnings():
-            data = load_fast_resume_data(FAKE_INFO_HASH)
-        self.assertEquals(data, None)
-        os.chmod(filename, old_mode)
+            self.store = self.open_store()
+        self.assertEquals(self.store.connection, None)
+        # we should still be able to save data for this run
+        self.store.save(FAKE_INFO_HASH, FAKE_RESUME_DATA)
+        self.assertEquals(self.store.load(FAKE_INFO_HASH),
+                          FAKE_RESUME_DATA_BENCODED)
@@ -126,6 +126,105 @@ class FeedParserTest(MiroTestCase):
             d = d['bozo_exception']
         self.eq_output(pprint.pformat(d), output)
 
+def _make_feed(entry_count, first_entry=0, dated=True):
+    """Make an RSS feed with entry_count entries, newest first."""
+    parts = ["""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Incremental Feed</title>
+      <link>http://example.com/</link>
+"""]
+    for i in reversed(xrange(first_entry, first_entry + entry_count)):
+        if dated:
+            pub_date = ("<pubDate>Mon, %02d Jan 2011 %02d:00:00 GMT</pubDate>"
+                        % (1 + i // 24, i % 24))
+        else:
+            pub_date = ""
+        parts.append("""<item>
+ <title>Entry %d</title>
+ <guid>entry-%d</guid>
+ %s
+ <enclosure url="http://example.com/%d.mpg" type="video/mpeg" />
+</item>
+""" % (i, i, pub_date, i))
+    parts.append("""   </channel>
+</rss>""")
+    return "".join(parts)
+
+class IncrementalParseTest(MiroTestCase):
+    def test_full_parse(self):
+        parsed = feedparserutil.parse(_make_feed(10))
+        self.assertEquals(len(parsed['entries']), 10)
+        self.assertEquals(len(parsed['entry_fingerprints']), 10)
+        self.assertEquals(len(set(parsed['entry_fingerprints'])), 10)
+        self.assertFalse(parsed.get('incremental', False))
+        # the digest shouldn't depend on things like the build date
+        parsed2 = feedparserutil.parse(_make_feed(10).replace(
+            "<link>", "<lastBuildDate>Mon, 01 Jan 2011 00:00:00 GMT"
+            "</lastBuildDate><link>"))
+        self.assertEquals(parsed['entries_digest'], parsed2['entries_digest'])
+
+    def test_new_entries(self):
+        known = set(feedparserutil.parse(_make_feed(10))['entry_fingerprints'])
+        parsed = feedparserutil.parse(_make_feed(12), known)
+        self.assert_(parsed['incremental'])
+        self.assertEquals([e['id'] for e in parsed['entries']],
+                          [u'entry-11', u'entry-10'])
+        self.assertEquals(len(parsed['entry_fingerprints']), 2)
+        # release times cover the known entries too
+        self.assertEquals(len(parsed['release_times']), 12)
+        # we looked at every entry, so we can calculate entries_digest
+        self.assertEquals(parsed['entries_digest'],
+                feedparserutil.parse(_make_feed(12))['entries_digest'])
+
+    def test_changed_entry(self):
+        known = set(feedparserutil.parse(_make_feed(10))['entry_fingerprints'])
+        feed = _make_feed(10).replace("<title>Entry 5</title>",
+                                      "<title>New Title</title>")
+        parsed = feedparserutil.parse(feed, known)
+        self.assertEquals([e['id'] for e in parsed['entries']],
+                          [u'entry-5'])
+
+    def test_stop_after(self):
+        known = set(feedparserutil.parse(_make_feed(50))['entry_fingerprints'])
+        parsed = feedparserutil.parse(_make_feed(52), known, stop_after=5)
+        self.assertEquals(len(parsed['entries']), 2)
+        # we didn't look at all entries, so we can't calculate entries_digest
+        self.assertEquals(parsed['entries_digest'], None)
+
+    def test_stop_after_needs_dates(self):
+        feed = _make_feed(50, dated=False)
+        known = set(feedparserutil.parse(feed)['entry_fingerprints'])
+        feed = _make_feed(50, dated=False).replace(
+                "<title>Entry 0</title>", "<title>New Title</title>")
+        parsed = feedparserutil.parse(feed, known, stop_after=5)
+        # The feed isn't ordered by date, so we should have looked at every
+        # entry.
+        self.assertEquals([e['id'] for e in parsed['entries']],
+                          [u'entry-0'])
+        self.assertNotEquals(parsed['entries_digest'], None)
+
+class SkipHoursTest(MiroTestCase):
+    def test_skip_hours(self):
+        feed = _make_feed(5).replace("<link>", """<skipHours>
+   <hour>2</hour>
+   <hour> 3 </hour>
+   <hour>14</hour>
+</skipHours>
+<link>""")
+        self.assertEquals(feedparserutil.parse(feed)['skip_hours'],
+                          [2, 3, 14])
+        path = os.path.join(self.tempdir, 'skiphours.rss')
+        f = open(path, 'wb')
+        f.write(feed)
+        f.close()
+        self.assertEquals(feedparserutil.parse_file(path)['skip_hours'],
+                          [2, 3, 14])
+
+    def test_no_skip_hours(self):
+        self.assertEquals(feedparserutil.parse(_make_feed(5))['skip_hours'],
+                          [])
+
 class FeedParserValuesTest(unittest.TestCase):
     def test_empty(self):
         fpv = FeedParserValues({})
@@ -5,11 +5,13 @@ from time import sleep
 from miro import app
 from miro import prefs
 from miro import dialogs
+from miro import feed
 from miro import feedparserutil
 from miro.item import Item
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
 
-from miro.test.framework import MiroTestCase, EventLoopTest
+from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
+from miro.test.feedparsertest import _make_feed
 
 class FakeDownloader(object):
     def __init__(self):
@@ -251,6 +253,90 @@ jalabel_nov28.jpg" />
         self.assertEqual(len(items), 4)
         my_feed.remove()
 
+    def test_title_changed(self):
+        my_feed = self.make_feed()
+        # Items without a guid should get matched by their enclosure, even if
+        # their title changes.
+        content = open(self.filename).read()
+        self.write_file(content.replace("<title>Bumper Sticker</title>",
+                                        "<title>New Sticker</title>"))
+        self.update_feed(my_feed)
+        items = list(Item.make_view())
+        self.assertEqual(len(items), 4)
+        titles = set(i.entry_title for i in items)
+        self.assert_(u"New Sticker" in titles)
+        self.assert_(u"Bumper Sticker" not in titles)
+
+class UnchangedFeedBodyTest(EventLoopTest):
+    # Test that we skip work when the server sends the same feed again.  The
+    # test HTTP server ignores the etag and modified headers that we send.
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.start_http_server()
+        self.url = unicode(self.httpserver.build_url('feed.xml'))
+        self.old_counts = feed.unchanged_feed_counts.copy()
+
+    def unchanged_count(self, key):
+        return feed.unchanged_feed_counts[key] - self.old_counts[key]
+
+    def wait_for_update(self, my_feed):
+        handle = my_feed.connect('update-finished',
+                lambda f: self.stopEventLoop(abnormal=False))
+        self.runEventLoop(timeout=5)
+        my_feed.disconnect(handle)
+
+    @uses_httpclient
+    def test_unchanged_body(self):
+        my_feed = Feed(self.url)
+        self.wait_for_update(my_feed)
+        self.assertEquals(my_feed.items.count(), 2)
+        # The first update has a new body, but the same entries
+        my_feed.update()
+        self.wait_for_update(my_feed)
+        self.assertEquals(self.unchanged_count('entries'), 1)
+        self.assertEquals(self.unchanged_count('body'), 0)
+        # The second update has the same body, we shouldn't parse it
+        my_feed.update()
+        self.wait_for_update(my_feed)
+        self.assertEquals(self.unchanged_count('entries'), 1)
+        self.assertEquals(self.unchanged_count('body'), 1)
+        self.assertEquals(my_feed.items.count(), 2)
+        # clean_old_items() should force a full update
+        my_feed.actualFeed.clean_old_items()
+        self.wait_for_update(my_feed)
+        self.assertEquals(self.unchanged_count('entries'), 1)
+        self.assertEquals(self.unchanged_count('body'), 1)
+
+class IncrementalFeedUpdateTest(FeedTestCase):
+    # Test that we only get new entries back for big feeds
+    def test_incremental_update(self):
+        entry_count = feed.INCREMENTAL_MIN_ENTRIES
+        self.write_file(_make_feed(entry_count))
+        my_feed = self.make_feed()
+        self.assertEquals(my_feed.items.count(), entry_count)
+        self.write_file(_make_feed(entry_count + 2))
+        self.update_feed(my_feed)
+        parsed = my_feed.actualFeed.parsed
+        self.assert_(parsed['incremental'])
+        self.assertEquals(len(parsed.entries), 2)
+        self.assertEquals(my_feed.items.count(), entry_count + 2)
+
+    def test_full_update(self):
+        # Every MAX_INCREMENTAL_UPDATES updates we should parse the entire
+        # feed.
+        entry_count = feed.INCREMENTAL_MIN_ENTRIES
+        self.write_file(_make_feed(entry_count))
+        my_feed = self.make_feed()
+        for i in xrange(feed.MAX_INCREMENTAL_UPDATES):
+            self.write_file(_make_feed(entry_count, first_entry=i + 1))
+            self.update_feed(my_feed)
+            self.assert_(my_feed.actualFeed.parsed['incremental'])
+        self.write_file(_make_feed(entry_count, first_entry=i + 2))
+        self.update_feed(my_feed)
+        parsed = my_feed.actualFeed.parsed
+        self.assertFalse(parsed.get('incremental', False))
+        self.assertEquals(len(parsed.entries), entry_count)
+
 class OldItemExpireTest(FeedTestCase):
     # Test that old items expire when the feed gets too big
     def setUp(self):
@@ -0,0 +1,120 @@
+import time
+
+from miro import feedupdate
+from miro.test.framework import MiroTestCase
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+class FakeFeed(object):
+    def __init__(self, id_):
+        self.id = id_
+
+    def get_title(self):
+        return u'Feed %d' % self.id
+
+class FeedUpdateQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.feed = FakeFeed(1)
+        self.now = time.time()
+        # make calc_delay() deterministic
+        self.old_jitter = feedupdate.JITTER_FRACTION
+        feedupdate.JITTER_FRACTION = 0
+
+    def tearDown(self):
+        feedupdate.JITTER_FRACTION = self.old_jitter
+        MiroTestCase.tearDown(self)
+
+    def calc_delay(self, update_freq=HOUR):
+        return self.queue.calc_delay(self.feed, update_freq, now=self.now)
+
+    def test_unknown_feed(self):
+        self.assertEquals(self.calc_delay(), HOUR)
+
+    def test_unchanged_backoff(self):
+        self.queue.record_response(self.feed, {'status': 304})
+        self.assertEquals(self.calc_delay(), HOUR * 1.5)
+        self.queue.record_response(self.feed, {'status': 304})
+        self.assertEquals(self.calc_delay(), HOUR * 1.5 * 1.5)
+        # a change resets the backoff
+        self.queue.record_response(self.feed, {'status': 200})
+        self.queue.record_entries(self.feed, [self.now - HOUR])
+        self.assertEquals(self.calc_delay(), HOUR)
+
+    def test_same_entries_count_as_unchanged(self):
+        self.queue.record_entries(self.feed, [self.now - HOUR])
+        self.assertEquals(self.calc_delay(), HOUR)
+        self.queue.record_entries(self.feed, [self.now - HOUR])
+        self.assertEquals(self.calc_delay(), HOUR * 1.5)
+
+    def test_error_backoff(self):
+        for i in xrange(10):
+            self.queue.record_error(self.feed)
+        self.assertEquals(self.calc_delay(),
+                HOUR * feedupdate.ERROR_BACKOFF **
+                feedupdate.MAX_BACKOFF_STEPS)
+        self.queue.record_response(self.feed, {'status': 200})
+        self.assertEquals(self.calc_delay(), HOUR)
+
+    def test_max_delay(self):
+        for i in xrange(10):
+            self.queue.record_error(self.feed)
+        self.assertEquals(self.calc_delay(10 * HOUR),
+                          feedupdate.MAX_ADAPTIVE_DELAY)
+        # we never poll more often than the regular interval
+        self.assertEquals(self.calc_delay(2 * DAY), 2 * DAY)
+
+    def test_cadence(self):
+        # daily feed that just published an entry
+        release_times = [self.now - i * DAY for i in xrange(5)]
+        self.queue.record_entries(self.feed, release_times)
+        self.assertEquals(self.calc_delay(), DAY * feedupdate.CADENCE_FRACTION)
+
+    def test_cadence_due(self):
+        # Daily feed that published its last entry 17 hours ago.  We
+        # shouldn't wait past the point where it's due for a new entry.
+        release_times = [self.now - 17 * HOUR - i * DAY for i in xrange(5)]
+        self.queue.record_entries(self.feed, release_times)
+        self.assertEquals(self.calc_delay(HOUR / 2), HOUR)
+        # after that, we should use the regular interval
+        release_times = [self.now - 20 * HOUR - i * DAY for i in xrange(5)]
+        self.queue.record_entries(self.feed, release_times)
+        self.assertEquals(self.calc_delay(HOUR / 2), HOUR / 2)
+
+    def test_cadence_needs_samples(self):
+        self.queue.record_entries(self.feed, [self.now, self.now - DAY])
+        self.assertEquals(self.calc_delay(), HOUR)
+
+    def test_max_age(self):
+        self.queue.record_response(self.feed, {'status': 200,
+            'cache-control': 'public, max-age=7200'})
+        self.assertEquals(self.calc_delay(), 2 * HOUR)
+        self.queue.record_response(self.feed, {'status': 200,
+            'cache-control': 'no-cache'})
+        self.assertEquals(self.calc_delay(), HOUR)
+
+    def test_skip_hours(self):
+        hour = time.gmtime(self.now + HOUR).tm_hour
+        self.queue.record_entries(self.feed, [], [hour, (hour + 1) % 24])
+        delay = self.calc_delay()
+        update_time = time.gmtime(self.now + delay)
+        self.assertEquals(update_time.tm_hour, (hour + 2) % 24)
+        self.assertEquals(update_time.tm_min, 0)
+
+    def test_parse_max_age(self):
+        self.assertEquals(feedupdate.parse_max_age('max-age=60'), 60)
+        self.assertEquals(feedupdate.parse_max_age('private, max-age="60"'),
+                          60)
+        self.assertEquals(feedupdate.parse_max_age('no-store, max-age=60'),
+                          None)
+        self.assertEquals(feedupdate.parse_max_age(None), None)
+
+    def test_next_update_time(self):
+        self.assertEquals(self.queue.next_update_time(self.feed), None)
+        self.queue.schedule_update(HOUR, self.feed, lambda: None)
+        next_update = self.queue.next_update_time(self.feed)
+        self.assert_(abs(next_update - (time.time() + HOUR)) < 10)
+        self.queue.cancel_update(self.feed)
+        self.assertEquals(self.queue.next_update_time(self.feed), None)
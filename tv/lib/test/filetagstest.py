@@ -7,11 +7,16 @@ try:
 except ImportError:
     import json
 
-from miro.test.framework import MiroTestCase, dynamic_test
+from miro.test.framework import (MiroTestCase, dynamic_test,
+                                 only_on_platforms)
 
+import os
 import shutil
 from os import path, stat
 
+from mutagen import id3
+
+from miro import coverart
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
 from miro.filetags import calc_cover_art_filename, process_file
@@ -104,3 +109,52 @@ class TestCalcCoverArtFilename(MiroTestCase):
                           correct_filename)
         self.assert_(isinstance(calc_cover_art_filename(album_name),
                      PlatformFilenameType))
+
+class CoverArtStoreTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.image = coverart.Image(id3.APIC(mime='image/jpeg', type=3,
+                                             data='fake image data'))
+
+    def test_store_image(self):
+        # test that identical images only get written once
+        store_path = coverart.store_image(self.image, self.tempdir)
+        self.assertEquals(path.dirname(store_path),
+                          path.join(self.tempdir,
+                                    coverart.CONTENT_STORE_DIRECTORY))
+        self.assert_(store_path.endswith('.jpg'))
+        org_mtime = stat(store_path).st_mtime
+        other_image = coverart.Image(id3.APIC(mime='image/jpeg', type=3,
+                                              data='fake image data'))
+        self.assertEquals(coverart.store_image(other_image, self.tempdir),
+                          store_path)
+        self.assertEquals(stat(store_path).st_mtime, org_mtime)
+
+    def test_link_and_remove(self):
+        album_paths = [path.join(self.tempdir, name)
+                       for name in ('Album 1', 'Album 2')]
+        for album_path in album_paths:
+            coverart.save_image(self.image, self.tempdir, album_path)
+            self.assertEquals(open(album_path).read(), 'fake image data')
+        store_path = coverart.store_image(self.image, self.tempdir)
+        # the stored image should stay around until nothing uses it
+        coverart.remove_image(album_paths[0])
+        self.assert_(not path.exists(album_paths[0]))
+        self.assert_(path.exists(store_path))
+        coverart.remove_image(album_paths[1])
+        self.assert_(not path.exists(album_paths[1]))
+        if hasattr(os, 'link'):
+            self.assert_(not path.exists(store_path))
+
+    @only_on_platforms('linux', 'osx')
+    def test_save_without_links(self):
+        # if we can't make hard links, the image should only get stored in
+        # the album file
+        mock_link = self.patch_for_test('miro.coverart.os.link')
+        mock_link.side_effect = OSError("links not supported")
+        album_path = path.join(self.tempdir, 'Album')
+        coverart.save_image(self.image, self.tempdir, album_path)
+        self.assertEquals(open(album_path).read(), 'fake image data')
+        store_directory = path.join(self.tempdir,
+                                    coverart.CONTENT_STORE_DIRECTORY)
+        self.assertEquals(os.listdir(store_directory), [])
@@ -362,6 +362,8 @@ class MiroTestCase(unittest.TestCase):
         workerprocess.shutdown()
         workerprocess._subprocess_manager = \
                 workerprocess.WorkerSubprocessManager()
+        workerprocess._movie_data_manager = \
+                workerprocess.WorkerSubprocessManager()
         workerprocess._miro_task_queue.reset()
         self.reset_log_filter()
         signals.system.disconnect_all()
@@ -486,9 +488,9 @@ class MiroTestCase(unittest.TestCase):
     def make_temp_dir_path(self):
         return tempfile.mkdtemp(dir=self.tempdir)
 
-    def start_http_server(self):
+    def start_http_server(self, threaded=False):
         self.stop_http_server()
-        self.httpserver = testhttpserver.HTTPServer()
+        self.httpserver = testhttpserver.HTTPServer(threaded)
         self.httpserver.start()
 
     def last_http_info(self, info_name):
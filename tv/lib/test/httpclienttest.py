@@ -1,4 +1,5 @@
 import functools
+import hashlib
 import os
 import logging
 import pycurl
@@ -14,7 +15,9 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test import testhttpserver
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+        uses_httpclient)
 
 from miro.gtcache import gettext as _
 
@@ -286,6 +289,70 @@ class HTTPClientTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url("test.txt"))
         self.assertEquals(self.grab_url_info['charset'], 'UTF-8')
 
+    @uses_httpclient
+    def test_body_sink(self):
+        class ListSink(httpclient.BodySink):
+            def __init__(self):
+                self.chunks = []
+                self.finished = False
+            def write(self, data):
+                self.chunks.append(data)
+            def reset(self):
+                self.chunks = []
+            def finish(self, info):
+                self.finished = True
+        sink = ListSink()
+        self.grab_url(self.httpserver.build_url('test.txt'), body_sink=sink)
+        self.assert_('body' not in self.grab_url_info)
+        self.assert_(sink.finished)
+        self.assertEquals(''.join(sink.chunks), self.test_response_data)
+
+    @uses_httpclient
+    def test_temp_file_sink(self):
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                body_sink=httpclient.TempFileSink())
+        path = self.grab_url_info['body-path']
+        self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        self.assertEquals(self.grab_url_info['body-digest'],
+                hashlib.sha1(self.test_response_data).hexdigest())
+        os.remove(path)
+
+    @uses_httpclient
+    def test_temp_file_sink_gzip(self):
+        self.httpserver.add_header("content-encoding", "gzip")
+        self.grab_url(self.httpserver.build_url('test.txt.gz'),
+                body_sink=httpclient.TempFileSink())
+        path = self.grab_url_info['body-path']
+        self.assertEquals(open(path, 'rb').read(), self.test_response_data)
+        os.remove(path)
+
+    @uses_httpclient
+    def test_temp_file_sink_error(self):
+        sink = httpclient.TempFileSink()
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                body_sink=sink)
+        self.check_errback_called()
+        # the temp file should be cleaned up
+        self.assertEquals(sink.path, None)
+
+    @uses_httpclient
+    def test_handle_reuse(self):
+        # Fetch from 2 different hosts a few times each.  We should only
+        # create 1 libcurl handle and only open 1 connection per host.
+        self.start_http_server(threaded=True)
+        handler_class = testhttpserver.MiroHTTPRequestHandler
+        start_connections = handler_class.handlers_created
+        for i in xrange(3):
+            for host in ('localhost', '127.0.0.1'):
+                self.grab_url(self.httpserver.build_url('test.txt', host))
+                self.assertEquals(self.grab_url_info['body'],
+                        self.test_response_data)
+        self.assertEquals(httpclient.curl_manager.handles_created, 1)
+        self.assertEquals(len(httpclient.curl_manager.free_handles), 1)
+        self.assertEquals(handler_class.handlers_created - start_connections,
+                2)
+
     @uses_httpclient
     def test_upload_progress(self):
         # upload a 100k file
@@ -483,6 +550,90 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+    @uses_httpclient
+    def test_write_file_small_buffer(self):
+        # make sure we handle data that spans several buffers
+        filename = self.make_temp_path(".txt")
+        self._write_partial_file(filename, 5)
+        with mock.patch.object(httpclient, 'WRITE_BUFFER_SIZE', 7):
+            self.grab_url(self.httpserver.build_url('test.txt'),
+                    write_file=filename, resume=True)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+
+    @uses_httpclient
+    def test_write_file_error(self):
+        def write_with_error(writer, data):
+            writer.error = IOError("disk full")
+        self.expecting_errback = True
+        filename = self.make_temp_path(".txt")
+        with mock.patch.object(httpclient.BufferedFileWriter, '_write',
+                write_with_error):
+            self.grab_url(self.httpserver.build_url('test.txt'),
+                    write_file=filename)
+        self.assert_(isinstance(self.grab_url_error, httpclient.WriteError))
+
+    @uses_httpclient
+    def test_write_after_write_error(self):
+        # libcurl can call our write function again in the same perform()
+        # pass after we've seen a write error.  We should keep aborting the
+        # transfer, not crash because the file is already closed.
+        filename = self.make_temp_path(".txt")
+        options = httpclient.TransferOptions("http://example.com/",
+                write_file=filename)
+        transfer = httpclient.CurlTransfer(options,
+                self.grab_url_callback, self.grab_url_errback)
+        transfer.status_code = 200
+        transfer._writer = httpclient.BufferedFileWriter(mock.Mock(),
+                BufferedFileWriterTest.ImmediateWriterThread())
+        transfer._writer.error = IOError("disk full")
+        with self.allow_warnings():
+            self.assertEquals(transfer._write_file('a' * 10), 0)
+        self.assertEquals(transfer._writer, None)
+        self.assertEquals(transfer._write_file('b' * 10), 0)
+        # aborting the transfer makes libcurl report an error, which we
+        # should ignore since we already sent the errback.
+        transfer.on_error(pycurl.E_WRITE_ERROR, None)
+        self.runPendingIdles()
+        self.check_errback_called()
+        self.assert_(isinstance(self.grab_url_error, httpclient.WriteError))
+
+class BufferedFileWriterTest(MiroTestCase):
+    class ImmediateWriterThread(object):
+        def add_job(self, func, *args):
+            func(*args)
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.fileobj = mock.Mock()
+        self.closed_with = []
+        self.writer = httpclient.BufferedFileWriter(self.fileobj,
+                self.ImmediateWriterThread(), offset=5)
+
+    def written(self):
+        return [args[0] for args, kwargs in
+                self.fileobj.write.call_args_list]
+
+    def test_aligned_writes(self):
+        with mock.patch.object(httpclient, 'WRITE_BUFFER_SIZE', 10):
+            self.writer.write('a' * 4)
+            self.writer.write('b' * 4)
+            self.assertEquals(self.written(), [])
+            # we started at offset 5, so we should write up to offset 30
+            self.writer.write('c' * 25)
+            self.assertEquals(self.written(), ['aaaabbbb' + 'c' * 17])
+            self.writer.close(self.closed_with.append)
+        self.assertEquals(self.written(),
+                ['aaaabbbb' + 'c' * 17, 'c' * 8])
+        self.assert_(self.fileobj.close.called)
+        self.assertEquals(self.closed_with, [None])
+
+    def test_error(self):
+        self.fileobj.write.side_effect = IOError("disk full")
+        self.writer.write('a' * httpclient.WRITE_BUFFER_SIZE)
+        self.assert_(isinstance(self.writer.error, IOError))
+        self.writer.close(self.closed_with.append)
+        self.assertEquals(self.closed_with, [self.writer.error])
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -1075,6 +1226,70 @@ class NetworkErrorTest(HTTPClientTestBase):
         self.assert_(isinstance(self.grab_url_error.longDescription, unicode))
         self.assert_(isinstance(self.grab_url_error.friendlyDescription, unicode))
 
+class SchedulerTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        self.url = 'http://example.com/'
+
+    def start_transfers(self, count, priority):
+        for i in xrange(count):
+            httpclient.grab_url(self.url, self.grab_url_callback,
+                    self.grab_url_errback, priority=priority)
+        self.wait_for_libcurl_manager()
+
+    @uses_mock_httpclient
+    def test_host_limits(self):
+        self.mocked_multi.info_read.return_value = (0, [], [])
+        limit = httpclient.HOST_CONNECTION_LIMITS[
+                httpclient.PRIORITY_SEGMENT]
+        self.start_transfers(limit + 2, httpclient.PRIORITY_SEGMENT)
+        self.assertEquals(self.mocked_multi.add_handle.call_count, limit)
+        self.assertEquals(len(httpclient.curl_manager.pending), 2)
+        # feed updates don't have to wait for the segments
+        self.start_transfers(1, httpclient.PRIORITY_FEED)
+        self.assertEquals(self.mocked_multi.add_handle.call_count, limit + 1)
+        self.assertEquals(len(httpclient.curl_manager.pending), 2)
+
+    @uses_mock_httpclient
+    def test_downloads_not_limited(self):
+        # downloads that the user started should never get queued, since
+        # they would look stalled
+        self.mocked_multi.info_read.return_value = (0, [], [])
+        self.start_transfers(10, httpclient.PRIORITY_DOWNLOAD)
+        self.assertEquals(self.mocked_multi.add_handle.call_count, 10)
+        self.assertEquals(len(httpclient.curl_manager.pending), 0)
+
+    @uses_mock_httpclient
+    def test_cancel_pending(self):
+        self.mocked_multi.info_read.return_value = (0, [], [])
+        limit = httpclient.HOST_CONNECTION_LIMITS[httpclient.PRIORITY_ICON]
+        self.start_transfers(limit, httpclient.PRIORITY_ICON)
+        client = httpclient.grab_url(self.url, self.grab_url_callback,
+                self.grab_url_errback, priority=httpclient.PRIORITY_ICON)
+        self.wait_for_libcurl_manager()
+        self.assertEquals(len(httpclient.curl_manager.pending), 1)
+        client.cancel()
+        self.wait_for_libcurl_manager()
+        self.assertEquals(len(httpclient.curl_manager.pending), 0)
+
+    @uses_mock_httpclient
+    def test_rate_limits(self):
+        self.mocked_multi.info_read.return_value = (0, [], [])
+        limits = []
+        def set_rate_limits(transfer, download_limit, upload_limit):
+            limits.append((transfer.options.priority, download_limit))
+        with mock.patch.object(httpclient.CurlTransfer, 'set_rate_limits',
+                set_rate_limits):
+            self.start_transfers(1, httpclient.PRIORITY_FEED)
+            self.start_transfers(1, httpclient.PRIORITY_DOWNLOAD)
+            httpclient.curl_manager.set_rate_limits(download_limit=50000)
+            self.wait_for_libcurl_manager()
+        # the bandwidth should be split evenly
+        self.assertSameSet(limits, [
+            (httpclient.PRIORITY_FEED, 25000),
+            (httpclient.PRIORITY_DOWNLOAD, 25000),
+        ])
+
 class LimitProtocolTest(HTTPClientTestBase):
     #test that we limit the protocols to HTTP and HTTPS
     @uses_httpclient
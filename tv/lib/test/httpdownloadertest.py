@@ -1,9 +1,11 @@
 import os
 
+from miro import app
 from miro import download_utils
 from miro import httpclient
+from miro import prefs
 from miro.test.framework import (
-    EventLoopTest, uses_httpclient, skip_for_platforms)
+    EventLoopTest, MiroTestCase, uses_httpclient, skip_for_platforms)
 from miro.plat import resources
 from miro.dl_daemon import download
 
@@ -165,3 +167,218 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentedDownloadTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        download.chatter = False
+        download.next_free_filename = lambda x: self.make_temp_path_fileobj()
+        download._downloads = {}
+        self.old_segment_min_size = download.SEGMENT_MIN_SIZE
+        # linux-screen.jpg is 45572 bytes, so this gives us 3 segments
+        download.SEGMENT_MIN_SIZE = 10000
+        app.config.set(prefs.HTTP_SEGMENTED_DOWNLOADS, True)
+        app.config.set(prefs.HTTP_SEGMENT_COUNT, 3)
+        self.start_http_server(threaded=True)
+        self.httpserver.add_header('Accept-Ranges', 'bytes')
+        self.download_url = unicode(
+                self.httpserver.build_url('linux-screen.jpg'))
+        self.download_path = resources.path(
+                'testdata/httpserver/linux-screen.jpg')
+        self.download_size = 45572
+
+    def tearDown(self):
+        EventLoopTest.tearDown(self)
+        download.next_free_filename = download_utils.next_free_filename
+        download.SEGMENT_MIN_SIZE = self.old_segment_min_size
+        download.chatter = True
+
+    def stop_on_finished(self):
+        if self.downloader.state == "finished":
+            self.stopEventLoop(False)
+
+    def check_downloaded_data(self, downloader):
+        self.assertEquals(downloader.state, 'finished')
+        self.assertEquals(downloader.current_size, self.download_size)
+        self.assertEquals(open(downloader.filename, 'rb').read(),
+                open(self.download_path, 'rb').read())
+
+    def last_range_header(self):
+        return self.last_http_info('headers').get('range')
+
+    @uses_httpclient
+    def test_download(self):
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stop_on_finished
+        self.runEventLoop()
+        self.check_downloaded_data(self.downloader)
+        self.assert_(self.last_range_header().startswith('bytes='))
+        self.assert_(self.downloader.segmented_ok)
+
+    @uses_httpclient
+    def test_range_ignored(self):
+        # The server says it accepts ranges, but really doesn't.  We should
+        # fall back to a regular download.
+        self.httpserver.disable_resume()
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stop_on_finished
+        self.runEventLoop()
+        self.check_downloaded_data(self.downloader)
+        self.assert_(not self.downloader.segmented_ok)
+
+    @uses_httpclient
+    def test_no_accept_ranges(self):
+        self.httpserver.httpserver.headers_to_send = []
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stop_on_finished
+        self.runEventLoop()
+        self.check_downloaded_data(self.downloader)
+        self.assertEquals(self.last_range_header(), None)
+
+    @uses_httpclient
+    def test_restore(self):
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        def pause_in_middle():
+            # each of our 3 segments gets 5000 bytes
+            if (self.downloader.state == 'downloading' and
+                    self.downloader.current_size == 15000):
+                self.downloader.pause()
+                self.stopEventLoop(False)
+        self.downloader.statusCallback = pause_in_middle
+        self.httpserver.pause_after(5000)
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'paused')
+        self.assertEquals(self.downloader.current_size, 15000)
+        state_path = download.segment_state_path(self.downloader.filename)
+        self.assert_(os.path.exists(state_path))
+
+        restore = self.downloader.lastStatus.copy()
+        restore['state'] = 'downloading'
+        download._downloads = {}
+        self.httpserver.pause_after(-1)
+        self.downloader = TestingDownloader(self, restore=restore)
+        self.downloader.statusCallback = self.stop_on_finished
+        self.runEventLoop()
+        self.check_downloaded_data(self.downloader)
+        # We should have resumed each segment, rather than starting over
+        self.assert_(not self.last_range_header().startswith('bytes=0-'))
+        self.assert_(not os.path.exists(state_path))
+
+class SegmentTest(MiroTestCase):
+    def test_running_transfer_not_finished(self):
+        # A segment isn't finished until its transfer is done and the file
+        # for it closed, even if all of its bytes have been written.
+        segment = download.Segment(0, 999)
+        segment.sink = httpclient.RangeFileSink(self.make_temp_path(), 0)
+        segment.sink.bytes_written = 1000
+        self.assertEquals(segment.current_done(), 1000)
+        self.assert_(not segment.is_finished())
+        segment.transfer_done()
+        self.assertEquals(segment.done, 1000)
+        self.assert_(segment.is_finished())
+
+class FakeStatusDownloader(object):
+    def __init__(self, status):
+        self.dlid = status['dlid']
+        self.status = status
+
+    def get_status(self):
+        return self.status.copy()
+
+class DownloadStatusUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.updater = download.DownloadStatusUpdater()
+        self.status = {
+            'dlid': u'dlid1',
+            'state': u'downloading',
+            'current_size': 100,
+            'rate': 10,
+            'filename': '/tmp/foo.mp4',
+        }
+        self.mock_clock = self.patch_for_test('miro.dl_daemon.download.clock')
+        self.mock_clock.return_value = 1000.0
+        self.mock_send = self.patch_for_test(
+            'miro.dl_daemon.command.Command.send')
+
+    def run_update(self, downloader, now):
+        """Queue an update for a downloader, then run do_update()
+
+        :returns: list of statuses that got sent
+        """
+        self.mock_clock.return_value = now
+        self.mock_send.reset_mock()
+        self.updater.queue_update(downloader)
+        self.updater.do_update(periodic=False)
+        if self.mock_send.call_count == 0:
+            return []
+        self.assertEquals(self.mock_send.call_count, 1)
+        return self.mock_send.call_args[0][0].args[0]
+
+    def check_delayed_updates(self, visible):
+        downloader = FakeStatusDownloader(self.status)
+        self.assertEquals(len(self.run_update(downloader, 1000.0)), 1)
+        downloader.status['current_size'] = 200
+        statuses = self.run_update(downloader, 1001.0)
+        if visible:
+            self.assertEquals(len(statuses), 1)
+            return
+        # progress for downloads that aren't visible should wait for the
+        # next heartbeat
+        self.assertEquals(statuses, [])
+        self.assertEquals(self.updater.to_update, set([downloader]))
+        heartbeat = 1000.0 + download.DownloadStatusUpdater.HEARTBEAT_INTERVAL
+        self.assertEquals(self.run_update(downloader, heartbeat), [{
+            'dlid': u'dlid1',
+            'current_size': 200,
+        }])
+        # state changes should be sent right away
+        downloader.status['state'] = u'finished'
+        self.assertEquals(self.run_update(downloader, heartbeat + 1), [{
+            'dlid': u'dlid1',
+            'state': u'finished',
+        }])
+
+    def test_not_visible(self):
+        self.check_delayed_updates(visible=False)
+
+    def test_visible(self):
+        self.updater.set_visible(False, [u'dlid1'])
+        self.check_delayed_updates(visible=True)
+
+    def test_all_visible(self):
+        self.updater.set_visible(True, [])
+        self.check_delayed_updates(visible=True)
+
+    def test_other_visible(self):
+        self.updater.set_visible(False, [u'dlid2'])
+        self.check_delayed_updates(visible=False)
+
+    def test_first_status_sent_whole(self):
+        self.assertEquals(self.updater.calc_delta(self.status), self.status)
+
+    def test_delta(self):
+        self.updater.calc_delta(self.status)
+        status = self.status.copy()
+        status['current_size'] = 200
+        status['metainfo'] = 'torrent data'
+        self.assertEquals(self.updater.calc_delta(status), {
+            'dlid': u'dlid1',
+            'current_size': 200,
+            'metainfo': 'torrent data',
+        })
+        self.assertEquals(self.updater.calc_delta(status),
+                          {'dlid': u'dlid1'})
+
+    def test_download_removed(self):
+        downloader = FakeStatusDownloader(self.status)
+        self.run_update(downloader, 1000.0)
+        self.updater.download_removed(u'dlid1')
+        # the final status should still be sent as a delta
+        downloader.status['state'] = u'stopped'
+        self.assertEquals(self.run_update(downloader, 1001.0), [{
+            'dlid': u'dlid1',
+            'state': u'stopped',
+        }])
+        self.assertEquals(self.updater.last_sent, {})
+        self.assertEquals(self.updater.last_sent_time, {})
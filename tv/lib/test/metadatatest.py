@@ -88,6 +88,9 @@ class MockMetadataProcessor(object):
 
         if isinstance(task, workerprocess.MutagenTask):
             self.add_task_data(task.source_path, 'mutagen', task_data)
+        elif isinstance(task, workerprocess.MutagenBatchTask):
+            for path in task.source_paths:
+                self.add_task_data(path, 'mutagen', task_data)
         elif isinstance(task, workerprocess.MovieDataProgramTask):
             self.add_task_data(task.source_path, 'movie-data', task_data)
         elif isinstance(task, workerprocess.CancelFileOperations):
@@ -111,11 +114,42 @@ class MockMetadataProcessor(object):
         task, callback, errback = self.pop_task_data(source_path, 'mutagen')
         callback_data = {'source_path': source_path}
         callback_data.update(metadata)
-        callback(task, callback_data)
+        if isinstance(task, workerprocess.MutagenBatchTask):
+            # send back the result for just this path.  The rest of the
+            # batch can finish later.
+            callback(task, [(source_path, callback_data)])
+        else:
+            callback(task, callback_data)
 
     def run_mutagen_errback(self, source_path, error):
         task, callback, errback = self.pop_task_data(source_path, 'mutagen')
-        errback(task, error)
+        if isinstance(task, workerprocess.MutagenBatchTask):
+            callback(task, [(source_path, error)])
+        else:
+            errback(task, error)
+
+    def run_mutagen_batch_callback(self, batch, metadata):
+        """Send back results for every path in a MutagenBatchTask."""
+        results = []
+        for path in batch.source_paths:
+            task, callback, errback = self.pop_task_data(path, 'mutagen')
+            callback_data = {'source_path': path}
+            callback_data.update(metadata)
+            results.append((path, callback_data))
+        callback(batch, results)
+
+    def run_mutagen_batch_errback(self, batch, error):
+        """Simulate an entire MutagenBatchTask failing."""
+        for path in batch.source_paths:
+            task, callback, errback = self.pop_task_data(path, 'mutagen')
+        errback(batch, error)
+
+    def mutagen_batches(self):
+        """Get the MutagenBatchTasks currently in the system."""
+        batches = set()
+        for task, callback, errback in self.task_data['mutagen'].values():
+            batches.add(task)
+        return batches
 
     def run_movie_data_callback(self, source_path, metadata):
         task, callback, errback = self.pop_task_data(source_path, 'movie-data')
@@ -164,6 +198,11 @@ class MetadataManagerTest(MiroTestCase):
                             self.processor.exec_codegen)
         self.patch_function('miro.echonest.query_echonest',
                             self.processor.query_echonest)
+        # pretend there's 1 worker process, so that the mutagen batch limits
+        # don't depend on how many cores we have.
+        self.mock_process_count = self.patch_for_test(
+            'miro.workerprocess.process_count')
+        self.mock_process_count.return_value = 1
         self.metadata_manager = metadata.LibraryMetadataManager(self.tempdir,
                                                                 self.tempdir)
         # For these examples we want to run echonest by default
@@ -486,6 +525,44 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_movie_data('foo.avi', 'video', 100, False)
         self.check_echonest_not_scheduled('foo.avi')
 
+    def get_progress_updates(self):
+        self.metadata_manager._send_progress_updates_caller.call_now()
+        return [(m.target, m.total, m.finished_local, m.finished)
+                for m in self.get_frontend_messages()
+                if isinstance(m, messages.MetadataProgressUpdate)]
+
+    def test_progress_updates(self):
+        # We should only send progress updates for targets whose counts
+        # changed since the last update.
+        self.check_add_file('foo.mp3')
+        self.check_add_file('bar.mp3')
+        self.assertEquals(self.get_progress_updates(), [
+            ((u'library', u'audio'), 2, 0, 0),
+            ((u'library', u'video'), 0, 0, 0),
+        ])
+        self.assertEquals(self.get_progress_updates(), [])
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Foo', 'Fights')
+        self.assertEquals(self.get_progress_updates(), [
+            ((u'library', u'audio'), 2, 1, 0),
+        ])
+
+    def test_movie_data_gets_mutagen_duration(self):
+        # If mutagen got a duration from the container headers, we should
+        # pass it to the movie data program so that it doesn't have to
+        # calculate it again.
+        self.check_add_file('foo.avi')
+        self.check_run_mutagen('foo.avi', 'video', 101, 'Foo')
+        path = self.make_path('foo.avi')
+        task = self.processor.task_data['movie-data'][path][0]
+        self.assertEquals(task.duration, 101)
+        self.check_run_movie_data('foo.avi', 'video', 101, True)
+        # If mutagen didn't get a duration, we shouldn't send one
+        self.check_add_file('bar.avi')
+        self.check_run_mutagen('bar.avi', 'video', None, 'Bar')
+        path = self.make_path('bar.avi')
+        task = self.processor.task_data['movie-data'][path][0]
+        self.assertEquals(task.duration, None)
+
     def test_audio(self):
         # Test audio files with no issues
         self.check_add_file('foo.mp3')
@@ -637,6 +714,35 @@ class MetadataManagerTest(MiroTestCase):
         self.check_run_mutagen('foo3.mp3', 'audio', 400, 'Baz', 'Fights',
                                cover_art=False)
 
+    def test_remove_unused_cover_art(self):
+        # Test that we remove cover art once no files use it
+        self.check_add_file('foo.mp3')
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Bar', 'Fights')
+        self.check_add_file('foo2.mp3')
+        self.check_run_mutagen('foo2.mp3', 'audio', 300, 'Foo', 'Fights',
+                               cover_art=False)
+        cover_art = self.cover_art('Fights')
+        self.metadata_manager.remove_file(self.make_path('foo.mp3'))
+        self.metadata_manager._remove_unused_cover_art()
+        self.assert_(os.path.exists(cover_art))
+        self.metadata_manager.remove_file(self.make_path('foo2.mp3'))
+        self.metadata_manager._remove_unused_cover_art()
+        self.assert_(not os.path.exists(cover_art))
+
+    def test_keep_cover_art_for_renamed_album(self):
+        # Test that we keep cover art while a file has it in its mutagen
+        # data, even if echonest gave that file a different album
+        self.check_add_file('foo.mp3')
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Bar', 'Fights')
+        self.check_run_echonest('foo.mp3', 'Bar', 'Artist', 'Fights2')
+        self.check_add_file('foo2.mp3')
+        self.check_run_mutagen('foo2.mp3', 'audio', 300, 'Foo', 'Fights',
+                               cover_art=False)
+        cover_art = self.cover_art('Fights')
+        self.metadata_manager.remove_file(self.make_path('foo2.mp3'))
+        self.metadata_manager._remove_unused_cover_art()
+        self.assert_(os.path.exists(cover_art))
+
     def test_audio_no_duration(self):
         # Test audio files where mutagen can't get the duration
         self.check_add_file('foo.mp3')
@@ -945,6 +1051,28 @@ class MetadataManagerTest(MiroTestCase):
         self.assertEquals(count_tracker.get_count_info(u'audio'),
                           (0, 0, 0))
 
+    def test_retry_net_lookup_in_chunks(self):
+        # retry_net_lookup() should restart the lookups a chunk at a time
+        names = ['song-%d.mp3' % i for i in xrange(10)]
+        for name in names:
+            self.check_add_file(name)
+            self.check_run_mutagen(name, 'audio', 200, 'title', 'album')
+            self.check_run_echonest(name, 'title', 'Artist', None)
+            self.allow_additional_echonest_query(name)
+        runner = self.metadata_manager._retry_net_lookup_runner
+        runner.chunk_size = 4
+        self.metadata_manager.retry_net_lookup()
+        retrying = self.metadata_manager._retry_net_lookup_entries
+        self.assertEquals(len(retrying), 4)
+        self.assertEquals(len(runner), 6)
+        runner.run_chunk()
+        self.assertEquals(len(retrying), 8)
+        runner.run_chunk()
+        self.assertEquals(len(retrying), 10)
+        self.assertEquals(len(runner), 0)
+        for name in names:
+            self.check_run_echonest(name, 'title', 'Artist', 'Album')
+
     def test_retry_net_lookup_with_many_items(self):
         should_retry = []
         shouldnt_retry = []
@@ -1141,6 +1269,49 @@ class MetadataManagerTest(MiroTestCase):
         self.assertEquals(metadata['title'], 'Newer Foo')
         self.assertEquals(metadata['album'], 'The bestest')
 
+    def test_get_metadata_uses_entry_metadata(self):
+        # test that get_metadata() doesn't need to query the metadata table
+        self.check_add_file('foo.mp3')
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Bar', 'Fights')
+        self.check_set_user_info('foo.mp3', title=u'New Bar')
+        self.check_run_echonest('foo.mp3', 'Bar', 'Artist', 'Fights')
+        mock_metadata_for_status = self.patch_for_test(
+            'miro.metadata.MetadataEntry.metadata_for_status',
+            autospec=False)
+        self.check_metadata('foo.mp3')
+        self.check_set_net_lookup_enabled('foo.mp3', False)
+        self.check_set_net_lookup_enabled('foo.mp3', True)
+        self.assertEquals(mock_metadata_for_status.call_count, 0)
+
+    def test_entry_metadata_not_calculated(self):
+        # test statuses from before we stored entry_metadata
+        self.check_add_file('foo.mp3')
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Bar', 'Fights')
+        status = metadata.MetadataStatus.get_by_path('/videos/foo.mp3')
+        status.entry_metadata = None
+        status.signal_change()
+        self.check_metadata('foo.mp3')
+        self.assertNotEquals(status.entry_metadata, None)
+        status.entry_metadata = None
+        status.signal_change()
+        self.check_set_user_info('foo.mp3', title=u'New Bar')
+        self.check_run_echonest('foo.mp3', 'Bar', 'Artist', 'Fights')
+
+    def test_calc_entry_metadata_saves_once(self):
+        # test that calculating entry_metadata only saves the status once,
+        # rather than once per entry
+        self.check_add_file('foo.mp3')
+        self.check_run_mutagen('foo.mp3', 'audio', 200, 'Bar', 'Fights')
+        self.check_set_user_info('foo.mp3', title=u'New Bar')
+        self.check_run_echonest('foo.mp3', 'Bar', 'Artist', 'Fights')
+        status = metadata.MetadataStatus.get_by_path('/videos/foo.mp3')
+        correct_metadata = status.get_merged_metadata()
+        status.entry_metadata = None
+        status.signal_change()
+        with mock.patch.object(status, 'signal_change') as mock_signal_change:
+            self.assertEquals(status.get_merged_metadata(), correct_metadata)
+        self.assertEquals(mock_signal_change.call_count, 1)
+
     def test_queueing(self):
         # test that if we don't send too many requests to the worker process
         paths = ['/videos/video-%d.avi' % i for i in xrange(200)]
@@ -1209,23 +1380,23 @@ class MetadataManagerTest(MiroTestCase):
         run_movie_data(0, 100)
         # we should only have 1 echonest codegen program running at once
         check_counts(75, 25, 1, 0)
-        # when that gets done, we should only have 1 echonest query running at
-        # once
+        # when that gets done, we should run up to ECHONEST_QUERY_LIMIT (3)
+        # echonest queries at once
         run_echonest_codegen(0, 2)
-        check_counts(75, 25, 1, 1)
+        check_counts(75, 25, 1, 2)
         # we should stop running echonest codegen once we have 5 codes queued
-        # up
-        run_echonest_codegen(2, 6)
-        check_counts(75, 25, 0, 1)
+        # up (3 codes are being used for queries)
+        run_echonest_codegen(2, 8)
+        check_counts(75, 25, 0, 3)
         # looks good, just double check that we finish our queues okay
         run_mutagen(125, 200)
-        check_counts(0, 100, 0, 1)
+        check_counts(0, 100, 0, 3)
         run_movie_data(100, 200)
-        check_counts(0, 0, 0, 1)
-        for i in xrange(195):
+        check_counts(0, 0, 0, 3)
+        for i in xrange(192):
             run_echonest(i, i+1)
-            run_echonest_codegen(i+6, i+7)
-        run_echonest(195, 200)
+            run_echonest_codegen(i+8, i+9)
+        run_echonest(192, 200)
 
     def test_move(self):
         # add a couple files at different points in the metadata process
@@ -1321,6 +1492,149 @@ class MetadataManagerTest(MiroTestCase):
         correct_paths = paths[100:150] + new_paths
         self.assertSameSet(self.processor.mutagen_paths(), correct_paths)
 
+    def add_cached_file(self, filename, data):
+        """Add a real file and run mutagen and movie data for it."""
+        path = os.path.join(self.tempdir, filename)
+        open(path, 'wb').write(data)
+        self.metadata_manager.add_file(path)
+        self.processor.run_mutagen_callback(path, {
+            'file_type': u'video',
+            'title': u'Cached',
+            'drm': False,
+        })
+        self.metadata_manager.run_updates()
+        screenshot = os.path.join(self.tempdir, filename + '.png')
+        open(screenshot, 'wb').write("FAKE SCREENSHOT")
+        self.processor.run_movie_data_callback(path, {
+            'file_type': u'video',
+            'duration': 100,
+            'screenshot': screenshot,
+        })
+        self.metadata_manager.run_updates()
+        return path
+
+    def test_metadata_cache(self):
+        # test that we don't re-run mutagen or movie data for files that get
+        # added again, like when a watched folder is removed and re-added.
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        path = self.add_cached_file('cached.avi', 'fake video data')
+        self.metadata_manager.remove_files([path])
+        self.assert_(os.path.exists(path + '.png'))
+        self.metadata_manager.add_file(path)
+        self.metadata_manager.run_updates()
+        self.assert_(path not in self.processor.mutagen_paths())
+        self.assert_(path not in self.processor.movie_data_paths())
+        metadata = self.metadata_manager.get_metadata(path)
+        self.assertEquals(metadata['title'], u'Cached')
+        self.assertEquals(metadata['screenshot'], path + '.png')
+
+    def test_metadata_cache_remove_old(self):
+        # test that we remove old entries and their images at startup
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        old_path = self.add_cached_file('old.avi', 'fake video data')
+        new_path = self.add_cached_file('new.avi', 'more fake video data')
+        self.metadata_manager.remove_files([old_path, new_path])
+        old_entry = metadata.MetadataCacheEntry.get_by_path(old_path)
+        old_entry.last_used -= metadata.METADATA_CACHE_MAX_AGE + 1
+        old_entry.signal_change()
+        metadata.MetadataCacheEntry.remove_old()
+        self.assertRaises(database.ObjectNotFoundError,
+                          metadata.MetadataCacheEntry.get_by_path, old_path)
+        self.assert_(not os.path.exists(old_path + '.png'))
+        metadata.MetadataCacheEntry.get_by_path(new_path)
+        self.assert_(os.path.exists(new_path + '.png'))
+        # if there are too many entries, the least recently used ones go
+        with mock.patch.object(metadata, 'METADATA_CACHE_MAX_ENTRIES', 0):
+            metadata.MetadataCacheEntry.remove_old()
+        self.assertRaises(database.ObjectNotFoundError,
+                          metadata.MetadataCacheEntry.get_by_path, new_path)
+
+    def test_metadata_cache_partial_hash_lazy(self):
+        # test that we only read files to hash them when there's another
+        # file with the same size to compare against
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        mock_partial_hash = self.patch_for_test('miro.metadata._partial_hash')
+        mock_partial_hash.side_effect = lambda path: path[-5:]
+        self.add_cached_file('first.avi', 'fake video data')
+        self.add_cached_file('second.avi', 'other fake video data')
+        self.assertEquals(mock_partial_hash.call_count, 0)
+        # a file with the same size as first.avi should trigger hashing both
+        path = os.path.join(self.tempdir, 'third.avi')
+        open(path, 'wb').write('more video data')
+        self.metadata_manager.add_file(path)
+        self.assertEquals(mock_partial_hash.call_count, 2)
+        self.assert_(path in self.processor.mutagen_paths())
+
+    def test_metadata_cache_content_match(self):
+        # test that we use cached results for a copy of a file
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        path = self.add_cached_file('original.avi', 'fake video data')
+        copy_path = os.path.join(self.tempdir, 'copy.avi')
+        shutil.copyfile(path, copy_path)
+        self.metadata_manager.add_file(copy_path)
+        self.metadata_manager.run_updates()
+        self.metadata_manager.run_updates()
+        self.assert_(copy_path not in self.processor.mutagen_paths())
+        self.assert_(copy_path not in self.processor.movie_data_paths())
+        metadata = self.metadata_manager.get_metadata(copy_path)
+        self.assertEquals(metadata['title'], u'Cached')
+        self.assertEquals(metadata['duration'], 100)
+
+    def test_metadata_cache_file_changed(self):
+        # test that we ignore cached results after the file changes
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        path = self.add_cached_file('changed.avi', 'fake video data')
+        self.metadata_manager.remove_files([path])
+        open(path, 'wb').write('new fake video data')
+        self.metadata_manager.add_file(path)
+        self.assert_(path in self.processor.mutagen_paths())
+
+    def test_mutagen_batches(self):
+        # test that files added with bulk_add() get sent to mutagen in batches
+        paths = ['/videos/video-%d.mp3' % i for i in xrange(120)]
+        with self.metadata_manager.bulk_add():
+            for p in paths:
+                self.metadata_manager.add_file(p)
+        # we should only send 100 paths at once
+        batches = list(self.processor.mutagen_batches())
+        self.assertEquals(sorted(len(b.source_paths) for b in batches),
+                          [50, 50])
+        signal_handler = mock.Mock()
+        self.metadata_manager.connect("new-metadata", signal_handler)
+        # each batch should be processed as soon as it comes back
+        mutagen_result = {
+            'file_type': u'audio',
+            'title': u'Title',
+            'drm': False,
+        }
+        self.processor.run_mutagen_batch_callback(batches[0], mutagen_result)
+        self.assertEquals(signal_handler.call_count, 1)
+        new_metadata = signal_handler.call_args[0][1]
+        self.assertSameSet(new_metadata.keys(), batches[0].source_paths)
+        # the 20 pending paths should be sent in a new batch
+        self.assertEquals(len(self.processor.mutagen_batches()), 2)
+        self.assertEquals(len(self.processor.mutagen_paths()), 70)
+        # if an entire batch fails, all its paths should move on to the next
+        # processor
+        with self.allow_warnings():
+            self.processor.run_mutagen_batch_errback(batches[1],
+                                                     ValueError())
+        self.assertEquals(signal_handler.call_count, 2)
+        for path in batches[1].source_paths:
+            status = metadata.MetadataStatus.get_by_path(path)
+            self.assertNotEquals(status.current_processor, u'mutagen')
+
+    def test_mutagen_batches_use_all_processes(self):
+        # test that we send enough batches to keep every worker process busy
+        self.mock_process_count.return_value = 4
+        paths = ['/videos/video-%d.mp3' % i for i in xrange(500)]
+        with self.metadata_manager.bulk_add():
+            for p in paths:
+                self.metadata_manager.add_file(p)
+        batches = list(self.processor.mutagen_batches())
+        self.assertEquals(sorted(len(b.source_paths) for b in batches),
+                          [50] * 8)
+
 class EchonestNetErrorTest(EventLoopTest):
     # Test our pause/retry logic when we get HTTP errors from echonest
 
@@ -1348,8 +1662,11 @@ class EchonestNetErrorTest(EventLoopTest):
             with self.allow_warnings():
                 _echonest_processor._echonest_errback(path_iter.next(),
                                                       http_error)
-        # after we get enough error, we should stop querying echonest
-        self.assertEquals(_echonest_processor._querying_echonest, False)
+        # after we get enough error, we should stop starting new echonest
+        # queries.  The ones already running can finish.
+        query_limit = _echonest_processor.ECHONEST_QUERY_LIMIT
+        self.assert_(len(_echonest_processor._echonest_queries) < query_limit)
+        self.assertEquals(_echonest_processor._waiting_from_http_errors, True)
         # we should also set a timeout to re-run the queue once enough time
         # has passed
         mock_add_timeout.assert_called_once_with(
@@ -1361,18 +1678,21 @@ class EchonestNetErrorTest(EventLoopTest):
             _echonest_processor._http_error_times[i] -= timeout
         mock_add_timeout.reset_mock()
         _echonest_processor._restart_after_http_errors()
-        self.assertEquals(_echonest_processor._querying_echonest, True)
+        self.assertEquals(len(_echonest_processor._echonest_queries),
+                          query_limit)
         # test that if this call is sucessfull, we keep going
         _echonest_processor._echonest_callback(path_iter.next(),
                                                {'album': u'Album'})
-        self.assertEquals(_echonest_processor._querying_echonest, True)
+        self.assertEquals(len(_echonest_processor._echonest_queries),
+                          query_limit)
         # test that if we get enough errors, we halt again
         for i in xrange(error_count):
             http_error = httpclient.UnknownHostError('fake.echonest.host')
             with self.allow_warnings():
                 _echonest_processor._echonest_errback(path_iter.next(),
                                                       http_error)
-        self.assertEquals(_echonest_processor._querying_echonest, False)
+        self.assert_(len(_echonest_processor._echonest_queries) < query_limit)
+        self.assertEquals(_echonest_processor._waiting_from_http_errors, True)
         mock_add_timeout.assert_called_once_with(
             timeout, _echonest_processor._restart_after_http_errors,
             MatchAny())
@@ -1610,11 +1930,11 @@ class TestCodegen(EventLoopTest):
 
 mock_grab_url = mock.Mock()
 @mock.patch('miro.httpclient.grab_url', new=mock_grab_url)
-class TestEchonestQueries(MiroTestCase):
+class TestEchonestQueries(EventLoopTest):
     """Test our echonest handling code"""
 
     def setUp(self):
-        MiroTestCase.setUp(self)
+        EventLoopTest.setUp(self)
         mock_grab_url.reset_mock()
         self.callback_data = self.errback_data = None
         self.path = "/videos/FakeSong.mp3"
@@ -1636,10 +1956,12 @@ class TestEchonestQueries(MiroTestCase):
             391641, 341656, 284075, 280538, 283379, 312343, 669160, 391639,
         ]
         self.thriller_release_id = 282494
-        echonest._EchonestQuery.seven_digital_cache = {}
+        self.callback_count = 0
+        echonest._requests_in_flight.clear()
 
     def callback(self, *args):
         self.callback_data = args
+        self.callback_count += 1
 
     def errback(self, *args):
         self.errback_data = args
@@ -2051,6 +2373,9 @@ class TestEchonestQueries(MiroTestCase):
         replys_with_errors = set([283379, 307167, 312343, 391641, 518377, ])
 
         self.check_7digital_grab_url_calls(release_ids)
+        # 312343 is listed twice, but we should only fetch it once
+        self.assertEquals(mock_grab_url.call_count, len(release_ids) - 1)
+        del release_ids[13]
 
         # send replies
         for i, release_id in enumerate(release_ids):
@@ -2087,7 +2412,9 @@ class TestEchonestQueries(MiroTestCase):
                        624250, 312343, 391641, 341656, 284075, 280538, 283379,
                        312343, 669160, 391639,
                       ]
-        # send HTTP errors for all results
+        # send HTTP errors for all results.  312343 is listed twice, but we
+        # only fetch it once
+        del release_ids[13]
         for i in xrange(len(release_ids) - 1):
             self.send_http_error(i, reset_mock=False)
         self.send_http_error(len(release_ids)-1, reset_mock=True)
@@ -2106,8 +2433,8 @@ class TestEchonestQueries(MiroTestCase):
         # skipn the 7digital step
         self.check_callback()
 
-    def test_7digital_caching(self):
-        # test that we cache 7digital results
+    def test_response_caching(self):
+        # test that we cache echonest and 7digital results
         self.start_query_with_tags()
         self.check_echonest_grab_url_call()
         self.send_echonest_reply('rock-music')
@@ -2117,17 +2444,80 @@ class TestEchonestQueries(MiroTestCase):
         self.send_album_art_reply()
         self.check_callback()
         old_metadata = self.reply_metadata
-        # start a new query that results in the same release id.
-        self.echonest_code = 'fake-code-2'
+        # start the same query again.  We shouldn't call grab_url
+        self.callback_data = None
+        self.start_query_with_tags()
+        self.runPendingIdles()
+        self.check_grab_url_not_called()
+        self.reply_metadata = old_metadata
+        del self.reply_metadata['created_cover_art']
+        self.check_callback()
+
+    def test_7digital_caching(self):
+        # test that we cache 7digital results for different echonest queries
         self.start_query_with_tags()
         self.check_echonest_grab_url_call()
         self.send_echonest_reply('rock-music')
-        # we shouldn't call grab_URL
+        self.send_7digital_reply(self.bossanova_release_id)
+        self.send_album_art_reply()
+        self.check_callback()
+        old_metadata = self.reply_metadata
+        # start a new query that results in the same release id.
+        self.callback_data = None
+        self.start_query_with_echonest_id()
+        self.send_echonest_reply('rock-music')
+        self.runPendingIdles()
         self.check_grab_url_not_called()
         self.reply_metadata = old_metadata
         del self.reply_metadata['created_cover_art']
         self.check_callback()
 
+    def test_negative_caching(self):
+        # test that we cache replies that don't match anything, but only for
+        # a short time
+        self.start_query_with_tags()
+        with self.allow_warnings():
+            self.send_echonest_reply('no-match')
+        self.check_callback()
+        entry = echonest.ResponseCacheEntry.make_view().get_singleton()
+        self.assert_(entry.expires < time.time() +
+                     echonest.ResponseCacheEntry.NEGATIVE_TTL + 1)
+        self.callback_data = None
+        self.start_query_with_tags()
+        with self.allow_warnings():
+            self.runPendingIdles()
+        self.check_grab_url_not_called()
+        self.check_callback()
+        # after the entry expires, we should query echonest again
+        entry.expires = time.time() - 1
+        entry.signal_change()
+        self.start_query_with_tags()
+        self.check_echonest_grab_url_call()
+
+    def test_errors_not_cached(self):
+        # test that we don't cache HTTP errors or echonest error replies
+        self.start_query_with_tags()
+        self.send_http_error(reset_mock=True)
+        self.start_query_with_tags()
+        self.check_echonest_grab_url_call()
+        with self.allow_warnings():
+            self.send_echonest_reply('error')
+        self.start_query_with_tags()
+        self.check_echonest_grab_url_call()
+
+    def test_coalesce_requests(self):
+        # test that identical requests in progress share a single reply
+        self.start_query_with_tags()
+        self.start_query_with_tags()
+        self.check_echonest_grab_url_call()
+        self.send_echonest_reply('rock-music')
+        self.check_7digital_grab_url_calls([self.bossanova_release_id])
+        self.send_7digital_reply(self.bossanova_release_id)
+        self.check_album_art_grab_url_call()
+        self.send_album_art_reply()
+        self.assertEquals(self.callback_count, 2)
+        self.check_callback()
+
     def test_avoid_redownloading_album_art(self):
         # test that we don't download album art that we already have
         album_art_path = os.path.join(self.album_art_dir, 'Bossanova')
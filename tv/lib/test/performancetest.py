@@ -0,0 +1,963 @@
+"""Performance tests.
+
+These only run if they're listed on the command line, for example
+"./run.sh miro.test.performancetest".
+"""
+
+import cPickle
+import heapq
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3, ID3NoHeaderError, APIC, TALB, TIT2, TPE1
+
+from miro import app
+from miro import coverart
+from miro import downloader
+from miro import feedparserutil
+from miro import feedupdate
+from miro import fileutil
+from miro import filetags
+from miro import httpclient
+from miro import messages
+from miro import metadata
+from miro import prefs
+from miro import subprocessmanager
+from miro import workerprocess
+from miro.item import Item
+from miro.test import mock
+from miro.test import testobjects
+from miro.test.feedparsertest import _make_feed
+from miro.test.feedtest import FeedTestCase
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 only_on_platforms, uses_httpclient)
+from miro.test.subprocesstest import PipeTestCase
+from miro.dl_daemon import download
+from miro.plat import resources
+
+def report(message, *args):
+    """Print the results of a performance test.
+
+    We can't use logging for this, MiroTestCase turns warnings into errors
+    and drops the other messages.
+    """
+    sys.stderr.write("\n" + (message % args) + "\n")
+
+def make_status(dlid, **kwargs):
+    status = {
+        'dlid': dlid,
+        'url': u'http://example.com/%s.mp4' % dlid,
+        'state': u'downloading',
+        'total_size': 123456789,
+        'current_size': 1234567,
+        'eta': 30,
+        'rate': 12345.5,
+        'upload_size': 0,
+        'filename': '/tmp/Incomplete Downloads/%s.mp4.part' % dlid,
+        'start_time': 1300000000.25,
+        'end_time': None,
+        'short_filename': '%s.mp4' % dlid,
+        'reason_failed': u'No Error',
+        'short_reason_failed': u'No Error',
+        'type': 'HTTP',
+        'retry_time': None,
+        'retry_count': -1,
+    }
+    status.update(kwargs)
+    return status
+
+class DownloadWriteThroughputTest(MiroTestCase):
+    """Measure how fast we can write data for many concurrent downloads.
+
+    We feed libcurl-sized chunks for each download in round-robin order and
+    compare writing each chunk directly (the old CurlTransfer._write_file())
+    to BufferedFileWriter with preallocation and a FileWriterThread.  If
+    /dev/shm exists we write there, as a stand-in for a fast disk.
+    """
+    DOWNLOAD_COUNT = 50
+    FILE_SIZE = 4 * 1024 * 1024
+    CHUNK_SIZE = 16 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+            self.directory = tempfile.mkdtemp(dir='/dev/shm')
+        else:
+            self.directory = os.path.join(self.tempdir, 'downloads')
+            os.mkdir(self.directory)
+        self.chunk = os.urandom(self.CHUNK_SIZE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        MiroTestCase.tearDown(self)
+
+    def open_files(self, name):
+        return [fileutil.open_file(os.path.join(self.directory,
+                                                '%s-%d' % (name, i)), 'wb')
+                for i in xrange(self.DOWNLOAD_COUNT)]
+
+    def write_chunks(self, writers):
+        for i in xrange(self.FILE_SIZE // self.CHUNK_SIZE):
+            for writer in writers:
+                writer.write(self.chunk)
+
+    def time_direct(self):
+        start = time.time()
+        files = self.open_files('direct')
+        self.write_chunks(files)
+        for f in files:
+            f.close()
+        return time.time() - start
+
+    def time_buffered(self):
+        writer_thread = httpclient.FileWriterThread()
+        writer_thread.start()
+        start = time.time()
+        writers = [httpclient.BufferedFileWriter(f, writer_thread)
+                   for f in self.open_files('buffered')]
+        for writer in writers:
+            writer.preallocate(self.FILE_SIZE)
+        self.write_chunks(writers)
+        for writer in writers:
+            writer.close()
+        writer_thread.stop()
+        elapsed = time.time() - start
+        for writer in writers:
+            self.assertEquals(writer.error, None)
+        return elapsed
+
+    def test_write_throughput(self):
+        total_mb = self.DOWNLOAD_COUNT * self.FILE_SIZE / (1024.0 * 1024.0)
+        direct_time = self.time_direct()
+        buffered_time = self.time_buffered()
+        total_size = self.DOWNLOAD_COUNT * self.FILE_SIZE
+        report("%d concurrent downloads to %s: direct writes: %.1f MB/s "
+               "(%d writes); buffered writes: %.1f MB/s (%d writes)",
+               self.DOWNLOAD_COUNT, self.directory,
+               total_mb / direct_time, total_size // self.CHUNK_SIZE,
+               total_mb / buffered_time,
+               total_size // httpclient.WRITE_BUFFER_SIZE)
+
+class DownloadStatusEncodingTest(MiroTestCase):
+    """Compare ways to send download statuses from the daemon.
+
+    - full: pickle every field of every status, the original protocol
+    - delta: pickle only the fields that changed since the last tick, which
+      is what DownloadStatusUpdater sends
+    - struct: packed records with the fields that change every tick, and
+      dlids sent once per connection.  This is about the best that a
+      binary protocol could do.
+    """
+    DOWNLOAD_COUNT = 500
+    TICKS = 20
+    # dlid id, current_size, rate, eta
+    RECORD = struct.Struct('!IQdi')
+
+    def make_ticks(self):
+        return [[make_status(u'dl%d' % i, current_size=tick * 100000 + i,
+                             rate=1000.0 + tick, eta=3600 - tick)
+                 for i in xrange(self.DOWNLOAD_COUNT)]
+                for tick in xrange(self.TICKS)]
+
+    def time_full(self, ticks):
+        start = time.time()
+        size = 0
+        for statuses in ticks:
+            data = cPickle.dumps(statuses, cPickle.HIGHEST_PROTOCOL)
+            cPickle.loads(data)
+            size += len(data)
+        return time.time() - start, size
+
+    def time_delta(self, ticks):
+        updater = download.DownloadStatusUpdater()
+        start = time.time()
+        size = 0
+        for statuses in ticks:
+            deltas = [updater.calc_delta(status) for status in statuses]
+            data = cPickle.dumps(deltas, cPickle.HIGHEST_PROTOCOL)
+            cPickle.loads(data)
+            size += len(data)
+        return time.time() - start, size
+
+    def time_struct(self, ticks):
+        record = self.RECORD
+        dlid_ids = {}
+        dlids = []
+        start = time.time()
+        size = 0
+        for statuses in ticks:
+            # encode
+            new_dlids = []
+            parts = []
+            for status in statuses:
+                dlid = status['dlid']
+                if dlid not in dlid_ids:
+                    dlid_ids[dlid] = len(dlid_ids)
+                    new_dlids.append(dlid)
+                parts.append(record.pack(dlid_ids[dlid],
+                                         status['current_size'],
+                                         status['rate'], status['eta']))
+            header = cPickle.dumps(new_dlids, cPickle.HIGHEST_PROTOCOL)
+            data = (struct.pack('!I', len(header)) + header +
+                    ''.join(parts))
+            # decode
+            header_size = struct.unpack_from('!I', data)[0]
+            dlids.extend(cPickle.loads(data[4:4 + header_size]))
+            decoded = []
+            for offset in xrange(4 + header_size, len(data), record.size):
+                dlid_id, current_size, rate, eta = record.unpack_from(data,
+                                                                      offset)
+                decoded.append({'dlid': dlids[dlid_id],
+                                'current_size': current_size,
+                                'rate': rate, 'eta': eta})
+            size += len(data)
+        return time.time() - start, size
+
+    def test_encode_decode(self):
+        ticks = self.make_ticks()
+        results = [(name, method(ticks)) for name, method in (
+            ('full pickle', self.time_full),
+            ('delta pickle', self.time_delta),
+            ('struct', self.time_struct))]
+        report("%d download statuses per tick, average of %d ticks:",
+               self.DOWNLOAD_COUNT, self.TICKS)
+        for name, (elapsed, size) in results:
+            report("%s: %.2fms encode+decode, %.1fKB", name,
+                   elapsed * 1000 / self.TICKS, size / 1024.0 / self.TICKS)
+
+class FakeTransfer(object):
+    """Stands in for a BGDownloader in the daemon."""
+    def __init__(self, dlid):
+        self.dlid = dlid
+        self.current_size = 0
+
+    def get_status(self):
+        return make_status(self.dlid, current_size=self.current_size,
+                           rate=1000.0)
+
+class DownloadProgressRateTest(MiroTestCase):
+    """Measure how much backend CPU we spend on progress updates for active
+    transfers that the user can't see.
+    """
+    DOWNLOAD_COUNT = 200
+    SIMULATED_SECONDS = 60
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_for_test('miro.flashscraper.try_scraping_url')
+        self.mock_send = self.patch_for_test(
+            'miro.dl_daemon.command.Command.send')
+        self.mock_clock = self.patch_for_test('miro.dl_daemon.download.clock')
+        feed = testobjects.make_feed()
+        self.transfers = []
+        for i in xrange(self.DOWNLOAD_COUNT):
+            url = u'http://example.com/video-%d.mp4' % i
+            item = testobjects.make_item(feed, u'item %d' % i, url=url)
+            dl = downloader.RemoteDownloader(url, item, u'video/mp4')
+            self.transfers.append(FakeTransfer(dl.dlid))
+
+    def run_simulation(self, updater):
+        """Simulate SIMULATED_SECONDS of transfers.
+
+        The daemon side is simulated, the backend side is real.
+
+        :returns: (backend CPU time, number of statuses sent)
+        """
+        backend_time = 0.0
+        status_count = 0
+        ticks = int(self.SIMULATED_SECONDS / updater.UPDATE_CLIENT_INTERVAL)
+        for tick in xrange(ticks):
+            now = tick * updater.UPDATE_CLIENT_INTERVAL
+            self.mock_clock.return_value = now
+            if now == int(now):
+                # transfers poll their stats once a second
+                for transfer in self.transfers:
+                    transfer.current_size += 1000
+                    updater.queue_update(transfer)
+            self.mock_send.reset_mock()
+            updater.do_update(periodic=False)
+            for args, kwargs in self.mock_send.call_args_list:
+                cmd = args[0]
+                status_count += len(cmd.args[0])
+                start = time.clock()
+                cmd.action()
+                backend_time += time.clock() - start
+        return backend_time, status_count
+
+    def test_no_visible_downloads(self):
+        visible = download.DownloadStatusUpdater()
+        visible.set_visible(True, [])
+        visible_time, visible_count = self.run_simulation(visible)
+        for transfer in self.transfers:
+            transfer.current_size = 0
+        hidden = download.DownloadStatusUpdater()
+        hidden_time, hidden_count = self.run_simulation(hidden)
+        report("%d transfers for %ds: all visible: %.2fms backend "
+                "CPU, %d statuses; none visible: %.2fms backend CPU, "
+                "%d statuses",
+                self.DOWNLOAD_COUNT, self.SIMULATED_SECONDS,
+                visible_time * 1000, visible_count,
+                hidden_time * 1000, hidden_count)
+        self.assert_(hidden_count < visible_count)
+
+class FeedEntryMatchingTest(FeedTestCase):
+    """Time updating a big feed whose entries don't have guids."""
+    ENTRY_COUNT = 5000
+
+    def write_feed(self, title_prefix):
+        parts = ["""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Big Feed</title>
+      <link>http://example.com/</link>
+      <description>Lots of entries without guids</description>
+"""]
+        for i in xrange(self.ENTRY_COUNT):
+            parts.append("""\
+<item>
+ <title>%s %d</title>
+ <enclosure url="http://example.com/video-%d.mpg" length="%d"
+    type="video/mpeg" />
+</item>
+""" % (title_prefix, i, i, 1000 + i))
+        parts.append("""
+   </channel>
+</rss>""")
+        self.write_file("".join(parts))
+
+    def test_update_guidless_feed(self):
+        self.write_feed("Video")
+        start = time.time()
+        feed = self.make_feed()
+        create_time = time.time() - start
+        # Change the titles so that entries have to be matched by their
+        # enclosures
+        self.write_feed("Renamed video")
+        start = time.time()
+        self.update_feed(feed)
+        update_time = time.time() - start
+        report("%d entries without guids: initial parse: %.2fs, "
+                "update: %.2fs", self.ENTRY_COUNT, create_time, update_time)
+        self.assertEquals(Item.make_view().count(), self.ENTRY_COUNT)
+
+class SimulatedFeed(object):
+    """Feed that publishes an entry every cadence seconds."""
+    def __init__(self, id_, cadence, offset):
+        self.id = id_
+        self.cadence = cadence
+        self.offset = offset
+        self.last_seen = None
+
+    def get_title(self):
+        return u'Feed %d' % self.id
+
+    def release_times(self, now):
+        count = int((now - self.offset) // self.cadence)
+        return [self.offset + i * self.cadence
+                for i in xrange(max(0, count - 9), count + 1)]
+
+class FeedPollingTest(MiroTestCase):
+    """Compare the number of feed updates and how late we find new entries
+    with adaptive polling and with polling at a fixed interval.
+    """
+    FEED_COUNT = 2000
+    SIMULATED_DAYS = 7
+    UPDATE_FREQ = 60 * 60
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        rand = random.Random(0)
+        self.feeds = []
+        for i in xrange(self.FEED_COUNT):
+            cadence = rand.choice([3600, 6 * 3600, 86400, 7 * 86400])
+            offset = -rand.uniform(0, cadence)
+            self.feeds.append(SimulatedFeed(i, cadence, offset))
+
+    def run_simulation(self, adaptive):
+        """Simulate polling all feeds.
+
+        :returns: (number of polls, mean seconds before finding entries)
+        """
+        queue = feedupdate.FeedUpdateQueue()
+        end = self.SIMULATED_DAYS * 86400
+        heap = [(random.uniform(0, feedupdate.STARTUP_SPREAD), feed)
+                for feed in self.feeds]
+        heapq.heapify(heap)
+        polls = 0
+        lateness = []
+        while heap:
+            now, feed = heapq.heappop(heap)
+            if now > end:
+                continue
+            polls += 1
+            release_times = feed.release_times(now)
+            newest = release_times[-1]
+            if feed.last_seen is None or newest > feed.last_seen:
+                if feed.last_seen is not None:
+                    lateness.extend(now - t for t in release_times
+                                    if t > feed.last_seen)
+                feed.last_seen = newest
+                queue.record_response(feed, {'status': 200})
+                queue.record_entries(feed, release_times)
+            else:
+                queue.record_response(feed, {'status': 304})
+            if adaptive:
+                delay = queue.calc_delay(feed, self.UPDATE_FREQ, now=now)
+            else:
+                delay = self.UPDATE_FREQ
+            heapq.heappush(heap, (now + delay, feed))
+        return polls, sum(lateness) / len(lateness)
+
+    def test_adaptive_polling(self):
+        fixed_polls, fixed_lateness = self.run_simulation(False)
+        for feed in self.feeds:
+            feed.last_seen = None
+        adaptive_polls, adaptive_lateness = self.run_simulation(True)
+        report("%d feeds for %d days: fixed interval: %d updates, "
+                "new entries found after %.1f minutes; adaptive: %d updates, "
+                "new entries found after %.1f minutes",
+                self.FEED_COUNT, self.SIMULATED_DAYS,
+                fixed_polls, fixed_lateness / 60,
+                adaptive_polls, adaptive_lateness / 60)
+        self.assert_(adaptive_polls < fixed_polls)
+
+class FeedRefreshTest(EventLoopTest):
+    """Measure the wall time of refreshing many feeds with and without
+    reusing libcurl handles between transfers.
+    """
+    FEED_COUNT = 300
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.start_http_server(threaded=True)
+
+    def refresh_feeds(self):
+        hosts = ['localhost', '127.0.0.1']
+        self.finished = self.errors = 0
+        def callback(info):
+            self.finished += 1
+            if self.finished + self.errors == self.FEED_COUNT:
+                self.stopEventLoop(abnormal=False)
+        def errback(error):
+            self.errors += 1
+            if self.finished + self.errors == self.FEED_COUNT:
+                self.stopEventLoop(abnormal=False)
+        start = time.time()
+        for i in xrange(self.FEED_COUNT):
+            url = self.httpserver.build_url('feed.xml',
+                                            host=hosts[i % len(hosts)])
+            httpclient.grab_url(url, callback, errback,
+                                priority=httpclient.PRIORITY_FEED)
+        self.runEventLoop(timeout=120)
+        self.assertEquals(self.errors, 0)
+        self.assertEquals(self.finished, self.FEED_COUNT)
+        return time.time() - start
+
+    @uses_httpclient
+    def test_refresh_feeds(self):
+        with mock.patch.object(httpclient, 'MAX_FREE_HANDLES', 0):
+            closed_time = self.refresh_feeds()
+        reused_time = self.refresh_feeds()
+        report("refreshing %d feeds: %.2fs closing handles, "
+               "%.2fs reusing handles", self.FEED_COUNT, closed_time,
+               reused_time)
+
+class IncrementalFeedParseTest(MiroTestCase):
+    """Compare the worker process side of a full parse of a big feed and an
+    incremental one.
+    """
+    ENTRY_COUNT = 3000
+
+    def parse_and_pickle(self, data, known_fingerprints=None):
+        start = time.time()
+        parsed = feedparserutil.parse(data, known_fingerprints,
+                                      stop_after=20)
+        pickled = cPickle.dumps(parsed, cPickle.HIGHEST_PROTOCOL)
+        return parsed, time.time() - start, len(pickled)
+
+    def test_incremental_parse(self):
+        parsed, full_time, full_size = self.parse_and_pickle(
+            _make_feed(self.ENTRY_COUNT))
+        known = set(parsed['entry_fingerprints'])
+        new_data = _make_feed(self.ENTRY_COUNT, first_entry=5)
+        parsed, incremental_time, incremental_size = self.parse_and_pickle(
+            new_data, known)
+        report("%d entries: full parse: %.2fs, %d bytes; "
+                "incremental parse: %.2fs, %d bytes",
+                self.ENTRY_COUNT, full_time, full_size, incremental_time,
+                incremental_size)
+        self.assertEquals(len(parsed['entries']), 5)
+        self.assert_(incremental_size < full_size / 10)
+
+class MutagenImportTest(EventLoopTest):
+    """Import a synthetic library through the metadata system.
+
+    We run the import with a single path per mutagen task, like we used to,
+    then with the normal batch size.
+    """
+    FILE_COUNT = 10000
+    TIMEOUT = 600
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        app.config.set(prefs.NET_LOOKUP_BY_DEFAULT, False)
+        workerprocess.startup()
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def make_library(self, name):
+        """Copy a test mp3 file FILE_COUNT times and give each copy
+        different tags.
+        """
+        source_path = resources.path('testdata/metadata/mp3-0.mp3')
+        paths = []
+        for i in xrange(self.FILE_COUNT):
+            artist = 'artist-%d' % (i // 100)
+            album = 'album-%d' % (i // 10)
+            directory = os.path.join(self.tempdir, name, artist, album)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'track-%d.mp3' % i)
+            shutil.copyfile(source_path, path)
+            try:
+                tags = EasyID3(path)
+            except ID3NoHeaderError:
+                tags = EasyID3()
+            tags['title'] = u'Track %d' % i
+            tags['artist'] = unicode(artist)
+            tags['album'] = unicode(album)
+            tags['tracknumber'] = unicode(i % 10 + 1)
+            tags.save(path)
+            paths.append(path)
+        return paths
+
+    def time_import(self, name, batch_size):
+        paths = self.make_library(name)
+        cover_art_dir = os.path.join(self.tempdir, name + '-cover-art')
+        screenshot_dir = os.path.join(self.tempdir, name + '-screenshots')
+        manager = metadata.LibraryMetadataManager(cover_art_dir,
+                                                  screenshot_dir)
+        manager.mutagen_processor.batch_size = batch_size
+        if batch_size == 1:
+            # match the old code, which sent up to 100 MutagenTasks at once
+            manager.mutagen_processor.path_limit = lambda: 100
+        start = time.time()
+        with manager.bulk_add():
+            for path in paths:
+                manager.add_file(path)
+        while manager.mutagen_processor.task_count() > 0:
+            if time.time() - start > self.TIMEOUT:
+                raise AssertionError("import didn't finish in %ss" %
+                                     self.TIMEOUT)
+            self.runEventLoop(0.1, timeoutNormal=True)
+        manager.run_updates()
+        elapsed = time.time() - start
+        manager.close()
+        return elapsed
+
+    def test_import(self):
+        single_time = self.time_import('single', 1)
+        batch_time = self.time_import('batched',
+                metadata.MetadataManagerBase.MUTAGEN_BATCH_SIZE)
+        report("import %d files: one path per task: %.1fs "
+                "(%.0f files/s) batched: %.1fs (%.0f files/s)",
+                self.FILE_COUNT, single_time, self.FILE_COUNT / single_time,
+                batch_time, self.FILE_COUNT / batch_time)
+
+class ScreenshotExtractionTest(EventLoopTest):
+    """Run the movie data program on a batch of videos.
+
+    We compare a single worker process that has to calculate every duration
+    itself, like we used to, with the movie data pool using the durations
+    from mutagen.
+    """
+    VIDEO_COUNT = 2000
+    TIMEOUT = 1800
+
+    def tearDown(self):
+        workerprocess.shutdown()
+        EventLoopTest.tearDown(self)
+
+    def make_videos(self, name):
+        source_path = resources.path(
+            'testdata/metadata/theora_with_ogg_extension.ogg')
+        directory = os.path.join(self.tempdir, name)
+        os.makedirs(directory)
+        paths = []
+        for i in xrange(self.VIDEO_COUNT):
+            path = os.path.join(directory, 'video-%d.ogg' % i)
+            shutil.copyfile(source_path, path)
+            paths.append(path)
+        return paths
+
+    def callback(self, msg, result):
+        self.results.append(result)
+        if len(self.results) == self.VIDEO_COUNT:
+            self.stopEventLoop(abnormal=False)
+
+    def errback(self, msg, error):
+        self.errors.append(error)
+        self.callback(msg, error)
+
+    def time_extraction(self, name, process_count, duration):
+        paths = self.make_videos(name)
+        screenshot_dir = os.path.join(self.tempdir, name + '-screenshots')
+        os.makedirs(screenshot_dir)
+        self.results = []
+        self.errors = []
+        workerprocess.startup(process_count=process_count)
+        start = time.time()
+        for path in paths:
+            msg = workerprocess.MovieDataProgramTask(path, screenshot_dir,
+                                                     duration)
+            workerprocess.send(msg, self.callback, self.errback)
+        self.runEventLoop(self.TIMEOUT)
+        elapsed = time.time() - start
+        workerprocess.shutdown()
+        workerprocess._subprocess_manager = \
+                workerprocess.WorkerSubprocessManager()
+        workerprocess._movie_data_manager = \
+                workerprocess.WorkerSubprocessManager()
+        self.assertEquals(self.errors, [])
+        self.assertEquals(len(self.results), self.VIDEO_COUNT)
+        return elapsed
+
+    @only_on_platforms('linux', 'win32')
+    def test_extraction(self):
+        single_time = self.time_extraction('single', 1, None)
+        pool_time = self.time_extraction('pool',
+                workerprocess.default_process_count(), 1044)
+        report("screenshots for %d videos: one process: %.1fs "
+                "(%.0f files/s) pool: %.1fs (%.0f files/s)",
+                self.VIDEO_COUNT, single_time, self.VIDEO_COUNT / single_time,
+                pool_time, self.VIDEO_COUNT / pool_time)
+
+class ProgressUpdateCountTest(EventLoopTest):
+    """Count the MetadataProgressUpdate messages sent during an import.
+
+    We simulate the count tracker calls for a library import that finishes
+    one mutagen batch every BATCH_TIME seconds.  We compare sending updates
+    after every batch, like we used to, with the coalesced updates.
+    """
+    FILE_COUNT = 20000
+    BATCH_TIME = 0.005
+
+    def import_files(self, name, send_updates):
+        manager = metadata.LibraryMetadataManager(self.tempdir, self.tempdir)
+        tracker = manager.count_tracker
+        batch_size = metadata.MetadataManagerBase.MUTAGEN_BATCH_SIZE
+        paths = ['/videos/%s/track-%d.mp3' % (name, i)
+                 for i in xrange(self.FILE_COUNT)]
+        self.get_frontend_messages()
+        start_cpu = time.clock()
+        for path in paths:
+            tracker.file_started(path, {'file_type': u'audio'})
+        for i in xrange(0, self.FILE_COUNT, batch_size):
+            for path in paths[i:i+batch_size]:
+                tracker.file_updated(path, {'file_type': u'audio',
+                                            'duration': 200})
+                tracker.file_finished(path)
+            send_updates(manager)
+            self.runEventLoop(self.BATCH_TIME, timeoutNormal=True)
+        manager._send_progress_updates_caller.call_now()
+        cpu_time = time.clock() - start_cpu
+        message_count = len([m for m in self.get_frontend_messages()
+                             if isinstance(m, messages.MetadataProgressUpdate)])
+        manager.close()
+        return message_count, cpu_time
+
+    def test_progress_updates(self):
+        def send_every_batch(manager):
+            manager._sent_progress_counts.clear()
+            manager._send_progress_updates_now()
+        def send_coalesced(manager):
+            manager._send_progress_updates()
+        old_count, old_cpu = self.import_files('old', send_every_batch)
+        new_count, new_cpu = self.import_files('new', send_coalesced)
+        report("progress updates for %d files: every batch: %d "
+                "messages, %.2fs CPU; coalesced: %d messages, %.2fs CPU",
+                self.FILE_COUNT, old_count, old_cpu, new_count, new_cpu)
+        self.assert_(new_count < old_count / 10)
+
+class MetadataRefreshTest(MiroTestCase):
+    """Time refresh_metadata_for_paths() for a large library.
+
+    We compare merging the MetadataEntry objects for each path, like we used
+    to, with using MetadataStatus.entry_metadata.
+    """
+    PATH_COUNT = 50000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = metadata.LibraryMetadataManager(self.tempdir,
+                                                       self.tempdir)
+        self.paths = []
+        app.bulk_sql_manager.start()
+        try:
+            for i in xrange(self.PATH_COUNT):
+                self.paths.append(self.add_path(i))
+        finally:
+            app.bulk_sql_manager.finish()
+
+    def add_path(self, i):
+        path = '/videos/track-%d.mp3' % i
+        status = metadata.MetadataStatus(path, False)
+        entry_data = [
+            (u'mutagen', {'file_type': u'audio', 'duration': 200,
+                          'title': u'Track %d' % i,
+                          'artist': u'artist-%d' % (i // 100),
+                          'album': u'album-%d' % (i // 10),
+                          'track': i % 10 + 1}),
+            (u'movie-data', {'file_type': u'audio', 'duration': 201}),
+            (u'user-data', {'title': u'My Track %d' % i}),
+        ]
+        for source, data in entry_data:
+            entry = metadata.MetadataEntry(status, source, data)
+            status.set_entry_metadata(entry)
+        return path
+
+    def merge_entries(self, path):
+        """get_metadata() from before we stored entry_metadata."""
+        status = self.manager._get_status_for_path(path)
+        rv = self.manager._get_metadata_from_filename(path)
+        for entry in metadata.MetadataEntry.metadata_for_status(status):
+            rv.update(entry.get_metadata())
+        rv['has_drm'] = status.get_has_drm()
+        rv['net_lookup_enabled'] = status.net_lookup_enabled
+        self.manager._add_cover_art(rv)
+        return rv
+
+    def time_refresh(self):
+        start = time.time()
+        self.manager.refresh_metadata_for_paths(self.paths)
+        return time.time() - start
+
+    def test_refresh(self):
+        new_metadata = []
+        self.manager.connect('new-metadata',
+                             lambda manager, data: new_metadata.append(data))
+        self.manager.get_metadata = self.merge_entries
+        merge_time = self.time_refresh()
+        del self.manager.get_metadata
+        stored_time = self.time_refresh()
+        self.assertEquals(new_metadata[0], new_metadata[1])
+        report("refresh_metadata_for_paths() for %d paths: "
+                "merging entries: %.1fs stored entry_metadata: %.1fs",
+                self.PATH_COUNT, merge_time, stored_time)
+
+class CoverArtImportTest(MiroTestCase):
+    """Measure cover art writes and disk usage when importing a library.
+
+    The library has 10 tracks per album with embedded cover art.  Albums are
+    compilations that share a smaller set of cover images.
+    """
+    FILE_COUNT = 5000
+    TRACKS_PER_ALBUM = 10
+    IMAGE_COUNT = 50
+    IMAGE_SIZE = 32 * 1024
+
+    def make_library(self):
+        source_path = resources.path('testdata/metadata/mp3-0.mp3')
+        images = [('image-%d ' % i) * (self.IMAGE_SIZE // 10)
+                  for i in xrange(self.IMAGE_COUNT)]
+        directory = os.path.join(self.tempdir, 'library')
+        os.makedirs(directory)
+        paths = []
+        for i in xrange(self.FILE_COUNT):
+            album_index = i // self.TRACKS_PER_ALBUM
+            path = os.path.join(directory, 'track-%d.mp3' % i)
+            shutil.copyfile(source_path, path)
+            tags = ID3()
+            tags.add(TIT2(encoding=3, text=u'Track %d' % i))
+            tags.add(TPE1(encoding=3, text=u'Various Artists'))
+            tags.add(TALB(encoding=3, text=u'Album %d' % album_index))
+            tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc=u'',
+                          data=images[album_index % self.IMAGE_COUNT]))
+            tags.save(path)
+            paths.append(path)
+        return paths
+
+    def disk_usage(self, directory):
+        """Calculate the disk usage for a directory.
+
+        :returns: (usage counting hard linked files once, usage counting
+            each file separately)
+        """
+        seen_inodes = set()
+        usage = separate_usage = 0
+        for dirpath, dirnames, filenames in os.walk(directory):
+            in_store = (os.path.basename(dirpath) ==
+                        coverart.CONTENT_STORE_DIRECTORY)
+            for filename in filenames:
+                stat_info = os.stat(os.path.join(dirpath, filename))
+                if not in_store:
+                    separate_usage += stat_info.st_size
+                inode = (stat_info.st_dev, stat_info.st_ino)
+                if inode not in seen_inodes:
+                    seen_inodes.add(inode)
+                    usage += stat_info.st_size
+        return usage, separate_usage
+
+    def test_import(self):
+        paths = self.make_library()
+        cover_art_dir = os.path.join(self.tempdir, 'cover-art')
+        os.makedirs(cover_art_dir)
+        writes = []
+        org_write_to_file = coverart.Image.write_to_file
+        def write_to_file(image, path):
+            writes.append(path)
+            org_write_to_file(image, path)
+        coverart.Image.write_to_file = write_to_file
+        try:
+            for path in paths:
+                filetags.process_file(path, cover_art_dir)
+        finally:
+            coverart.Image.write_to_file = org_write_to_file
+        usage, separate_usage = self.disk_usage(cover_art_dir)
+        album_count = self.FILE_COUNT // self.TRACKS_PER_ALBUM
+        self.assertEquals(len(writes), self.IMAGE_COUNT)
+        # writing a file per album is what we did before the content store
+        report("cover art for %d files: a file per album: %d writes "
+                "%.1fMB content store: %d writes %.1fMB",
+                self.FILE_COUNT, album_count, separate_usage / 1024.0 ** 2,
+                len(writes), usage / 1024.0 ** 2)
+
+class NetLookupRetryTest(MiroTestCase):
+    """Time retry_net_lookup() for a library with many incomplete lookups.
+
+    We compare restarting every lookup at once, like we used to, with
+    restarting them in chunks.  We also time canceling half of the queued
+    lookups.
+    """
+    LOOKUP_COUNT = 40000
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.patch_function('miro.echonest.query_echonest',
+                            lambda *args: None)
+        self.paths = []
+        app.bulk_sql_manager.start()
+        try:
+            for i in xrange(self.LOOKUP_COUNT):
+                self.paths.append(self.add_path(i))
+        finally:
+            app.bulk_sql_manager.finish()
+
+    def add_path(self, i):
+        path = '/videos/track-%d.mp3' % i
+        status = metadata.MetadataStatus(path, True)
+        status.mutagen_status = status.STATUS_COMPLETE
+        status.moviedata_status = status.STATUS_SKIP
+        status.echonest_status = status.STATUS_COMPLETE
+        status._set_current_processor()
+        status.signal_change()
+        # echonest found the song, but 7digital didn't find the album
+        metadata.MetadataEntry(status, u'echonest', {'title': u'Track %d' % i})
+        return path
+
+    def time_retry(self, chunk_size):
+        manager = metadata.LibraryMetadataManager(self.tempdir, self.tempdir)
+        manager._retry_net_lookup_runner.chunk_size = chunk_size
+        start = time.time()
+        manager.retry_net_lookup()
+        retry_time = time.time() - start
+        start = time.time()
+        manager.echonest_processor.remove_tasks_for_paths(
+            self.paths[::2])
+        cancel_time = time.time() - start
+        manager.close()
+        return retry_time, cancel_time
+
+    def test_retry(self):
+        # cancel while all the paths are queued up
+        all_retry, cancel_time = self.time_retry(self.LOOKUP_COUNT)
+        chunked_retry, _ = self.time_retry(
+            metadata.MetadataManagerBase.RESTART_CHUNK_SIZE)
+        report("retry_net_lookup() for %d paths: all at once: %.2fs "
+                "chunked: %.2fs.  Canceling %d queued paths: %.2fs",
+                self.LOOKUP_COUNT, all_retry, chunked_retry,
+                self.LOOKUP_COUNT // 2, cancel_time)
+
+class PipeThroughputTest(PipeTestCase):
+    """Measure how fast we can send messages through a pipe.
+
+    We compare the current protocol to the old one, which pickled with
+    protocol 0 and did a separate write for the size and the data.
+    """
+
+    def old_dump_obj(self, obj, pipe):
+        pickle_data = cPickle.dumps(obj)
+        pipe.write(struct.pack("Q", len(pickle_data)))
+        pipe.write(pickle_data)
+        pipe.flush()
+
+    def old_load_obj(self, pipe):
+        size_data = subprocessmanager._read_bytes_from_pipe(pipe,
+                struct.calcsize("Q"))
+        size = struct.unpack("Q", size_data)[0]
+        return cPickle.loads(
+                subprocessmanager._read_bytes_from_pipe(pipe, size))
+
+    def new_dump_obj(self, obj, pipe):
+        subprocessmanager._dump_obj(obj, pipe)
+
+    def new_dump_obj_batched(self, objects, pipe):
+        subprocessmanager._write_to_pipe(pipe, ''.join(
+            subprocessmanager._encode_obj(obj) for obj in objects))
+
+    def make_small_messages(self):
+        return [workerprocess.TaskResult(i, {'duration': i, 'title': u'Song',
+                                             'file_type': u'audio'})
+                for i in xrange(5000)]
+
+    def make_big_messages(self):
+        body = ''.join('<item><title>Entry %d</title></item>' % i
+                       for i in xrange(50000))
+        return [workerprocess.FeedparserTask(body) for i in xrange(10)]
+
+    def time_transfer(self, messages, load_obj, send_messages):
+        self.start_reader(len(messages), load_obj)
+        start = time.time()
+        send_messages(messages)
+        self.reader_thread.join()
+        elapsed = time.time() - start
+        self.assertEquals(len(self.objects_read), len(messages))
+        return elapsed
+
+    def log_throughput(self, name, messages, elapsed):
+        size = sum(len(cPickle.dumps(m)) for m in messages)
+        report("%s: %.0f messages/s %.1f MB/s", name,
+               len(messages) / elapsed, size / elapsed / (1024 * 1024))
+
+    def check_throughput(self, description, messages):
+        def send_old(messages):
+            for msg in messages:
+                self.old_dump_obj(msg, self.write_pipe)
+        def send_new(messages):
+            for msg in messages:
+                self.new_dump_obj(msg, self.write_pipe)
+        def send_batched(messages):
+            self.new_dump_obj_batched(messages, self.write_pipe)
+        old_time = self.time_transfer(messages, self.old_load_obj, send_old)
+        new_time = self.time_transfer(messages, subprocessmanager._load_obj,
+                send_new)
+        batched_time = self.time_transfer(messages,
+                subprocessmanager._load_obj, send_batched)
+        self.log_throughput(description + " (before)", messages, old_time)
+        self.log_throughput(description + " (after)", messages, new_time)
+        self.log_throughput(description + " (after, batched)", messages,
+                batched_time)
+
+    def test_small_message_throughput(self):
+        self.check_throughput("small messages", self.make_small_messages())
+
+    def test_big_message_throughput(self):
+        self.check_throughput("feed bodies", self.make_big_messages())
@@ -1,14 +1,18 @@
 import os
+import struct
+import threading
 import time
 import Queue
 
 from miro import app
+from miro import metadata
 from miro import moviedata
 from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -226,6 +230,75 @@ class SubprocessManagerTest(EventLoopTest):
         self.runEventLoop(0.1, timeoutNormal=True)
         self.assertEquals(self.responder.pong_count, 1)
 
+class PipeTestCase(MiroTestCase):
+    """Base class for tests that send objects through an os.pipe()."""
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        read_fd, write_fd = os.pipe()
+        self.read_pipe = os.fdopen(read_fd, 'rb')
+        self.write_pipe = os.fdopen(write_fd, 'wb')
+
+    def tearDown(self):
+        self.read_pipe.close()
+        self.write_pipe.close()
+        MiroTestCase.tearDown(self)
+
+    def start_reader(self, count, load_obj=subprocessmanager._load_obj):
+        """Start a thread that reads count objects from our pipe."""
+        self.objects_read = []
+        def read_objects():
+            for i in xrange(count):
+                self.objects_read.append(load_obj(self.read_pipe))
+        self.reader_thread = threading.Thread(target=read_objects)
+        self.reader_thread.start()
+
+class PipeTest(PipeTestCase):
+    """Test the low-level functions that send objects over pipes."""
+
+    def test_small_message(self):
+        self.start_reader(2)
+        subprocessmanager._dump_obj({'foo': 'bar'}, self.write_pipe)
+        subprocessmanager._dump_obj(None, self.write_pipe)
+        self.reader_thread.join()
+        self.assertEquals(self.objects_read, [{'foo': 'bar'}, None])
+
+    def test_out_of_band(self):
+        data = 'a' * (subprocessmanager.OUT_OF_BAND_THRESHOLD + 1)
+        encoded = subprocessmanager._encode_obj(data)
+        # only the path should go through the pipe
+        self.assert_(len(encoded) < 1024)
+        size, kind = struct.unpack(subprocessmanager.HEADER_FORMAT,
+                encoded[:subprocessmanager.HEADER_SIZE])
+        self.assertEquals(kind, subprocessmanager.MESSAGE_OUT_OF_BAND)
+        path = encoded[subprocessmanager.HEADER_SIZE:]
+        self.assert_(os.path.exists(path))
+        self.start_reader(1)
+        self.write_pipe.write(encoded)
+        self.write_pipe.flush()
+        self.reader_thread.join()
+        self.assertEquals(self.objects_read, [data])
+        # the reader should delete the file once it's done
+        self.assert_(not os.path.exists(path))
+
+    def test_discard_out_of_band(self):
+        data = 'a' * (subprocessmanager.OUT_OF_BAND_THRESHOLD + 1)
+        small = subprocessmanager._encode_obj('small')
+        big = subprocessmanager._encode_obj(data)
+        path = big[subprocessmanager.HEADER_SIZE:]
+        self.assert_(os.path.exists(path))
+        # messages that never get sent shouldn't leave their files behind
+        subprocessmanager._discard_encoded_data(small + big)
+        self.assert_(not os.path.exists(path))
+
+    def test_corrupt_out_of_band(self):
+        path = os.path.join(self.tempdir, 'missing')
+        self.write_pipe.write(struct.pack(subprocessmanager.HEADER_FORMAT,
+            len(path), subprocessmanager.MESSAGE_OUT_OF_BAND) + path)
+        self.write_pipe.flush()
+        self.assertRaises(subprocessmanager.LoadError,
+                subprocessmanager._load_obj, self.read_pipe)
+
 class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
     def handle_feedparser_task(self, msg):
         if msg.html == 'FORCE EXCEPTION':
@@ -238,6 +311,12 @@ class UnittestWorkerProcessHandler(workerprocess.WorkerProcessHandler):
         time.sleep(0.5)
         return None
 
+    def handle_movie_data_program_task(self, msg):
+        if msg.source_path == 'HANG':
+            time.sleep(3600)
+        return workerprocess.WorkerProcessHandler.\
+                handle_movie_data_program_task(self, msg)
+
 class WorkerProcessTest(EventLoopTest):
     """Test our worker process."""
     def setUp(self):
@@ -263,14 +342,17 @@ class WorkerProcessTest(EventLoopTest):
         self.error = error
         self.stopEventLoop(abnormal=False)
 
+def make_feedparser_task():
+    path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+        "http___feeds_miroguide_com_miroguide_featured.xml")
+    html = open(path).read()
+    return workerprocess.FeedparserTask(html)
+
 class FeedParserTest(WorkerProcessTest):
     def send_feedparser_task(self):
         # send feedparser successfully parsing a feed
-        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
-            "http___feeds_miroguide_com_miroguide_featured.xml")
-        html = open(path).read()
-        msg = workerprocess.FeedparserTask(html)
-        workerprocess.send(msg, self.callback, self.errback)
+        workerprocess.send(make_feedparser_task(), self.callback,
+                           self.errback)
 
     def check_successful_result(self):
         if self.error is not None:
@@ -300,14 +382,14 @@ class FeedParserTest(WorkerProcessTest):
     def test_crash(self):
         # force a crash of our subprocess right after we send the task
         workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        process = workerprocess._subprocess_manager.processes[0]
+        original_pid = process.process.pid
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        process.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
         # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        self.assertNotEqual(original_pid, process.process.pid)
         self.check_successful_result()
 
     def test_queue_before_start(self):
@@ -320,6 +402,139 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+
+    def callback(self, msg, result):
+        self.results.append(result)
+        if len(self.results) == self.expected_results:
+            self.stopEventLoop(abnormal=False)
+
+    def send_feedparser_tasks(self, count):
+        self.expected_results = count
+        for i in xrange(count):
+            workerprocess.send(make_feedparser_task(), self.callback,
+                               self.errback)
+
+    def test_tasks_spread_over_processes(self):
+        workerprocess.startup(process_count=2)
+        processes = workerprocess._subprocess_manager.processes
+        self.assertEquals(len(processes), 2)
+        self.assertNotEquals(processes[0].process.pid,
+                             processes[1].process.pid)
+        self.send_feedparser_tasks(4)
+        self.assertEquals([len(p.tasks) for p in processes], [2, 2])
+        self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), 4)
+        self.assertEquals([len(p.tasks) for p in processes], [0, 0])
+
+    def test_crash_reassigns_tasks(self):
+        # If one process crashes, only it should get restarted and its tasks
+        # should get reassigned.
+        workerprocess.startup(process_count=2)
+        processes = workerprocess._subprocess_manager.processes
+        pids = [p.process.pid for p in processes]
+        self.send_feedparser_tasks(2)
+        processes[0].process.terminate()
+        with self.allow_warnings():
+            self.runEventLoop(4.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), 2)
+        self.assertNotEquals(processes[0].process.pid, pids[0])
+        self.assertEquals(processes[1].process.pid, pids[1])
+
+    def test_mutagen_batches_spread_over_processes(self):
+        # the mutagen processor should keep every process in the pool busy
+        workerprocess.startup(process_count=4)
+        processes = workerprocess._subprocess_manager.processes
+        processor = metadata._MutagenProcessor(u'mutagen', 10)
+        processor.add_tasks([
+            workerprocess.MutagenTask('/videos/video-%d.mp3' % i,
+                                      self.tempdir)
+            for i in xrange(200)])
+        self.assertEquals(
+            [p.class_counts[workerprocess.MutagenBatchTask]
+             for p in processes], [2, 2, 2, 2])
+
+    @mock.patch.object(workerprocess.WorkerProcess, 'MOVIE_DATA_TIMEOUT',
+                       0.5)
+    def test_hung_movie_data_process_killed(self):
+        # A process that hangs on a movie data task should get killed, not
+        # just replaced, and only its task should fail.
+        movie_data_manager = workerprocess._movie_data_manager
+        movie_data_manager.handler_class = UnittestWorkerProcessHandler
+        try:
+            workerprocess.startup(process_count=1)
+            process = movie_data_manager.processes[0]
+            old_popen = process.process
+            msg = workerprocess.MovieDataProgramTask('HANG', self.tempdir)
+            workerprocess.send(msg, self.callback, self.errback)
+            with self.allow_warnings():
+                self.runEventLoop(10.0)
+            self.assert_(isinstance(self.error,
+                                    workerprocess.SubprocessTimeoutError))
+            for i in xrange(20):
+                if old_popen.poll() is not None:
+                    break
+                time.sleep(0.1)
+            self.assertNotEquals(old_popen.poll(), None)
+            self.assert_(process.is_running)
+            self.assertNotEquals(process.process.pid, old_popen.pid)
+            self.assertEquals(process.tasks, {})
+        finally:
+            movie_data_manager.handler_class = (
+                    workerprocess.WorkerProcessHandler)
+
+    def test_movie_data_uses_own_pool(self):
+        # MovieDataProgramTasks should go to their own processes, so that a
+        # hung movie data task doesn't affect other tasks.
+        workerprocess.startup(process_count=1)
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        msg = workerprocess.MovieDataProgramTask(source_path, self.tempdir)
+        self.expected_results = 1
+        workerprocess.send(msg, self.callback, self.errback)
+        movie_data_process = workerprocess._movie_data_manager.processes[0]
+        other_process = workerprocess._subprocess_manager.processes[0]
+        self.assertEquals(movie_data_process.tasks.keys(), [msg.task_id])
+        self.assertEquals(other_process.tasks, {})
+        self.runEventLoop(30.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), 1)
+        self.assertEquals(movie_data_process.tasks, {})
+
+    def test_queue_before_start_uses_right_pool(self):
+        # Tasks queued before startup() should only get sent to the pool
+        # that handles them.
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        movie_data_msg = workerprocess.MovieDataProgramTask(source_path,
+                                                            self.tempdir)
+        feedparser_msg = make_feedparser_task()
+        self.expected_results = 2
+        workerprocess.send(movie_data_msg, self.callback, self.errback)
+        workerprocess.send(feedparser_msg, self.callback, self.errback)
+        workerprocess.startup(process_count=1)
+        movie_data_process = workerprocess._movie_data_manager.processes[0]
+        other_process = workerprocess._subprocess_manager.processes[0]
+        self.assertEquals(movie_data_process.tasks.keys(),
+                          [movie_data_msg.task_id])
+        self.assertEquals(other_process.tasks.keys(),
+                          [feedparser_msg.task_id])
+        self.runEventLoop(30.0)
+        self.assertEquals(self.error, None)
+        self.assertEquals(len(self.results), 2)
+        self.assertEquals(movie_data_process.tasks, {})
+        self.assertEquals(other_process.tasks, {})
+
+    def test_cancel_before_start(self):
+        source_path = resources.path("testdata/metadata/mp3-0.mp3")
+        msg = workerprocess.MutagenTask(source_path, self.tempdir)
+        workerprocess.send(msg, self.callback, self.errback)
+        workerprocess.cancel_tasks_for_files([source_path])
+        self.assertEquals(workerprocess._miro_task_queue.pending_tasks(), [])
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
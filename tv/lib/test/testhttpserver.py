@@ -11,6 +11,7 @@ import os
 import posixpath
 import urllib
 import socket
+import SocketServer
 import threading
 
 from miro.plat import utils
@@ -225,7 +226,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if start != '':
                     self.start_pos = int(start)
                 if end != '':
-                    self.end_pos = int(end)
+                    # end_pos is exclusive, the header value is inclusive
+                    self.end_pos = int(end) + 1
                 code = 206
                 headers_to_send.append(('Content-Range', range))
         f = None
@@ -291,10 +293,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_error(self, *args):
         pass
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 class HTTPServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, threaded=False):
+        """Create an HTTPServer.
+
+        :param threaded: handle each connection in a separate thread.  Use
+            this for tests that need to open several connections at once.
+        """
         threading.Thread.__init__(self)
         self.event = threading.Event()
+        self.threaded = threaded
 
     def start(self):
         threading.Thread.start(self)
@@ -312,7 +324,11 @@ class HTTPServer(threading.Thread):
         else:
             utils.finish_thread_loop(self)
             raise AssertionError("Can't find an open port")
-        self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
+        if self.threaded:
+            server_class = ThreadingHTTPServer
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        self.httpserver = server_class(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
         self.httpserver.headers_to_send = []
@@ -352,8 +368,8 @@ class HTTPServer(threading.Thread):
             s.close()
             return True
 
-    def build_url(self, path):
-        return 'http://localhost:%s/%s' % (self.port, path)
+    def build_url(self, path, host='localhost'):
+        return 'http://%s:%s/%s' % (host, self.port, path)
 
     def last_info(self):
         return self.httpserver.last_info
@@ -1390,9 +1390,11 @@ def alarm(timeout, set_signal=True):
     if set_signal:
         signal.signal(signal.SIGALRM, alarm_handler)
         signal.alarm(timeout)
-    yield set_signal
-    if set_signal:
-        signal.alarm(0)
+    try:
+        yield set_signal
+    finally:
+        if set_signal:
+            signal.alarm(0)
 
 def supports_alarm():
     return hasattr(signal, 'SIGALRM')
@@ -30,13 +30,18 @@
 """```workerprocess.py``` -- Miro worker subprocess
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to this process.  See #17328 for more details.  This includes
+feedparser, mutagen and movie data tasks.
+
+Most of these tasks are pure python, so a single process only uses one core
+at a time.  We run a pool of worker processes (by default one per core) and
+spread the tasks between them.
 """
 
-from collections import deque, namedtuple
+from collections import defaultdict, deque, namedtuple
 import itertools
 import logging
+import multiprocessing
 import threading
 
 from miro import clock
@@ -71,17 +76,41 @@ class TaskMessage(WorkerMessage):
         self.task_id = TaskMessage._id_counter.next()
 
 class FeedparserTask(TaskMessage):
+    """Parse a feed.
+
+    The feed data is either passed in directly with html, or stored in a file
+    at path.  Passing a path avoids sending large feeds through the pipe.
+
+    If known_fingerprints is given, only new and changed entries get sent
+    back.  See feedparserutil.parse() for details.
+    """
     priority = 20
-    def __init__(self, html):
+    def __init__(self, html=None, path=None, charset=None,
+                 known_fingerprints=None, stop_after=None):
         TaskMessage.__init__(self)
         self.html = html
+        self.path = path
+        self.charset = charset
+        self.known_fingerprints = known_fingerprints
+        self.stop_after = stop_after
 
 class MovieDataProgramTask(TaskMessage):
+    """Get the duration and a screenshot for a file.
+
+    MovieDataProgramTasks are handled by their own pool of processes (see
+    _movie_data_manager).
+
+    :param source_path: path to the file
+    :param screenshot_directory: directory to put the screenshot in
+    :param duration: duration in milliseconds, if we already know it from
+        mutagen.  This lets the extractor skip calculating it.
+    """
     priority = 10
-    def __init__(self, source_path, screenshot_directory):
+    def __init__(self, source_path, screenshot_directory, duration=None):
         TaskMessage.__init__(self)
         self.source_path = source_path
         self.screenshot_directory = screenshot_directory
+        self.duration = duration
 
     def __str__(self):
         return 'MovieDataProgramTask (path: %s)' % self.source_path
@@ -96,6 +125,36 @@ class MutagenTask(TaskMessage):
     def __str__(self):
         return 'MutagenTask (path: %s)' % self.source_path
 
+class MutagenBatchTask(TaskMessage):
+    """Run mutagen on several files at once.
+
+    The result is a list of (source_path, result) tuples, where result is
+    either the metadata dict or the exception we got for that file.  If a
+    file gets canceled with CancelFileOperations, it's left out of the
+    result.
+    """
+    priority = 10
+    def __init__(self, source_paths, cover_art_directory):
+        TaskMessage.__init__(self)
+        self.source_paths = source_paths
+        self.cover_art_directory = cover_art_directory
+
+    def __str__(self):
+        return 'MutagenBatchTask (%d paths)' % len(self.source_paths)
+
+def _remove_canceled_paths(msg, path_set):
+    """Remove canceled paths from a file operation task.
+
+    :returns: True if the task still needs to run
+    """
+    if isinstance(msg, MutagenBatchTask):
+        # keep the task, even if it's empty.  The main process is waiting
+        # for a result for it.
+        msg.source_paths = [p for p in msg.source_paths
+                            if p not in path_set]
+        return True
+    return msg.source_path not in path_set
+
 class CancelFileOperations(TaskMessage):
     """Cancel mutagen/movie data tasks for a set of path."""
     priority = 0
@@ -141,7 +200,7 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # one.  Put it in main_thread_tasks and handle once
                 # there's no more tasks waiting in to be processed
                 self.main_thread_tasks.append((method, msg))
-            elif isinstance(msg, MutagenTask):
+            elif isinstance(msg, (MutagenTask, MutagenBatchTask)):
                 # If we're using the alarm, then MutagenTasks need to run in
                 # the main thread as well.  Signals aren't support outside of
                 # the main thread.
@@ -164,6 +223,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
                 # if we're here, it means we want to use the signals
                 handle_task(self.handle_mutagen_task_with_alarm, msg)
                 continue
+            if isinstance(msg, MutagenBatchTask):
+                handle_task(self.handle_mutagen_batch_task_with_alarm, msg)
+                continue
             handle_task(method, msg)
 
         # block waiting for the next message.  We know that one of the
@@ -192,8 +254,9 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque((method, msg)
+                               for (method, msg) in self.main_thread_tasks
+                               if _remove_canceled_paths(msg, path_set))
         self.main_thread_tasks = filtered_tasks
         return None
 
@@ -202,14 +265,22 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
 
     def handle_movie_data_program_task(self, msg):
         return moviedata.process_file(msg.source_path,
-                                      msg.screenshot_directory)
+                                      msg.screenshot_directory,
+                                      msg.duration)
 
 
     # NOTE: all of the handle_*_task() methods below get called in one of our
     # worker threads, so they should only call thread-safe functions
 
     def handle_feedparser_task(self, msg):
-        parsed_feed = feedparserutil.parse(msg.html)
+        if msg.path is not None:
+            parsed_feed = feedparserutil.parse_file(msg.path, msg.charset,
+                                                    msg.known_fingerprints,
+                                                    msg.stop_after)
+        else:
+            parsed_feed = feedparserutil.parse(msg.html,
+                                               msg.known_fingerprints,
+                                               msg.stop_after)
         # bozo_exception is sometimes C object that is not picklable.  We
         # don't use it anyways, so just unset the value
         parsed_feed['bozo_exception'] = None
@@ -222,6 +293,26 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
         with util.alarm(2):
             return self.handle_mutagen_task(msg)
 
+    def handle_mutagen_batch_task(self, msg):
+        return self._process_mutagen_batch(msg, False)
+
+    def handle_mutagen_batch_task_with_alarm(self, msg):
+        return self._process_mutagen_batch(msg, True)
+
+    def _process_mutagen_batch(self, msg, use_alarm):
+        results = []
+        for path in msg.source_paths:
+            try:
+                with util.alarm(2, set_signal=use_alarm):
+                    result = filetags.process_file(path,
+                                                   msg.cover_art_directory)
+            except StandardError, e:
+                # one bad file shouldn't fail the entire batch
+                logging.info("mutagen error: %s (%s)", path, e)
+                result = e
+            results.append((path, result))
+        return results
+
 class _SinglePriorityQueue(object):
     """Manages tasks at a single priority for WorkerTaskQueue
 
@@ -336,8 +427,8 @@ class WorkerTaskQueue(object):
         # tasks from getting tasks, since they may be about to deleted.
         with self.condition:
             def filter_func(msg):
-                return msg.source_path not in path_set
-            for cls in (MutagenTask, MovieDataProgramTask):
+                return _remove_canceled_paths(msg, path_set)
+            for cls in (MutagenTask, MutagenBatchTask, MovieDataProgramTask):
                 queue = self.queue_map[cls.priority]
                 queue.filter_messages(filter_func, cls)
 
@@ -385,15 +476,17 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, pool):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.pool = pool
+        # WorkerProcess that we handle responses for
+        self.process = None
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.process.send_message(self.pool.startup_message)
+        self.pool.process_started(self.process)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -404,6 +497,7 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
+        self.pool.task_finished(msg.task_id)
         _miro_task_queue.process_result(msg)
 
     def handle_worker_process_ready(self, msg):
@@ -413,8 +507,10 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         if msg.task_id is not None:
             self.movie_data_task_status = MovieDataTaskStatusInfo(
                     msg.task_id, clock.clock())
+            self.process.schedule_check_subprocess_hung()
         else:
             self.movie_data_task_status = None
+            self.process.cancel_check_subprocess_hung()
 
 class MiroTaskQueue(object):
     """Store the pending tasks for the main process.
@@ -433,34 +529,79 @@ class MiroTaskQueue(object):
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        manager = _manager_for_task(msg)
+        if manager.is_running:
+            manager.send_task(msg)
 
     def process_result(self, reply):
         """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # CancelFileOperations, or a task that we canceled
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def cancel_file_operations(self, path_set):
+        """Forget about mutagen/movie data tasks for a set of paths."""
+        for task_id, (msg, callback, errback) in \
+                self.tasks_in_progress.items():
+            if (isinstance(msg, (MutagenTask, MovieDataProgramTask)) and
+                    msg.source_path in path_set):
+                del self.tasks_in_progress[task_id]
+                _manager_for_task(msg).task_finished(task_id)
+
+    def pending_tasks(self):
+        """Get the messages for all tasks in the queue."""
+        return [msg for (msg, callback, errback)
+                in self.tasks_in_progress.values()]
 
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
-class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
+# Manage subprocesses
+class WorkerProcess(subprocessmanager.SubprocessManager):
+    """One worker process in a WorkerSubprocessManager pool.
+
+    If a MovieDataProgramTask runs for longer than MOVIE_DATA_TIMEOUT
+    seconds, we assume that it's hung.  We send an error for the task and
+    restart the process.
+    """
+
+    # gst_extractor gives up after 30 seconds on its own, so anything
+    # longer than this means the process is stuck.
+    MOVIE_DATA_TIMEOUT = 45
+
+    def __init__(self, pool):
+        responder = WorkerProcessResponder(pool)
         subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+                responder, pool.handler_class,
+                restart_delay=pool.restart_delay)
+        responder.process = self
+        self.pool = pool
         self.check_hung_timeout = None
-
-    def _start(self):
-        subprocessmanager.SubprocessManager._start(self)
-        self.schedule_check_subprocess_hung()
+        # maps task_ids to messages for the tasks we've sent to this process
+        self.tasks = {}
+        # maps TaskMessage classes to the number of them in self.tasks
+        self.class_counts = defaultdict(int)
+
+    def add_task(self, msg):
+        self.tasks[msg.task_id] = msg
+        self.class_counts[msg.__class__] += 1
+        self.send_message(msg)
+
+    def remove_task(self, task_id):
+        msg = self.tasks.pop(task_id)
+        self.class_counts[msg.__class__] -= 1
+
+    def take_tasks(self):
+        """Remove all tasks from this process and return them."""
+        tasks = self.tasks.values()
+        self.tasks = {}
+        self.class_counts.clear()
+        return tasks
 
     def shutdown(self):
         self.cancel_check_subprocess_hung()
@@ -471,9 +612,25 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         self.responder.movie_data_task_status = None
         subprocessmanager.SubprocessManager.restart(self, clean)
 
+    def kill_and_restart(self):
+        """Kill our process and start a new one.
+
+        A hung process won't read the quit message from stdin, so restart()
+        alone would leave it running.
+        """
+        self.thread.detach()
+        try:
+            self.process.kill()
+        except OSError:
+            # the process already quit
+            pass
+        self.restart()
+
     def schedule_check_subprocess_hung(self):
-        self.check_hung_timeout = eventloop.add_timeout(90,
-                self.check_subprocess_hung, 'check workerprocess hung')
+        self.cancel_check_subprocess_hung()
+        self.check_hung_timeout = eventloop.add_timeout(
+                self.MOVIE_DATA_TIMEOUT, self.check_subprocess_hung,
+                'check workerprocess hung')
 
     def cancel_check_subprocess_hung(self):
         if self.check_hung_timeout is not None:
@@ -481,30 +638,175 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
             self.check_hung_timeout = None
 
     def check_subprocess_hung(self):
+        self.check_hung_timeout = None
         task_status = self.responder.movie_data_task_status
-
-        if (task_status is not None and
-                clock.clock() - task_status.start_time > 90):
+        if task_status is None:
+            return
+        elapsed = clock.clock() - task_status.start_time
+        if elapsed >= self.MOVIE_DATA_TIMEOUT:
             logging.warn("Worker process is hanging on a movie data task.")
             error_result = TaskResult(task_status.task_id,
                     SubprocessTimeoutError())
             self.responder.handle_task_result(error_result)
-            self.restart()
+            self.kill_and_restart()
+        else:
+            # the timeout fired early, check again when the task is due
+            self.check_hung_timeout = eventloop.add_timeout(
+                    self.MOVIE_DATA_TIMEOUT - elapsed,
+                    self.check_subprocess_hung, 'check workerprocess hung')
+
+class WorkerSubprocessManager(object):
+    """Manages a pool of worker processes.
+
+    Each task is sent to the running process with the fewest tasks of the
+    same class, so that each kind of task gets spread over all processes.
+    Processes get restarted separately if they crash or hang.  When that
+    happens, the tasks that the process was working on get spread over the
+    pool again.
+
+    Non-task messages like CancelFileOperations get sent to every process
+    in every pool.
+    """
+    def __init__(self):
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.startup_message = None
+        self.processes = []
+        # maps task_ids to the process that's handling them
+        self.task_processes = {}
+        WorkerMessage.install_handler(self)
+
+    @property
+    def is_running(self):
+        return any(p.is_running for p in self.processes)
+
+    def start(self, process_count):
+        if self.is_running:
+            return
+        self.processes = [WorkerProcess(self) for i in xrange(process_count)]
+        # Each SubprocessManager installs itself as the handler for
+        # WorkerMessage.  Messages should go through us instead.
+        WorkerMessage.install_handler(self)
+        self.task_processes = {}
+        for process in self.processes:
+            process.start()
+        for msg in _miro_task_queue.pending_tasks():
+            if (_manager_for_task(msg) is self and
+                    msg.task_id not in self.task_processes):
+                self.send_task(msg)
+
+    def shutdown(self):
+        for process in self.processes:
+            process.shutdown()
+
+    def restart(self, clean=False):
+        for process in self.processes:
+            if process.is_running:
+                process.restart(clean)
+
+    def process_started(self, process):
+        """Called when one of our processes starts or restarts."""
+        for msg in process.take_tasks():
+            del self.task_processes[msg.task_id]
+            self.send_task(msg)
+
+    def send_task(self, msg):
+        running = [p for p in self.processes if p.is_running]
+        if not running:
+            # we'll send the task once we start
+            return
+        process = min(running, key=lambda p: (p.class_counts[msg.__class__],
+                                              len(p.tasks)))
+        self.task_processes[msg.task_id] = process
+        process.add_task(msg)
+
+    def task_finished(self, task_id):
+        try:
+            process = self.task_processes.pop(task_id)
+        except KeyError:
+            return
+        process.remove_task(task_id)
+
+    def broadcast(self, msg):
+        """Send a message to every running process."""
+        for process in self.processes:
+            if process.is_running:
+                process.send_message(msg)
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        if isinstance(msg, TaskMessage):
+            _manager_for_task(msg).send_task(msg)
         else:
-            self.schedule_check_subprocess_hung()
+            for manager in _all_managers():
+                manager.broadcast(msg)
 
+# Pool for everything except movie data
 _subprocess_manager = WorkerSubprocessManager()
+# Pool for MovieDataProgramTasks.  Each process only handles one movie data
+# task at a time, so restarting a process after a timeout only affects that
+# task, and a slow file doesn't hold up feedparser and mutagen work.
+_movie_data_manager = WorkerSubprocessManager()
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+def _manager_for_task(msg):
+    if isinstance(msg, MovieDataProgramTask):
+        return _movie_data_manager
+    else:
+        return _subprocess_manager
+
+def _all_managers():
+    return (_subprocess_manager, _movie_data_manager)
+
+def default_process_count():
+    """Get the number of worker processes to use by default.
+
+    This is the number of CPU cores.
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+def process_count():
+    """Get the number of processes in the main pool.
+
+    If the pool hasn't started yet, this is default_process_count().
+    """
+    return (len(_subprocess_manager.processes) or
+            default_process_count())
+
+def movie_data_process_count(process_count):
+    """Get the number of movie data processes to use.
+
+    We use half as many as the main pool, so that we don't start 2 processes
+    per core.
+
+    :param process_count: number of processes in the main pool
+    """
+    return max(1, process_count // 2)
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
+
+    :param thread_count: number of worker threads in each process
+    :param process_count: number of processes to start for the main pool.
+        Defaults to default_process_count().  The movie data pool gets
+        movie_data_process_count(process_count) processes.
+    """
+    if process_count is None:
+        process_count = default_process_count()
+    _subprocess_manager.startup_message = WorkerStartupInfo(thread_count)
+    _subprocess_manager.start(process_count)
+    # movie data runs in the main thread of the worker process, so we don't
+    # need any worker threads for it
+    _movie_data_manager.startup_message = WorkerStartupInfo(0)
+    _movie_data_manager.start(movie_data_process_count(process_count))
 
 def shutdown():
-    """Shutdown the worker process."""
-    _subprocess_manager.shutdown()
+    """Shutdown the worker processes."""
+    for manager in _all_managers():
+        manager.shutdown()
 
 # API for sending tasks
 def send(msg, callback, errback):
@@ -518,9 +820,9 @@ def send(msg, callback, errback):
 
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
-    msg = CancelFileOperations(paths)
-    # we don't care about the return value, but we still want to use the task
-    # queue to queue up this message.
-    def null_callback(msg, result):
-        pass
-    send(msg, null_callback, null_callback)
+    path_set = set(paths)
+    _miro_task_queue.cancel_file_operations(path_set)
+    # Tasks may already be queued up in the worker processes.  Tell all of
+    # them to drop the tasks.
+    for manager in _all_managers():
+        manager.broadcast(CancelFileOperations(paths))
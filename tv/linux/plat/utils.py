@@ -309,9 +309,9 @@ def exit_miro(return_code):
     """
     sys.exit(return_code)
 
-def run_media_metadata_extractor(movie_path, thumbnail_path):
+def run_media_metadata_extractor(movie_path, thumbnail_path, duration=None):
     from miro.frontends.widgets.gst import gst_extractor
-    return gst_extractor.run(movie_path, thumbnail_path)
+    return gst_extractor.run(movie_path, thumbnail_path, duration)
 
 def miro_helper_program_info():
     """Get the command line to launch miro_helper.py """
@@ -152,7 +152,7 @@ def extract_thumbnail(qtmovie, target, width=0, height=0):
 def usage():
     print 'usage: %s movie thumb' % sys.argv[0]
 
-def run(movie_path, thumb_path):
+def run(movie_path, thumb_path, duration=None):
     # XXX movieWithFile_error_ may be asynchronous, but at least when
     # it is done locally it seems to return in such a way that makes it possible
     # to extract stuff.  The QTMovieLoadState attribute never seems to update,
@@ -170,7 +170,8 @@ def run(movie_path, thumb_path):
         return ('other', -1, None)
     
     movie_type = get_type(qtmovie)
-    duration = extract_duration(qtmovie)
+    if duration is None:
+        duration = extract_duration(qtmovie)
     thmb_result = False
 
     if movie_type == "video":
@@ -449,8 +449,8 @@ def _get_cmd_line_and_env_for_script(script_name):
             env[k] = env[k].encode('utf-8')
     return ((py_exe_path, script_path), env)
 
-def run_media_metadata_extractor(movie_path, thumbnail_path):
-    return qt_extractor.run(movie_path, thumbnail_path)
+def run_media_metadata_extractor(movie_path, thumbnail_path, duration=None):
+    return qt_extractor.run(movie_path, thumbnail_path, duration)
 
 def miro_helper_program_info():
     cmd_line = _app_command_line() + [u'--miro-helper']
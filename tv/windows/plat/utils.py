@@ -367,8 +367,8 @@ def exit_miro(return_code):
     except WindowsError:
         pass
 
-def run_media_metadata_extractor(movie_path, thumbnail_path):
-    return gst_extractor.run(movie_path, thumbnail_path)
+def run_media_metadata_extractor(movie_path, thumbnail_path, duration=None):
+    return gst_extractor.run(movie_path, thumbnail_path, duration)
 
 def get_logical_cpu_count():
     try: